@@ -1,13 +1,17 @@
 import re
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, defaultdict, deque
 import random
 from functools import wraps
+from timeit import default_timer
+import weakref
 
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from .pluginbase import BotPlugin
+from .transport import Histogram
 
 """
 
@@ -45,7 +49,127 @@ This command framework has a few nice features: easily defined commands with
 flexible argument parsing with regular expressions, an integrated help system,
 and automatic permission checking.
 
+Messages are not checked by each plugin in turn. One router per transport
+listens for irc.on_privmsg, strips the nick or global prefix once, and looks
+up the commands that could match by the first word of the message. Only
+those commands' regular expressions are tried. A message that doesn't start
+with the bot's nick, the global prefix or a command's own prefix, and isn't a
+direct message, is dismissed without trying any.
+
+How often each user may invoke each command can be limited by setting
+config['command']['ratelimit'], see _RateLimiter. Invocations over the limit
+are held back for a while or dropped without a reply.
+
+Setting config['command']['stats'] counts and times every command that is
+run, see _CommandStats.
+
 """
+
+# Matches the word a message must start with to invoke a command
+_WORD = re.compile(r"\w+")
+
+# Matches cmdmatch expressions that are just a list of alternative words
+_WORDS = re.compile(r"\w+(?:\|\w+)*\$?$")
+
+def _first_words(grpname, cmdname, cmdmatch):
+    """Returns the list of words that a message invoking a command must start
+    with, or None if they can't be known without trying the regex
+
+    """
+    if grpname:
+        return [grpname] if _WORD.match(grpname).group() == grpname else None
+    if cmdmatch is None:
+        m = _WORD.match(cmdname)
+        return [cmdname] if m and m.group() == cmdname else None
+    if _WORDS.match(cmdmatch):
+        return cmdmatch.rstrip("$").split("|")
+    return None
+
+# Named groups can't be repeated within one pattern, so they are made
+# non-capturing in combined patterns
+_NAMED_GROUP = re.compile(r"(?<!\\)\(\?P<\w+>")
+
+# Patterns using these can't be combined: backreferences and conditional
+# groups would refer to the wrong groups, or to names that are made
+# non-capturing, and inline flags would apply to every alternative
+_UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)")
+
+# The most groups a combined pattern may have. Python 2's re module refuses
+# patterns with more than 100.
+_MAX_GROUPS = 99
+
+class _Alternation(object):
+    """Finds the first of a list of regular expressions that matches a
+    string, trying most of them at once.
+
+    The regexes are joined into as few patterns of the form
+    (?P<_0>...)|(?P<_1>...)|... as the group limit allows, so that one call
+    into the regex engine tries them all in order. A regex that can't be
+    joined with others is tried on its own, in its place in the list, and so
+    is each regex of a combined pattern that fails to compile. None entries in
+    regexes are skipped.
+
+    """
+    def __init__(self, regexes):
+        self.regexes = regexes
+
+        # list of (compiled pattern, position) in the order of regexes.
+        # position is None for combined patterns.
+        self.chunks = []
+        parts = []
+        groups = 0
+        for pos, regex in enumerate(regexes):
+            if regex is None:
+                continue
+            pattern = _NAMED_GROUP.sub("(?:", regex.pattern)
+            ngroups = regex.groups + 1
+            if _UNCOMBINABLE.search(pattern) or ngroups > _MAX_GROUPS:
+                self._add_chunk(parts)
+                parts = []
+                groups = 0
+                self.chunks.append((regex, pos))
+                continue
+            if groups + ngroups > _MAX_GROUPS:
+                self._add_chunk(parts)
+                parts = []
+                groups = 0
+            parts.append((pos, "(?P<_%d>%s)" % (pos, pattern)))
+            groups += ngroups
+        self._add_chunk(parts)
+
+    def _add_chunk(self, parts):
+        if not parts:
+            return
+        try:
+            combined = re.compile("|".join(part for pos, part in parts))
+        except re.error as e:
+            # Something _UNCOMBINABLE doesn't know about. Routing must not
+            # stop working for every plugin over it.
+            log.msg("Could not combine command regexes ({0}), trying them "
+                    "one by one".format(e))
+            self.chunks.extend((self.regexes[pos], pos) for pos, part in parts)
+        else:
+            self.chunks.append((combined, None))
+
+    def first(self, text):
+        """Returns (position in regexes, match object) for the first regex
+        that matches text, or (None, None)
+
+        """
+        for pattern, pos in self.chunks:
+            m = pattern.match(text)
+            if m is None:
+                continue
+            if pos is not None:
+                return pos, m
+            # The marker group of the alternative that matched encloses its
+            # other groups, so it is the last one to have closed. The
+            # winning regex is matched again to give the callback its own
+            # groups.
+            pos = int(m.lastgroup[1:])
+            return pos, self.regexes[pos].match(text)
+        return None, None
+
 def require_channel(func):
     """Wraps command callbacks and requires them to be in response to a channel
     message, not a private message directed to the bot.
@@ -72,16 +196,19 @@ class _CommandGroup(object):
             permission=None,
             helptext=None,
             globalprefix=None,
+            changed=lambda: None,
             ):
         self.grpname = grpname
         self.cmdlist = cmdlist
         self.prefix = prefix
         self.permission = permission
         self.globalprefix = globalprefix
+        # called whenever a command or group is installed
+        self.changed = changed
 
         if grpname:
-            help_re = re.compile("(?:help )?(?:%s)?%s" % (
-                prefix if prefix else "",
+            help_re = re.compile(r"(?:help )?(?:%s)?%s\b" % (
+                re.escape(prefix) if prefix else "",
                 re.escape(grpname),
                 ))
         else:
@@ -112,7 +239,9 @@ class _CommandGroup(object):
             helpre=help_re,
             helplines=helplines,
             subcmds=self.subcmds,
+            prefix=self.prefix,
             ))
+        changed()
 
     def install_command(self,
             cmdname,
@@ -202,6 +331,7 @@ class _CommandGroup(object):
         # plus the prefix. If this command doesn't give a prefix, go with the
         # group prefix.
         prefix = prefix if prefix is not None else self.prefix
+        cmdprefix = prefix
         if prefix is not None:
             prefix_re = re.compile(re.escape(prefix) + commandargs_str)
         else:
@@ -223,7 +353,7 @@ class _CommandGroup(object):
         if prefix is None:
             prefix = self.globalprefix
             if prefix is None:
-                # This will be replaced in __do_help(), since we don't want to
+                # This will be replaced in _do_help(), since we don't want to
                 # assume the nick won't change at runtime
                 prefix = "{nickname}: "
 
@@ -244,10 +374,13 @@ class _CommandGroup(object):
             callback=callback,
             deniedcallback=deniedcallback,
             helplines=help_str.split("\n"),
+            prefix=cmdprefix,
+            firstwords=_first_words(self.grpname, cmdname, cmdmatch),
             ))
         self.subcmds.append(
                 (cmdname,permission if permission else self.permission)
                 )
+        self.changed()
 
 
 _CommandTuple = namedtuple("_CommandTuple", [
@@ -258,29 +391,531 @@ _CommandTuple = namedtuple("_CommandTuple", [
     "helpre",
     "callback",
     "deniedcallback",
-    "helplines"
+    "helplines",
+    "prefix",
+    "firstwords",
     ])
 _CommandGroupTuple = namedtuple("_CommandGroupTuple", [
     "grpname",
     "helpre",
     "helplines",
     "subcmds",
+    "prefix",
     ])
 
+class _RateLimiter(object):
+    """Token buckets limiting how often each user may invoke each command.
+
+    Settings, from config['command']['ratelimit']:
+    rate: how many invocations per second a bucket refills by
+    burst: how many invocations a full bucket holds
+    delay: how many seconds an invocation over the limit may be held back
+        until its bucket refills. Invocations that would have to wait longer
+        are dropped. With the default of 0 they are all dropped.
+    commands: maps command names to dicts of rate and burst for those
+        commands, overriding the above. Help for any command or group counts
+        as the command "help".
+    size: how many buckets to keep at most
+
+    Users are told apart by the user@host part of their hostmask, so changing
+    nicks doesn't refill their buckets. The buckets are kept in the order
+    they were last used. A bucket that has been left alone long enough to
+    fill up is the same as a new one, so those are dropped from the front,
+    as are the oldest ones once there are more than size.
+
+    This object provides the command.ratelimit request, which returns a list
+    of dicts with the keys command, dropped and delayed, one for each
+    command that has been throttled.
+
+    """
+    plugin_name = "command.RateLimiter"
+
+    def __init__(self, settings, clock=reactor):
+        self._clock = clock
+        # maps (user@host, command name) to (tokens, time they were counted)
+        self.buckets = OrderedDict()
+        # maps command names to [dropped, delayed] counters
+        self.throttled = defaultdict(lambda: [0, 0])
+        self.configure(settings)
+
+    def configure(self, settings):
+        self.rate = settings.get("rate", 0.5)
+        self.burst = settings.get("burst", 5)
+        self.delay = settings.get("delay", 0)
+        self.commands = settings.get("commands", {})
+        self.size = settings.get("size", 10000)
+
+    def _limits(self, cmdname):
+        limits = self.commands.get(cmdname, {})
+        return limits.get("rate", self.rate), limits.get("burst", self.burst)
+
+    def _evict(self, now):
+        while self.buckets:
+            key = next(iter(self.buckets))
+            tokens, counted = self.buckets[key]
+            rate, burst = self._limits(key[1])
+            if (len(self.buckets) <= self.size and
+                    tokens + (now - counted) * rate < burst):
+                break
+            del self.buckets[key]
+
+    def take(self, user, cmdname):
+        """Takes a token from the bucket of the user with hostmask user for
+        the command cmdname. Returns how many seconds to hold the invocation
+        back for, 0 if it can go ahead now, or None if it should be dropped.
+
+        """
+        now = self._clock.seconds()
+        key = (user.split("!", 1)[-1], cmdname)
+        rate, burst = self._limits(cmdname)
+        tokens, counted = self.buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - counted) * rate)
+
+        if tokens >= 1:
+            wait = 0
+        elif rate > 0 and (1 - tokens) / rate <= self.delay:
+            wait = (1 - tokens) / rate
+            self.throttled[cmdname][1] += 1
+        else:
+            wait = None
+            self.throttled[cmdname][0] += 1
+        if wait is not None:
+            # Invocations held back take their token now, so the bucket goes
+            # negative and the next one waits behind them
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        self._evict(now)
+        return wait
+
+    def summary(self):
+        return [dict(command=cmdname, dropped=dropped, delayed=delayed)
+                for cmdname, (dropped, delayed) in sorted(self.throttled.items())]
+
+    def handles_event(self, eventtype):
+        return False
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def incoming_request(self, name):
+        return self.summary()
+
+class _CommandStats(object):
+    """Counts and times command invocations.
+
+    For each command of each plugin it counts the calls, how many were denied
+    and how many callbacks failed, and keeps Histograms of how long the
+    permission check took and how long the callback took. A callback that
+    returns a deferred is timed until the deferred fires.
+
+    Settings, from config['command']['stats']:
+    slow: how many seconds a command may take, permission check and callback
+        together, before it is put in the slow log
+    keep: how many of the most recent slow commands to remember
+
+    This object provides the command.stats request. It returns a dict with
+    the keys commands, a list of dicts describing each command, most expensive
+    (by total time) first, and slow, the slow log, oldest first. A top keyword
+    argument limits how many commands are returned.
+
+    """
+    plugin_name = "command.CommandStats"
+
+    def __init__(self, settings, clock=reactor):
+        self._clock = clock
+        # maps (plugin name, command name) to [calls, denied, failed,
+        # permission check Histogram, callback Histogram]
+        self.commands = {}
+        self.slow_log = deque()
+        self.configure(settings)
+
+    def configure(self, settings):
+        self.slow = settings.get("slow", 1.0)
+        self.slow_log = deque(self.slow_log, maxlen=settings.get("keep", 20))
+
+    def _entry(self, plugin, cmd):
+        key = (plugin.plugin_name, cmd.cmdname)
+        try:
+            return self.commands[key]
+        except KeyError:
+            entry = self.commands[key] = [0, 0, 0, Histogram(), Histogram()]
+            return entry
+
+    def denied(self, plugin, cmd, checking):
+        """Records a call that was denied after a permission check that took
+        checking seconds
+
+        """
+        entry = self._entry(plugin, cmd)
+        entry[0] += 1
+        entry[1] += 1
+        entry[3].add(checking)
+
+    def ran(self, result, plugin, cmd, user, started, checked):
+        """Callback for the deferred of a command's callback, which was
+        called at time checked after the permission check started at
+        started. Passes result on.
+
+        """
+        finished = default_timer()
+        entry = self._entry(plugin, cmd)
+        entry[0] += 1
+        if isinstance(result, Failure):
+            entry[2] += 1
+        entry[3].add(checked - started)
+        entry[4].add(finished - checked)
+
+        if finished - started >= self.slow:
+            log.msg("Command {0} from {1} took {2:.3f}s".format(
+                cmd.cmdname, user, finished - started))
+            self.slow_log.append(dict(
+                time=self._clock.seconds(),
+                plugin=plugin.plugin_name,
+                command=cmd.cmdname,
+                user=user,
+                check=checked - started,
+                callback=finished - checked,
+                ))
+        return result
+
+    def summary(self, top=None):
+        """Returns the list of dicts describing each command. Times are in
+        seconds.
+
+        """
+        rows = []
+        for (plugin_name, cmdname), (calls, denied, failed, check,
+                callback) in self.commands.items():
+            rows.append(dict(
+                plugin=plugin_name,
+                command=cmdname,
+                calls=calls,
+                denied=denied,
+                failed=failed,
+                total=check.total + callback.total,
+                check_p50=check.percentile(0.5),
+                check_max=check.max,
+                p50=callback.percentile(0.5),
+                p99=callback.percentile(0.99),
+                max=callback.max,
+                ))
+        rows.sort(key=lambda row: row['total'], reverse=True)
+        if top is not None:
+            rows = rows[:top]
+        return rows
+
+    def handles_event(self, eventtype):
+        return False
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def incoming_request(self, name, top=None):
+        return dict(commands=self.summary(top), slow=list(self.slow_log))
+
+# maps transports to their _CommandRouter
+_routers = weakref.WeakKeyDictionary()
+
+class _CommandRouter(object):
+    """Listens for irc.on_privmsg on behalf of every CommandPluginSuperclass
+    plugin on a transport, and dispatches commands and help requests to the
+    plugins they belong to.
+
+    The commands are indexed by the word a message must start with to invoke
+    them, see _first_words(). Each plugin still gets at most one command or
+    help request per message, chosen in the same order as if it checked all
+    its own commands: its commands in the order they were installed, then
+    help for its groups in reverse. A plugin whose commands the message could
+    invoke has all its command regexes, and separately all its prefix
+    regexes, tried at once through an _Alternation.
+
+    """
+    plugin_name = "command.CommandRouter"
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.plugins = []
+        self._index = None
+        # Incremented whenever the commands change, see commands_version()
+        self.version = 0
+        # A _RateLimiter if command invocations are rate limited
+        self.limiter = None
+        # A _CommandStats if commands are being counted and timed
+        self.stats = None
+
+    @classmethod
+    def for_transport(cls, transport):
+        try:
+            return _routers[transport]
+        except KeyError:
+            router = _routers[transport] = cls(transport)
+            transport.listen_for_event("irc.on_privmsg", router)
+            transport.unhook_observers.append(router.remove)
+            return router
+
+    def add(self, plugin):
+        if plugin not in self.plugins:
+            self.plugins.append(plugin)
+            self.invalidate()
+
+    def remove(self, plugin):
+        if plugin in self.plugins:
+            self.plugins.remove(plugin)
+            self.invalidate()
+
+    def invalidate(self):
+        self._index = None
+        self.version += 1
+
+    def configure(self, commandconfig):
+        """Applies the ratelimit and stats settings from config['command'],
+        turning rate limiting or stats off if they're not there
+
+        """
+        # Share the transport's clock, so the tests can drive both
+        clock = self.transport._clock
+
+        settings = commandconfig.get("ratelimit")
+        if settings is not None and self.limiter is None:
+            self.limiter = _RateLimiter(settings, clock)
+            self.transport.provides_request("command.ratelimit", self.limiter)
+        elif settings is not None:
+            self.limiter.configure(settings)
+        elif self.limiter is not None:
+            limiter, self.limiter = self.limiter, None
+            self.transport.unhook_plugin(limiter)
+
+        settings = commandconfig.get("stats")
+        if settings is not None and self.stats is None:
+            self.stats = _CommandStats(settings, clock)
+            self.transport.provides_request("command.stats", self.stats)
+        elif settings is not None:
+            self.stats.configure(settings)
+        elif self.stats is not None:
+            stats, self.stats = self.stats, None
+            self.transport.unhook_plugin(stats)
+
+    def _run(self, event, cmdname, func, *args):
+        """Calls func(*args) now, later or not at all, as the rate limit on
+        the user invoking cmdname allows
+
+        """
+        if self.limiter is None:
+            func(*args)
+            return
+        wait = self.limiter.take(event.user, cmdname)
+        if wait is None:
+            log.msg("Dropped {0} from {1}: over the rate limit".format(
+                cmdname, event.user))
+        elif wait:
+            self.limiter._clock.callLater(wait, func, *args)
+        else:
+            func(*args)
+
+    def _build_index(self):
+        """Returns (index, unindexed, prefixes, tables). index maps first
+        words to lists of (plugin rank, position, is group, plugin, command
+        or group) tuples, where position is the command's index in the
+        plugin's cmds, or for groups comes after all of them. unindexed is a
+        list of those for commands with no known first words, prefixes is
+        the set of command and group prefixes, and tables maps plugins to
+        _Alternations of their command regexes and their prefix regexes.
+
+        """
+        index = {}
+        unindexed = []
+        prefixes = set()
+        tables = {}
+        for rank, plugin in enumerate(self.plugins):
+            cmds = plugin.cmds
+            tables[plugin] = (
+                    _Alternation([cmd.commandre for cmd in cmds]),
+                    _Alternation([cmd.prefixre for cmd in cmds]),
+                    )
+            order = 0
+            for cmd in cmds:
+                entry = (rank, order, False, plugin, cmd)
+                order += 1
+                if cmd.prefix is not None:
+                    prefixes.add(cmd.prefix)
+                if cmd.firstwords is None:
+                    unindexed.append(entry)
+                else:
+                    for word in set(cmd.firstwords):
+                        index.setdefault(word, []).append(entry)
+            for cmdg in plugin.cmdgs:
+                if cmdg.helpre is None:
+                    continue
+                entry = (rank, order, True, plugin, cmdg)
+                order += 1
+                if cmdg.prefix:
+                    prefixes.add(cmdg.prefix)
+                index.setdefault(cmdg.grpname, []).append(entry)
+        return index, unindexed, prefixes, tables
+
+    def handles_event(self, eventtype):
+        return True
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def received_event(self, event):
+        if event.eventtype == "irc.on_privmsg":
+            self.route(event)
+
+    def route(self, event, only=None):
+        """Dispatches the irc.on_privmsg event to the commands it invokes,
+        or only to those of the plugin only if it's given
+
+        """
+        if not self.plugins:
+            return
+        if self._index is None:
+            self._index = self._build_index()
+        index, unindexed, prefixes, tables = self._index
+
+        pluginboss = self.plugins[0].pluginboss
+        # dig deep to find the current nickname; we use it in a couple checks
+        # below
+        nick = pluginboss.loaded_plugins['irc.IRCBotPlugin'].client.nickname
+        globalprefix = pluginboss.config.get("command", {}).get("prefix", None)
+
+        # First see if this looks like a command. A command takes the form of
+        # <botname>: <command>
+        # or
+        # <global prefix> <command>
+        message = event.message
+        raw = message.strip()
+
+        nickprefix = nick + ":"
+        globalprefix = globalprefix.strip() if globalprefix else None
+        if message.startswith(nickprefix):
+            message = message[len(nickprefix):].strip()
+        elif globalprefix and message.startswith(globalprefix):
+            message = message[len(globalprefix):].strip()
+        elif event.direct:
+            # Don't require a prefix if this was sent in a direct message to me
+            message = message
+        else:
+            # Don't match the command by itself... we require a prefix (but
+            # there could be a command-specific prefix that could still match)
+            message = None
+
+        # Gather the words the message could be invoking a command with
+        words = set()
+        def add_words(text):
+            m = _WORD.match(text)
+            if m:
+                words.add(m.group())
+            for prefix in prefixes:
+                if text.startswith(prefix):
+                    m = _WORD.match(text, len(prefix))
+                    if m:
+                        words.add(m.group())
+        for prefix in prefixes:
+            if raw.startswith(prefix):
+                m = _WORD.match(raw, len(prefix))
+                if m:
+                    words.add(m.group())
+        if message:
+            add_words(message)
+            if message.startswith("help "):
+                add_words(message[5:])
+        elif not words:
+            return
+
+        candidates = list(unindexed)
+        for word in words:
+            candidates.extend(index.get(word, ()))
+        if only is not None:
+            candidates = [entry for entry in candidates if entry[3] is only]
+        if not candidates:
+            return
+        candidates.sort(key=lambda entry: entry[:2])
+
+        # Go through the candidates a plugin at a time
+        start = 0
+        while start < len(candidates):
+            rank = candidates[start][0]
+            end = start
+            while end < len(candidates) and candidates[end][0] == rank:
+                end += 1
+            plugin_candidates = candidates[start:end]
+            start = end
+            plugin = plugin_candidates[0][3]
+            try:
+                # Charge the plugin for its own commands, so the stats and
+                # the circuit breaker see it and not the router
+                self.transport.call_handler(plugin,
+                        lambda event: self._dispatch(event, message, raw,
+                            plugin_candidates, tables[plugin]),
+                        event)
+            except Exception:
+                # We don't want one plugin's errors to prevent other
+                # plugins from being called
+                import traceback
+                log.msg(traceback.format_exc())
+
+    def _dispatch(self, event, message, raw, candidates, tables):
+        """Dispatches the message to the first of one plugin's commands it
+        matches, unless help for one of the candidate commands before it
+        matches, or failing that to help for one of its groups
+
+        """
+        plugin = candidates[0][3]
+        commands, prefixes = tables
+        pos, m = commands.first(message) if message else (None, None)
+        prefixpos, prefixm = prefixes.first(raw)
+        if prefixpos is not None and (pos is None or prefixpos < pos):
+            pos, m = prefixpos, prefixm
+
+        for rank, order, is_group, plugin, cmd in candidates:
+            if is_group or (pos is not None and order >= pos):
+                break
+            if message and cmd.helpre.match(message):
+                self._run(event, "help", plugin._do_help, event, cmd)
+                return
+        if pos is not None:
+            cmd = plugin.cmds[pos]
+            self._run(event, cmd.cmdname, plugin._do_command, event, cmd, m)
+            return
+
+        # No commands or help for a specific command matched, now check for a
+        # match on help for a command group. These checks are done in reverse
+        # order so that we always display the most specific help text we can.
+        for rank, order, is_group, plugin, cmdg in reversed(candidates):
+            if is_group and message and cmdg.helpre.match(message):
+                self._run(event, "help", plugin._do_help, event, cmdg)
+                return
+
+def commands_version(transport):
+    """Returns a number that changes whenever a command plugin on transport is
+    started or unloaded, or installs a command or command group. Plugins that
+    work something out from the installed commands can use it to tell when to
+    work it out again.
+
+    """
+    return _CommandRouter.for_transport(transport).version
+
 class CommandPluginSuperclass(BotPlugin):
     """This class is meant to be a superclass of plugins that wish to use the
     command abstractions. It is NOT to be installed as a plugin itself.
 
     It provides several things:
 
-    the install_command() function will install a command. This means the
-    plugin will listen to incoming irc.on_privmsg events, determine if it is a
-    command directed at this bot, verify permissions, and then call the
-    callback. See the documentation for the Command() class.
+    the install_command() function will install a command. This means
+    incoming irc.on_privmsg events will be checked for whether they are a
+    command directed at this bot, permissions verified, and then the
+    callback called. See the documentation for the Command() class. The
+    checking is done by a router shared by all command plugins, see
+    _CommandRouter.
 
-    This plugin overrides on_event_irc_on_privmsg(), reload() and start(), so
-    if you implement these functions in a subclass, be sure to call the
-    superclass's method!
+    This plugin overrides reload() and start(), so if you implement these
+    functions in a subclass, be sure to call the superclass's method! A
+    subclass that overrides on_event_irc_on_privmsg() is subscribed to
+    irc.on_privmsg so it sees every message, commands or not. One that only
+    cares about some channels should override privmsg_channels() too, so it
+    is not called for the others.
 
     Use of the permissions in installed commands requires the use of the
     auth.Auth plugin.
@@ -289,8 +924,16 @@ class CommandPluginSuperclass(BotPlugin):
     example, if the global prefix is "!", all commands must be prefixed with a
     "!". But individual commands may override this prefix.
 
+    Rate limits on commands are configured in config['command']['ratelimit'],
+    see _RateLimiter, and command stats in config['command']['stats'], see
+    _CommandStats.
+
     """
 
+    # Whether start() has subscribed to irc.on_privmsg as privmsg_channels()
+    # says, so reload() does it again
+    __listening = False
+
     def __init__(self, *args, **kwargs):
         super(CommandPluginSuperclass, self).__init__(*args, **kwargs)
 
@@ -307,19 +950,74 @@ class CommandPluginSuperclass(BotPlugin):
                 grpname="",
                 ).install_command
 
+    @property
+    def cmds(self):
+        return self.__cmds
+
     @property
     def cmdgs(self):
         return self.__cmdgs
 
     def start(self):
         super(CommandPluginSuperclass, self).start()
-        self.listen_for_event("irc.on_privmsg")
+        router = _CommandRouter.for_transport(self.transport)
+        router.add(self)
+        router.configure(self.pluginboss.config.get("command", {}))
+
+        self.__listening = True
+        self.update_privmsg_listener()
+
+    def privmsg_channels(self):
+        """Returns the channels this plugin wants to see every irc.on_privmsg
+        for, commands or not, or None for all of them. By default that is
+        all of them if the subclass overrides on_event_irc_on_privmsg(), and
+        none otherwise. Call update_privmsg_listener() when it changes.
+
+        """
+        handler = type(self).on_event_irc_on_privmsg
+        handler = getattr(handler, "__func__", handler)
+        if handler is not CommandPluginSuperclass.__dict__['on_event_irc_on_privmsg']:
+            return None
+        return []
+
+    def update_privmsg_listener(self):
+        """Subscribes to irc.on_privmsg for the channels privmsg_channels()
+        returns, and no others
+
+        """
+        self.stop_listening_for_event("irc.on_privmsg")
+        channels = self.privmsg_channels()
+        if channels is None:
+            self.listen_for_event("irc.on_privmsg")
+            return
+        for channel in channels:
+            if channel:
+                self.listen_for_event("irc.on_privmsg", channel=channel)
+
+    def received_missed_event(self, event):
+        super(CommandPluginSuperclass, self).received_missed_event(event)
+        # The router saw this message before this plugin was listening
+        if event.eventtype == "irc.on_privmsg":
+            _CommandRouter.for_transport(self.transport).route(event, only=self)
+
+    def _commands_changed(self):
+        router = _routers.get(self.transport)
+        if router is not None:
+            router.invalidate()
 
     def reload(self):
         super(CommandPluginSuperclass, self).reload()
         commandconfig = self.pluginboss.config.get("command", {})
         self.__globalprefix = commandconfig.get("prefix", None)
 
+        router = _routers.get(self.transport)
+        if router is not None:
+            router.configure(commandconfig)
+
+        # The channels may be set in the config
+        if self.__listening:
+            self.update_privmsg_listener()
+
     def install_cmdgroup(self,
             grpname,
             prefix=None,
@@ -363,63 +1061,18 @@ class CommandPluginSuperclass(BotPlugin):
                 permission=permission,
                 helptext=helptext,
                 globalprefix=self.__globalprefix,
+                changed=self._commands_changed,
                 )
 
     def on_event_irc_on_privmsg(self, event):
-        """Checks to see if this is a command. If so, dispatch to the command
-        handler as appropriate.
+        """Commands are recognized by the router, so this does nothing.
+        Subclasses can override it to see every message.
 
         """
-        # dig deep to find the current nickname; we use it in a couple checks
-        # below
-        nick = self.pluginboss.loaded_plugins['irc.IRCBotPlugin'].client.nickname
-
-        # First see if this looks like a command. A command takes the form of
-        # <botname>: <command>
-        # or
-        # <global prefix> <command>
-        message = event.message
-
-        nickprefix = nick + ":"
-        globalprefix = self.__globalprefix.strip() if self.__globalprefix else None
-        if message.startswith(nickprefix):
-            message = message[len(nickprefix):].strip()
-        elif globalprefix and message.startswith(globalprefix):
-            message = message[len(globalprefix):].strip()
-        elif event.direct:
-            # Don't require a prefix if this was sent in a direct message to me
-            message = message
-        else:
-            # Don't match the command by itself... we require a prefix (but
-            # don't return just yet, there could be a command-specific prefix
-            # that could still match)
-            message = None
-
-        # Look through all our defined commands to see if any match
-        for cmd in self.__cmds:
-            m = cmd.commandre.match(message) if message else None
-            if m:
-                self.__do_command(event, cmd, m)
-                return
-            if cmd.prefixre:
-                m = cmd.prefixre.match(event.message.strip())
-                if m:
-                    self.__do_command(event, cmd, m)
-                    return
-            if message and cmd.helpre.match(message):
-                self.__do_help(event, cmd)
-                return
-
-        # No commands or help for a specific command matched, now check for a
-        # match on help for a command group. These checks are done in reverse
-        # order so that we always display the most specific help text we can.
-        for cmdg in reversed(self.__cmdgs):
-            if cmdg.helpre and message and cmdg.helpre.match(message):
-                self.__do_help(event, cmdg)
-                return
+        pass
 
     @defer.inlineCallbacks
-    def __do_command(self, event, cmd, match):
+    def _do_command(self, event, cmd, match):
         """A user has issued command `cmd` and it matched with regular
         expression Match object `match`.
 
@@ -427,11 +1080,24 @@ class CommandPluginSuperclass(BotPlugin):
 
         """
 
+        router = _routers.get(self.transport)
+        stats = router.stats if router is not None else None
+        started = default_timer()
+
         if (yield event.has_permission(cmd.permission, event.channel)):
             log.msg("User %s is auth'd to perform %s" % (event.user, cmd.cmdname))
-            cmd.callback(event, match)
+            if stats is None:
+                cmd.callback(event, match)
+            else:
+                checked = default_timer()
+                # A failure is passed on by ran(), so it still gets logged as
+                # an unhandled error
+                d = defer.maybeDeferred(cmd.callback, event, match)
+                d.addBoth(stats.ran, self, cmd, event.user, started, checked)
         else:
             log.msg("User %s does not have permission for %s" % (event.user, cmd.cmdname))
+            if stats is not None:
+                stats.denied(self, cmd, default_timer() - started)
 
             # Before we reply with a scathing retort to the user that tried to
             # invoke a command they shouldn't, check to see if the user's
@@ -490,7 +1156,7 @@ class CommandPluginSuperclass(BotPlugin):
                 reactor.callLater(random.uniform(0.5,2), event.reply, random.choice(replies), userprefix=False, notice=False)
 
     @defer.inlineCallbacks
-    def __do_help(self, event, cmd):
+    def _do_help(self, event, cmd):
         """Send to the user help info about this command"""
         nick = self.pluginboss.loaded_plugins['irc.IRCBotPlugin'].client.nickname
         if hasattr(cmd, "subcmds"):
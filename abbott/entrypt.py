@@ -4,7 +4,10 @@ from . import transport
 from twisted.internet import reactor
 from twisted.python import log
 
+import os
+import shutil
 import sys
+import tempfile
 
 def main():
     if len(sys.argv) < 2:
@@ -12,6 +15,7 @@ def main():
         sys.exit(1)
     transportobj = transport.Transport()
     boss = pluginbase.PluginBoss(sys.argv[1], transportobj)
+    transportobj.configure(boss.config)
 
     observer = log.FileLogObserver(sys.stdout)
     observer.timeFormat = "%Y-%m-%d %H:%M:%S"
@@ -23,5 +27,49 @@ def main():
 
     reactor.run()
 
+def replay():
+    """Feeds a recording made by the recorder.Recorder plugin through the
+    plugins of the given config, with no network connection, and reports the
+    throughput. The config dir is copied first, so it is left untouched.
+
+    The optional speed is a multiple of the recorded rate. 0, the default,
+    replays as fast as possible.
+
+    """
+    if len(sys.argv) < 3:
+        print("Usage: %s <config dir> <recording> [speed]" % sys.argv[0])
+        sys.exit(1)
+    from .plugins import irc, recorder
+
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        configdir = os.path.join(tempdir, "config")
+        shutil.copytree(sys.argv[1], configdir)
+
+        transportobj = transport.Transport()
+        boss = pluginbase.PluginBoss(configdir, transportobj)
+        transportobj.configure(boss.config)
+
+        observer = log.FileLogObserver(sys.stdout)
+        observer.timeFormat = "%Y-%m-%d %H:%M:%S"
+        log.startLoggingWithObserver(observer.emit)
+        log.msg("Abbott replaying %s" % sys.argv[2])
+
+        # Don't record the replay
+        if "recorder.Recorder" in boss.config['core']['plugins']:
+            boss.config['core']['plugins'].remove("recorder.Recorder")
+        boss.plugin_overrides['irc.IRCBotPlugin'] = irc.ReplayIRCBotPlugin
+        d = boss.load_all_plugins()
+        d.addCallback(lambda _: recorder.replay(boss, transportobj,
+            sys.argv[2], speed))
+        d.addErrback(log.err)
+        d.addBoth(lambda _: reactor.stop())
+
+        reactor.run()
+    finally:
+        shutil.rmtree(tempdir)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,196 @@
+import os
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+
+"""
+Writing files without blocking the reactor.
+
+The IOExecutor takes the whole new contents of a file, already serialized,
+and writes them to a temporary file, fsyncs it and renames it over the file,
+in a thread. Writes to the same file are done in the order they were asked
+for. A write asked for while the file is still being written waits for that
+write to finish, and if another is asked for in the meantime, only the newest
+contents are written.
+
+Things that must only be used from one thread, such as an SQLite connection,
+get a Worker from the IOExecutor: a thread of their own that runs the calls
+asked of it one at a time, in order.
+
+Until the reactor runs, there are no threads to wait for, and a write left
+for one would be lost if the bot exits before starting, so everything is done
+right away instead.
+
+"""
+
+def write_file(filename, text):
+    """Atomically replaces the contents of filename with text, and waits for
+    them to reach the disk. Blocks.
+
+    """
+    with open(filename + "~", "w") as out:
+        out.write(text)
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(filename + "~", filename)
+
+def _in_thread_or_now(func, *args):
+    """deferToThread, once the reactor is running"""
+    if not reactor.running:
+        return defer.maybeDeferred(func, *args)
+    return threads.deferToThread(func, *args)
+
+class Worker(object):
+    """Runs calls one at a time, in the order they were asked for, in a thread
+    of its own. call_from_thread is called like reactor.callFromThread to
+    fire the deferreds on the reactor thread.
+
+    """
+    def __init__(self, name, call_from_thread=None):
+        self._call_from_thread = call_from_thread or reactor.callFromThread
+        self._calls = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            func, args, done = self._calls.get()
+            try:
+                result = func(*args)
+            except Exception:
+                done(False, sys.exc_info())
+            else:
+                done(True, result)
+
+    def run(self, func, *args):
+        """Calls func(*args) in the thread, after the calls asked for before.
+        Blocks until it is done, and returns its result or raises its
+        exception.
+
+        """
+        finished = threading.Event()
+        outcome = []
+        def done(ok, result):
+            outcome[:] = [ok, result]
+            finished.set()
+        self._calls.put((func, args, done))
+        finished.wait()
+        ok, result = outcome
+        if not ok:
+            Failure(result[1], result[0], result[2]).raiseException()
+        return result
+
+    def call(self, func, *args):
+        """Calls func(*args) in the thread, after the calls asked for before.
+        Returns a deferred that fires with its result. Until the reactor runs,
+        blocks until it is done instead.
+
+        """
+        if not reactor.running:
+            return defer.maybeDeferred(self.run, func, *args)
+        d = defer.Deferred()
+        def done(ok, result):
+            if ok:
+                self._call_from_thread(d.callback, result)
+            else:
+                failure = Failure(result[1], result[0], result[2])
+                self._call_from_thread(d.errback, failure)
+        self._calls.put((func, args, done))
+        return d
+
+class IOExecutor(object):
+    """Writes files in a thread, in order per file. in_thread is called like
+    deferToThread to run the writes; the tests pass something that runs them
+    right away.
+
+    """
+    def __init__(self, in_thread=_in_thread_or_now):
+        self._in_thread = in_thread
+        # maps names to the Workers made for them
+        self._workers = {}
+        # maps file names to [text, deferreds to fire] of the write in
+        # progress for the file
+        self._writing = {}
+        # maps file names to [text, deferreds to fire] of the write that is
+        # waiting for the one in progress
+        self._queued = {}
+
+    def write(self, filename, text):
+        """Replaces the contents of filename with text. Returns a deferred
+        that fires once text, or something written after it, is on the disk.
+
+        """
+        d = defer.Deferred()
+        if filename in self._writing:
+            queued = self._queued.setdefault(filename, [None, []])
+            queued[0] = text
+            queued[1].append(d)
+        else:
+            self._start(filename, text, [d])
+        return d
+
+    def _start(self, filename, text, waiters):
+        self._writing[filename] = [text, waiters]
+        d = self._in_thread(write_file, filename, text)
+        d.addBoth(self._finished, filename)
+
+    def _finished(self, result, filename):
+        text, waiters = self._writing.pop(filename)
+        queued = self._queued.pop(filename, None)
+        if queued is not None:
+            self._start(filename, *queued)
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(None)
+
+    def read(self, filename):
+        """Returns the contents filename will have once the writes asked for
+        so far are done. Only reads the file if there are none.
+
+        """
+        for pending in (self._queued, self._writing):
+            if filename in pending:
+                return pending[filename][0]
+        with open(filename, "r") as inp:
+            return inp.read()
+
+    def worker(self, name):
+        """Returns the Worker for name, e.g. the file name of an SQLite
+        database, starting it the first time. wait() waits for it too.
+
+        """
+        if name not in self._workers:
+            self._workers[name] = Worker("io " + os.path.basename(name))
+        return self._workers[name]
+
+    def wait(self, filename=None):
+        """Returns a deferred that fires when the writes asked for so far to
+        filename, or to every file if it is None, are done, along with the
+        calls asked of the worker for it
+
+        """
+        if filename is None:
+            filenames = list(self._writing)
+            workers = list(self._workers.values())
+        else:
+            filenames = [filename] if filename in self._writing else []
+            workers = [self._workers[filename]] if filename in self._workers else []
+        ds = []
+        for name in filenames:
+            d = defer.Deferred()
+            pending = self._queued.get(name) or self._writing[name]
+            pending[1].append(d)
+            ds.append(d)
+        for worker in workers:
+            ds.append(worker.call(lambda: None))
+        return defer.DeferredList(ds, consumeErrors=True)
@@ -0,0 +1,268 @@
+import json
+import os
+import threading
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+
+from .pluginbase import PluginConfig
+from .trackedconfig import REPLACED, TrackedPluginConfig
+
+"""
+A journal for plugin configs, as a lighter alternative to abbott.sqliteconfig
+for plugins whose configs change often.
+
+The config is kept in the usual <plugin name>.json file, the snapshot, plus
+<plugin name>.journal. Writing the config appends one small json list per
+change to the journal instead of rewriting the snapshot:
+
+    ["set", path, value]
+    ["del", path]
+    ["splice", path, index, items]
+
+path is a list of the top-level key and, for a change to one item of a dict,
+the item's key, as strings the way json stores dict keys. A splice replaces
+everything from index onward in a list, so appending to a list only records
+the new items. The journal is fsynced after each write, like the snapshot.
+Every record gives the same result if it is applied twice, which keeps
+compaction crash safe.
+
+After compact_after records, the journal is compacted: it is renamed to
+<plugin name>.journal.1 and a new one started, and the snapshot is rewritten
+in a thread. The old journal is removed once the new snapshot is in place.
+Loading the config reads the snapshot and applies .journal.1, if it is still
+there, and then .journal, skipping any record that was cut short by a crash
+or does not apply. It waits for a compaction that is replacing the snapshot.
+
+When the config is given the bot's IOExecutor, the journal is appended to
+and compacted only by a Worker thread of its own, so writing never blocks the
+reactor.
+
+Plugins select this in the "core" section of config.json:
+
+    "config_storage": {
+        "admin.Admin": {"engine": "journal", "compact_after": 1000}
+    }
+
+"""
+
+# maps journal file names to the deferreds of the compactions in progress for
+# them. Kept here rather than on the config, because a plugin's config object
+# is replaced when it is reloaded
+_compacting = {}
+
+# maps journal file names to a lock held while the snapshot is replaced and
+# the old journal removed, and while the config is read, so reading a config
+# that is being compacted waits for the compaction
+_snapshot_locks = {}
+
+def _json_key(key):
+    """Returns key the way it comes back from the snapshot, where json has
+    made it a string, e.g. "5" for 5
+
+    """
+    if isinstance(key, (str, type(u""))):
+        return key
+    return next(iter(json.loads(json.dumps({key: None}))))
+
+def _records(key, slots, data):
+    """Yields the records that write the changes to the top-level key, whose
+    value is REPLACED or has the items in slots changed. Keys in paths are
+    recorded as json strings, so replaying the journal gives the same config
+    as reading the snapshot.
+
+    """
+    path = [_json_key(key)]
+    if key not in data:
+        yield ["del", path]
+        return
+    value = data[key]
+    if slots is REPLACED:
+        yield ["set", path, value]
+    elif isinstance(value, dict):
+        for subkey in slots:
+            if subkey in value:
+                yield ["set", path + [_json_key(subkey)], value[subkey]]
+            else:
+                yield ["del", path + [_json_key(subkey)]]
+    else:
+        start = min(min(slots), len(value))
+        yield ["splice", path, start, value[start:]]
+
+def apply_record(data, record):
+    """Applies one journal record to the config dict data"""
+    op, path = record[0], record[1]
+    target = data
+    for key in path[:-1]:
+        target = target[key]
+    if op == "set":
+        target[path[-1]] = record[2]
+    elif op == "del":
+        target.pop(path[-1], None)
+    elif op == "splice":
+        target[path[-1]][record[2]:] = record[3]
+    else:
+        raise ValueError("Unknown journal record {0!r}".format(op))
+
+class JournalPluginConfig(TrackedPluginConfig):
+    """A PluginConfig that writes its changes to a journal. Saving works the
+    same as for PluginConfig, write-behind included. What to write is found
+    out as for abbott.trackedconfig.TrackedPluginConfig.
+
+    """
+    # Overridden by the tests to compact without a thread pool
+    _in_thread = staticmethod(threads.deferToThread)
+
+    def __init__(self, jsonfile, compact_after=1000, interval=0, changes=1,
+            clock=reactor, io=None):
+        self._journalfile = os.path.splitext(jsonfile)[0] + ".journal"
+        self.compact_after = compact_after
+        # how many records the journal has
+        self.records = 0
+        self._journal = None
+        # whether the journal ends in a record cut short by a crash
+        self._torn = False
+        # Without an IOExecutor, the files are used right away from the
+        # calling thread. With one, only from a Worker thread, which also
+        # compacts the journal, after the appends asked for before.
+        self._worker = None if io is None else io.worker(jsonfile)
+
+        TrackedPluginConfig.__init__(self, jsonfile, interval=interval,
+                changes=changes, clock=clock, io=io)
+        self._run(self._open_journal)
+
+    def _run(self, func, *args):
+        """Calls func(*args) in the worker thread, and waits for it"""
+        if self._worker is None:
+            return func(*args)
+        return self._worker.run(func, *args)
+
+    def _call(self, func, *args):
+        """Calls func(*args) in the worker thread. Returns a deferred that
+        fires once it is done.
+
+        """
+        if self._worker is None:
+            return defer.maybeDeferred(func, *args)
+        return self._worker.call(func, *args)
+
+    def _open_journal(self):
+        # A .journal.1 with no compaction in progress was left by a crash, and
+        # everything in it has just been read
+        if (os.path.exists(self._journalfile + ".1") and
+                self._journalfile not in _compacting):
+            self._write_snapshot(json.dumps(self.data, indent=4))
+
+        self._journal = open(self._journalfile, "a")
+        if self._torn:
+            # so the next record does not go on the end of the torn one
+            self._journal.write("\n")
+
+    def _read(self):
+        return self._run(self._read_files)
+
+    def _read_files(self):
+        lock = _snapshot_locks.setdefault(self._journalfile, threading.Lock())
+        with lock:
+            data = PluginConfig._read(self)
+            self.records = 0
+            for filename in (self._journalfile + ".1", self._journalfile):
+                if not os.path.exists(filename):
+                    continue
+                self._torn = False
+                with open(filename, "r") as inp:
+                    for line in inp:
+                        self.records += 1
+                        self._torn = not line.endswith("\n")
+                        try:
+                            apply_record(data, json.loads(line))
+                        except Exception:
+                            # A record cut short by a crash, or one that does
+                            # not apply. The records after it still do.
+                            log.msg("Skipped bad record in {0}: {1!r}".format(
+                                filename, line))
+        return data
+
+    def _write_changes(self, touched):
+        lines = []
+        for key, slots in touched.items():
+            for record in _records(key, slots, self.data):
+                lines.append(json.dumps(record, separators=(",", ":")))
+
+        written = None
+        if lines:
+            written = self._call(self._append, lines)
+            self.records += len(lines)
+
+        if self.records >= self.compact_after:
+            self.compact()
+        return written
+
+    def _append(self, lines):
+        self._journal.write("\n".join(lines) + "\n")
+        self._journal.flush()
+        # A change is only written once it is on the disk
+        os.fsync(self._journal.fileno())
+
+    def compact(self):
+        """Starts compacting the journal into the snapshot. Returns a deferred
+        that fires when it is done, or None if a compaction is already in
+        progress.
+
+        """
+        # A .journal.1 left by a failed compaction must not be overwritten.
+        # It is dealt with when the config is next loaded.
+        if (self._journalfile in _compacting or
+                os.path.exists(self._journalfile + ".1")):
+            return None
+
+        text = json.dumps(self.data, indent=4)
+        self.records = 0
+
+        def done(result):
+            del _compacting[self._journalfile]
+            return result
+        if self._worker is None:
+            self._rotate()
+            d = self._in_thread(self._write_snapshot, text)
+        else:
+            d = self._worker.call(self._rotate_and_write, text)
+        _compacting[self._journalfile] = d
+        d.addBoth(done)
+        d.addErrback(log.err, "Compacting {0} failed".format(self._jsonfile))
+        return d
+
+    def _rotate(self):
+        """Starts a new journal, keeping the old one as .journal.1"""
+        self._journal.close()
+        os.rename(self._journalfile, self._journalfile + ".1")
+        self._journal = open(self._journalfile, "a")
+
+    def _rotate_and_write(self, text):
+        self._rotate()
+        self._write_snapshot(text)
+
+    def _write_snapshot(self, text):
+        """Replaces the snapshot with text and removes the old journal. Runs
+        in a thread.
+
+        """
+        lock = _snapshot_locks.setdefault(self._journalfile, threading.Lock())
+        with lock:
+            with open(self._jsonfile + "~", "w") as out:
+                out.write(text)
+                out.flush()
+                os.fsync(out.fileno())
+            os.rename(self._jsonfile + "~", self._jsonfile)
+            os.remove(self._journalfile + ".1")
+
+    def close(self):
+        """Writes any unwritten changes and closes the journal. Returns a
+        deferred that fires once it is closed.
+
+        """
+        TrackedPluginConfig.close(self)
+        return self._call(self._close_journal)
+
+    def _close_journal(self):
+        self._journal.close()
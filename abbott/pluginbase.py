@@ -12,28 +12,180 @@ except:
     # This moved in python 3
     from collections import UserDict
 from functools import wraps
+from timeit import default_timer
 
 from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.python import log
+from twisted.python.failure import Failure
+
+from .ioexecutor import IOExecutor
+from .transport import compile_glob
 
 class PluginConfig(UserDict):
     """Installed in plugins as self.config. Provides a dictionary-like
     interface with a method .save() to save to persistent storage. Uses a json
     file as a backing store.
 
+    Saving is write-behind: save() only marks the config as changed, and the
+    file is written interval seconds after the first unwritten change, or
+    as soon as save() has been called changes times since the last write,
+    whichever comes first.
+    flush() writes it right away. An interval of 0 writes on every save().
+    Both return a deferred that fires once the changes are on the disk.
+    If writing them fails, the error is raised from flush(), or logged if
+    the file is written later, and the changes stay unwritten until the
+    next write.
+
+    If io is an IOExecutor, the file is written by it in a thread instead of
+    right away.
+
+    Callables in the before_flush list are called with no arguments just
+    before the file is written, for plugins that keep derived data in their
+    config.
+
     """
-    def __init__(self, jsonfile):
+    def __init__(self, jsonfile, interval=0, changes=1, clock=reactor,
+            io=None):
         """Initialize a config from a json file."""
         self._jsonfile = jsonfile
-        with open(jsonfile, 'r') as inp:
-            self.data = json.load(inp)
+        self._io = io
+        self.data = self._read()
+
+        self.interval = interval
+        self.changes = changes
+        self.before_flush = []
+        self._clock = clock
+        # how many times save() was called since the file was last written
+        self.dirty = 0
+        self._flush_call = None
+        # deferreds returned by save() since the file was last written
+        self._waiters = []
 
     def save(self):
+        """Marks the config as changed, to be written to the file soon.
+        Returns a deferred that fires once it has been.
+
+        """
+        d = defer.Deferred()
+        self._waiters.append(d)
+        self.dirty += 1
+        if not self.interval or self.dirty >= self.changes:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self._clock.callLater(self.interval, self.flush)
+        return d
+
+    def flush(self):
+        """Writes the config to the file now if it has unwritten changes.
+        Returns a deferred that fires once they are on the disk.
+
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not self.dirty:
+            if self._io is None:
+                return defer.succeed(None)
+            return self._io.wait(self._jsonfile)
+        dirty, self.dirty = self.dirty, 0
+
+        waiters, self._waiters = self._waiters, []
+        d = defer.Deferred()
+        waiters.append(d)
+        def done(_):
+            for waiter in waiters:
+                waiter.callback(None)
+        def failed(failure):
+            log.err(failure, "Could not write %s" % self._jsonfile)
+            self._not_written(dirty, waiters)
+
+        for hook in self.before_flush:
+            hook()
+        try:
+            written = self._write()
+        except Exception:
+            self._not_written(dirty, waiters[:-1])
+            raise
+        if written is None:
+            done(None)
+        else:
+            written.addCallbacks(done, failed)
+        return d
+
+    def _not_written(self, dirty, waiters):
+        """Marks the changes a write failed to store as unwritten again, so
+        the next write stores them and fires their waiters
+
+        """
+        self.dirty += dirty
+        self._waiters[:0] = waiters
+
+    def _read(self):
+        """Returns the stored config dict"""
+        if self._io is not None:
+            return json.loads(self._io.read(self._jsonfile))
+        with open(self._jsonfile, 'r') as inp:
+            return json.load(inp)
+
+    def _write(self):
+        """Stores self.data. Returns a deferred if it is stored later."""
+        if self._io is not None:
+            return self._io.write(self._jsonfile,
+                    json.dumps(self.data, indent=4))
         with open(self._jsonfile+"~", 'w') as out:
             json.dump(self.data, out, indent=4)
         os.rename(self._jsonfile+"~", self._jsonfile)
 
+    def close(self):
+        """Writes any unwritten changes. Called when the config is replaced
+        or its plugin is unloaded. Returns a deferred that fires once they
+        are written and the config is closed.
+
+        """
+        return self.flush()
+
+
+class DependencyCycle(Exception):
+    """Raised by PluginBoss.load_all_plugins() when the configured plugins
+    require each other in a cycle
+
+    """
+
+class _NotStarted(Exception):
+    """Passed along to the plugins that require a plugin that did not start,
+    so they are skipped without logging the reason again
+
+    """
+
+def _startup_order(plugin_names, requires):
+    """Returns plugin_names ordered so each plugin comes after those in its
+    requires list, and otherwise in the given order. requires maps each plugin
+    name to its REQUIRES. Raises DependencyCycle if there is no such order.
+
+    """
+    order = []
+    remaining = list(plugin_names)
+    while remaining:
+        for plugin_name in remaining:
+            if not any(dep in remaining for dep in requires[plugin_name]):
+                break
+        else:
+            # Every remaining plugin waits on another remaining one, so
+            # following the requirements from any of them must loop
+            path = [remaining[0]]
+            while True:
+                dep = next(dep for dep in requires[path[-1]] if dep in remaining)
+                if dep in path:
+                    cycle = path[path.index(dep):] + [dep]
+                    break
+                path.append(dep)
+            raise DependencyCycle("Plugins require each other in a cycle: "
+                    + " -> ".join(cycle))
+        remaining.remove(plugin_name)
+        order.append(plugin_name)
+    return order
 
 class PluginBoss(object):
     """Handles the loading and unloading of plugins and the reading 
@@ -50,6 +202,19 @@ class PluginBoss(object):
 
         self.loaded_plugins = {}
 
+        # maps plugin names to classes to load in place of the ones named,
+        # e.g. to run the bot with a stand-in IRC connection
+        self.plugin_overrides = {}
+
+        # maps plugin names to the PluginConfig object last handed out for
+        # them, so unwritten changes can be flushed
+        self._plugin_configs = {}
+        reactor.addSystemEventTrigger("before", "shutdown", self.flush_configs)
+
+        # Writes config files in a thread, so a slow disk never blocks the
+        # reactor
+        self.io = IOExecutor()
+
         if not os.path.exists(self._configdir):
             os.mkdir(self._configdir)
         elif not os.path.isdir(self._configdir):
@@ -144,62 +309,238 @@ I'll create a new one for you now""")
         self.save()
 
     def _load(self):
-        with open(self._filename, 'r') as file_handle:
-            self.config = json.load(file_handle)
+        self.config = json.loads(self.io.read(self._filename))
+
+    def config_path(self, filename):
+        """Returns the path of filename, e.g. one named in a plugin's config,
+        taken relative to the config directory
+
+        """
+        return os.path.join(self._configdir, filename)
 
     def save(self):
         """Saves the master config. Use plugin.config.save() to save plugin
         configs
-        
+
+        The file is written in a thread, or right away if the reactor is not
+        running yet, as at first-run setup. Returns a deferred that fires once
+        it is on the disk.
+
         """
-        with open(self._filename, 'w') as output_file_handle:
-            json.dump(self.config, output_file_handle, indent=4)
+        return self.io.write(self._filename, json.dumps(self.config, indent=4))
 
     def load_all_plugins(self):
-        """Called by the main method at startup time to load all configured plugins"""
-        for plugin_name in self.config['core']['plugins']:
-            self.load_plugin(plugin_name)
+        """Called by the main method at startup time to load all configured
+        plugins.
+
+        Each plugin is started once every plugin in its REQUIRES that is also
+        configured has finished starting, and otherwise in the configured
+        order. Plugins whose start() returns a deferred are not waited for by
+        the plugins that don't require them. A plugin that fails to start is
+        logged, and the plugins that require it are not started.
+
+        Raises DependencyCycle, before starting anything, if the plugins
+        require each other in a cycle. Otherwise returns a deferred that fires
+        with a dict mapping the names of the plugins that started to how many
+        seconds they took, once every plugin has started or failed to.
+
+        """
+        plugin_names = list(self.config['core']['plugins'])
+        lazy = self.config['core'].get("lazy_plugins", {})
+        requires = {}
+        import_failed = set()
+        for plugin_name in plugin_names:
+            if plugin_name in lazy:
+                # Not imported until it is needed
+                requires[plugin_name] = []
+                continue
+            try:
+                requires[plugin_name] = self._plugin_class(plugin_name).REQUIRES
+            except Exception:
+                log.err(None, "Could not import plugin %s" % plugin_name)
+                requires[plugin_name] = []
+                import_failed.add(plugin_name)
+
+        for plugin_name in plugin_names:
+            for dep in requires[plugin_name]:
+                if dep not in requires and dep not in self.loaded_plugins:
+                    log.msg("Warning: {0} depends on {1}, but {1} is not set to load on startup".format(
+                        plugin_name, dep))
+
+        order = _startup_order(plugin_names, requires)
+
+        startup_began = default_timer()
+        start_times = {}
+
+        def start(_, plugin_name):
+            began = default_timer()
+            d = defer.maybeDeferred(self.load_plugin, plugin_name)
+            def started(_):
+                elapsed = start_times[plugin_name] = default_timer() - began
+                log.msg("Started %s in %.0fms" % (plugin_name, elapsed * 1000))
+            def failed(failure):
+                log.err(failure, "Plugin %s failed to start" % plugin_name)
+                raise _NotStarted(plugin_name)
+            d.addCallbacks(started, failed)
+            return d
+
+        def skip(failure, plugin_name):
+            dep = failure.value.subFailure.value.args[0]
+            log.msg("Not starting %s because %s did not start" % (
+                plugin_name, dep))
+            raise _NotStarted(plugin_name)
+
+        starting = {}
+        for plugin_name in order:
+            if plugin_name in import_failed:
+                starting[plugin_name] = defer.fail(_NotStarted(plugin_name))
+                continue
+            deps = [starting[dep] for dep in requires[plugin_name]
+                    if dep in starting]
+            if deps:
+                d = defer.gatherResults(deps)
+            else:
+                d = defer.succeed(None)
+            d.addCallbacks(start, skip, callbackArgs=(plugin_name,),
+                    errbackArgs=(plugin_name,))
+            starting[plugin_name] = d
+
+        def done(_):
+            log.msg("Started %d of %d plugins in %.2f seconds" % (
+                len(start_times), len(plugin_names),
+                default_timer() - startup_began))
+            return start_times
+        d = defer.DeferredList([starting[plugin_name] for plugin_name in
+            order], consumeErrors=True)
+        d.addCallback(done)
+        return d
+
+    def _plugin_class(self, plugin_name):
+        """Returns the class to load for the named plugin"""
+        try:
+            return self.plugin_overrides[plugin_name]
+        except KeyError:
+            modulename, classname = plugin_name.split(".")
+            module = __import__("abbott.plugins."+modulename, fromlist=[classname])
 
-    def load_plugin(self, plugin_name):
+            return getattr(module, classname)
+
+    def load_plugin(self, plugin_name, lazy=True):
         """Loads the named plugin.
         
         plugin_name is expected to be in the form A.B where A is the module and
         B is the class. This module is expected to live in the plugins package.
+
+        Returns what the plugin's start() returns. If that is a deferred that
+        fails, the plugin is unloaded again.
+
+        Plugins with a manifest in the "lazy_plugins" dict of the core config
+        section are loaded as a LazyPlugin stand-in, unless lazy is False.
         
         """
-        modulename, classname = plugin_name.split(".")
-        module = __import__("abbott.plugins."+modulename, fromlist=[classname])
-        
-        pluginclass = getattr(module, classname)
+        manifest = self.config['core'].get("lazy_plugins", {}).get(plugin_name)
+        if lazy and manifest is not None:
+            plugin = LazyPlugin(plugin_name, self._transport, self, manifest)
+            plugin.start()
+            self.loaded_plugins[plugin_name] = plugin
+            return None
+
+        pluginclass = self._plugin_class(plugin_name)
         
         plugin = pluginclass(plugin_name, self._transport, self)
         try:
-            plugin.start()
+            started = plugin.start()
         except Exception:
             self._transport.unhook_plugin(plugin)
             raise
 
         self.loaded_plugins[plugin_name] = plugin
 
+        if isinstance(started, defer.Deferred):
+            def failed(failure):
+                if self.loaded_plugins.get(plugin_name) is plugin:
+                    del self.loaded_plugins[plugin_name]
+                self._transport.unhook_plugin(plugin)
+                return failure
+            started.addErrback(failed)
+        return started
+
+    def activate_plugin(self, plugin_name):
+        """Replaces the LazyPlugin stand-in for the named plugin with the
+        plugin itself. Returns a deferred that fires once it has started.
+
+        """
+        stub = self.loaded_plugins.get(plugin_name)
+        if not isinstance(stub, LazyPlugin):
+            return defer.succeed(None)
+        self.unload_plugin(plugin_name)
+        log.msg("Activating lazy plugin %s" % plugin_name)
+        def failed(failure):
+            log.err(failure, "Lazy plugin %s failed to start" % plugin_name)
+            return failure
+        d = defer.maybeDeferred(self.load_plugin, plugin_name, lazy=False)
+        d.addErrback(failed)
+        return d
+
     def unload_plugin(self, plugin_name):
         plugin = self.loaded_plugins.pop(plugin_name)
         self._transport.unhook_plugin(plugin)
         plugin.stop()
+        config = self._plugin_configs.pop(plugin_name, None)
+        if config is not None:
+            config.close()
 
-    def get_plugin_config(self, plugin_name):
+    def flush_configs(self):
+        """Writes every plugin config with unwritten changes. Called at
+        reactor shutdown. Returns a deferred that fires once every config
+        file being written is on the disk.
+
+        """
+        for config in self._plugin_configs.values():
+            config.flush()
+        return self.io.wait()
+
+    def get_plugin_config(self, plugin_name, reread=False):
         """Returns a config dictionary for the named plugin. This dict has an
         additional method: .save(), to save any changes back to persistant
         store
 
+        If the plugin's config is already open, the same object is returned,
+        so other plugins can change it without closing the database or
+        journal the plugin is using. Only with reread, which the plugin's own
+        reload() passes, is it closed and read again, and any unwritten
+        changes to it are written first, so they are not lost. How often
+        configs are written is set by the "config_flush" dict in the core
+        section of the master config, with the keys "interval" and "changes".
+        See PluginConfig.
+
+        Plugins listed with the sqlite or the journal engine in the
+        "config_storage" dict of the core section get an SQLite backed or a
+        journaled config instead. See abbott.sqliteconfig and
+        abbott.journalconfig.
+
         """
+        previous = self._plugin_configs.get(plugin_name)
+        if previous is not None:
+            if not reread:
+                return previous
+            del self._plugin_configs[plugin_name]
+            previous.close()
+
         try:
             old_config = self.config['plugin_config'][plugin_name]
         except KeyError:
             old_config = {}
         
+        core = self.config.get("core", {})
+        storage = core.get("config_storage", {}).get(plugin_name, {})
+        use_sqlite = storage.get("engine") == "sqlite"
+
         plugin_config_path = os.path.join(self._configdir, plugin_name)+".json"
+        sqlite_path = os.path.join(self._configdir, plugin_name)+".sqlite"
 
-        if not os.path.exists(plugin_config_path):
+        if not os.path.exists(plugin_config_path) and not (use_sqlite and
+                os.path.exists(sqlite_path)):
             with open(plugin_config_path, "w") as out:
                 json.dump(old_config, out, indent=4)
 
@@ -211,8 +552,189 @@ I'll create a new one for you now""")
             self.save()
 
 
-        return PluginConfig(plugin_config_path)
+        flush_settings = core.get("config_flush", {})
+        interval = flush_settings.get("interval", 30)
+        changes = flush_settings.get("changes", 100)
+        if use_sqlite:
+            from .sqliteconfig import SQLitePluginConfig, migrate
+            tables = storage.get("tables", ())
+            if not os.path.exists(sqlite_path):
+                migrate(plugin_config_path, sqlite_path, tables)
+            config = SQLitePluginConfig(sqlite_path, tables,
+                    interval=interval, changes=changes, io=self.io)
+        elif storage.get("engine") == "journal":
+            from .journalconfig import JournalPluginConfig
+            config = JournalPluginConfig(plugin_config_path,
+                    compact_after=storage.get("compact_after", 1000),
+                    interval=interval, changes=changes, io=self.io)
+        else:
+            config = PluginConfig(plugin_config_path,
+                    interval=interval, changes=changes, io=self.io)
+        self._plugin_configs[plugin_name] = config
+        return config
+
+
+class LazyPlugin(object):
+    """Stands in for a plugin that is configured to be loaded lazily, so its
+    module isn't imported and it isn't started until it is needed. Since that
+    means the plugin itself can't be asked, what it needs is declared in its
+    manifest in the "lazy_plugins" dict of the core config section:
+
+        "lazy_plugins": {
+            "twitter.Twitter": {
+                "events": ["irc.on_join"],
+                "middleware": [],
+                "requests": ["twitter.lookup"],
+                "commands": ["tweet", "twitter"],
+                "prefixes": ["."]
+            }
+        }
+
+    The stand-in listens for the events, installs the middleware and provides
+    the requests. It also watches for messages that invoke one of the command
+    words, or asks for help with one, given with the bot's nick, the global
+    command prefix or one of the prefixes, or in a direct message. The first
+    of any of those loads the plugin, which then gets the event or request
+    that caused it.
+
+    """
+    REQUIRES = []
+
+    def __init__(self, plugin_name, transport, pluginboss, manifest):
+        self.plugin_name = plugin_name
+        self.transport = transport
+        self.pluginboss = pluginboss
+        self.manifest = manifest
+        self._events = [compile_glob(matchstr) for matchstr in
+                manifest.get("events", [])]
+        self._commands = frozenset(manifest.get("commands", []))
+        self._prefixes = manifest.get("prefixes", [])
+
+    def start(self):
+        for matchstr in self.manifest.get("events", []):
+            self.transport.listen_for_event(matchstr, self)
+        for matchstr in self.manifest.get("middleware", []):
+            self.transport.install_middleware(matchstr, self)
+        for name in self.manifest.get("requests", []):
+            self.transport.provides_request(name, self)
+        if self._commands:
+            self.transport.listen_for_event("irc.on_privmsg", self)
+
+    def stop(self):
+        pass
+
+    def reload(self):
+        pass
+
+    def handles_event(self, eventtype):
+        return True
+
+    def handles_middleware_event(self, eventtype):
+        return True
+
+    def _is_command(self, event):
+        message = event.message.strip()
+        try:
+            nick = self.pluginboss.loaded_plugins['irc.IRCBotPlugin'].client.nickname
+        except (KeyError, AttributeError):
+            nick = None
+        globalprefix = self.pluginboss.config.get("command", {}).get("prefix")
+        for prefix in [nick + ":" if nick else None,
+                globalprefix.strip() if globalprefix else None] + self._prefixes:
+            if prefix and message.startswith(prefix):
+                message = message[len(prefix):]
+                break
+        else:
+            if not getattr(event, "direct", False):
+                return False
+        words = message.split()
+        if words and words[0] == "help":
+            words = words[1:]
+        return bool(words) and words[0] in self._commands
+
+    def _activate(self):
+        return self.pluginboss.activate_plugin(self.plugin_name)
+
+    def received_event(self, event):
+        eventtype = event.eventtype
+        if not (any(glob.match(eventtype) for glob in self._events) or
+                (eventtype == "irc.on_privmsg" and self._is_command(event))):
+            return
+
+        def deliver(_):
+            plugin = self.pluginboss.loaded_plugins.get(self.plugin_name)
+            if plugin is not None:
+                plugin.received_missed_event(event)
+        self._activate().addCallback(deliver).addErrback(log.err)
+
+    def received_middleware_event(self, event):
+        results = []
+        self._activate().addBoth(results.append)
+        plugin = self.pluginboss.loaded_plugins.get(self.plugin_name)
+        if (not results or isinstance(results[0], Failure) or plugin is None or
+                not plugin.handles_middleware_event(event.eventtype)):
+            # Still starting, or failed to. Let the event through untouched.
+            return event
+        return plugin.received_middleware_event(event)
+
+    def incoming_request(self, name, *args, **kwargs):
+        d = self._activate()
+        d.addCallback(lambda _: self.transport.issue_request(name, *args,
+            **kwargs))
+        return d
+
+class _HandlerMap(object):
+    """Maps event or request names to the methods of a plugin class that
+    handle them, e.g. "irc.on_privmsg" to on_event_irc_on_privmsg().
+
+    The method names are gathered once per class. Each name is then resolved
+    the first time it is seen and remembered, so dispatching is a single dict
+    lookup.
+
+    """
+    def __init__(self, cls, prefix, catchall):
+        self._cls = cls
+        # maps handler method names minus the prefix to the full method name
+        self._names = dict((name[len(prefix):], name) for name in dir(cls)
+                if name.startswith(prefix))
+        # maps event or request names to unbound handler functions, or None
+        self._resolved = {}
+
+        # If the class overrides the dispatcher method, it may do something
+        # with names that have no handler method
+        dispatcher = getattr(cls, catchall)
+        dispatcher = getattr(dispatcher, "__func__", dispatcher)
+        self.catchall = dispatcher is not BotPlugin.__dict__[catchall]
+
+    def get(self, name):
+        try:
+            return self._resolved[name]
+        except KeyError:
+            methodname = self._names.get(name.replace(".", "_"))
+            func = getattr(self._cls, methodname) if methodname else None
+            self._resolved[name] = func
+            return func
+
+    def handles(self, name):
+        return self.catchall or self.get(name) is not None
+
+def _handler_maps(cls):
+    """Returns the (events, middleware, requests, batch requests) _HandlerMap
+    objects for a plugin class, building them the first time the class is seen. They are
+    stored on the class itself, so a class re-created by reloading its module
+    gets new ones.
 
+    """
+    maps = cls.__dict__.get("_handler_maps")
+    if maps is None:
+        maps = (
+                _HandlerMap(cls, "on_event_", "received_event"),
+                _HandlerMap(cls, "on_middleware_", "received_middleware_event"),
+                _HandlerMap(cls, "on_request_", "incoming_request"),
+                _HandlerMap(cls, "on_batch_request_", "incoming_batch_request"),
+                )
+        cls._handler_maps = maps
+    return maps
 
 class BotPlugin(object):
     """All bot plugins should inherit from this. It provides methods for
@@ -234,6 +756,10 @@ class BotPlugin(object):
         self.transport = transport
         self.pluginboss = pluginboss
 
+        (self._event_handlers, self._middleware_handlers,
+                self._request_handlers, self._batch_request_handlers,
+                ) = _handler_maps(type(self))
+
         self.reload()
 
     ### Plugins should override these methods if appropriate
@@ -248,7 +774,8 @@ class BotPlugin(object):
         Feel free to override. This is just an example.
 
         """
-        self.config = self.pluginboss.get_plugin_config(self.plugin_name)
+        self.config = self.pluginboss.get_plugin_config(self.plugin_name,
+                reread=True)
         save = lambda: None
         for key, defaultvalue in self.DEFAULT_CONFIG.items():
             if key not in self.config:
@@ -261,6 +788,10 @@ class BotPlugin(object):
 
         This should do any sort of interaction with the twisted reactor such as connecting
 
+        At startup, plugins listed in REQUIRES have already started. If
+        starting takes a while, return a deferred that fires when it is done;
+        plugins that require this one will wait for it.
+
         """
         pass
 
@@ -276,9 +807,19 @@ class BotPlugin(object):
 
     def received_event(self, event):
         """An event has been received by this plugin"""
-        method = getattr(self, "on_event_%s" % event.eventtype.replace(".","_"), None)
+        method = self._event_handlers.get(event.eventtype)
         if method:
-            method(event)
+            method(self, event)
+
+    def received_missed_event(self, event):
+        """An event has been passed on to this plugin after the fact, because
+        it was sent before the plugin was listening, e.g. the event that made
+        a LazyPlugin load it. Plugins that don't get their events straight
+        from the transport can override this.
+
+        """
+        if self.handles_event(event.eventtype):
+            self.received_event(event)
 
     def received_middleware_event(self, event):
         """This event has been intercepted before it got to its destination. We
@@ -286,31 +827,75 @@ class BotPlugin(object):
         be swallowed
 
         """
-        method = getattr(self, "on_middleware_%s" % event.eventtype.replace(".","_"), None)
+        method = self._middleware_handlers.get(event.eventtype)
         if method:
-            return method(event)
+            return method(self, event)
         return event
 
     def incoming_request(self, name, *args, **kwargs):
         """A request has been issued to this plugin. Return a deferred.
 
         """
-        method = getattr(self, "on_request_%s" % name.replace(".","_"), None)
+        method = self._request_handlers.get(name)
         if method:
-            toret = method(*args, **kwargs)
+            toret = method(self, *args, **kwargs)
         else:
             toret = defer.fail(NotImplementedError("The plugin {0} does not provide a request method for {1}".format(self.plugin_name, name)))
         return toret
 
+    def incoming_batch_request(self, name, argsets):
+        """A batch of requests has been issued to this plugin with
+        Transport.issue_requests(). argsets is a list of tuples of arguments.
+        Return a list with one deferred or value for each.
+
+        This is only called for requests with an on_batch_request_ method,
+        which is called with the list of tuples.
+
+        """
+        method = self._batch_request_handlers.get(name)
+        if method:
+            return method(self, argsets)
+        raise NotImplementedError("The plugin {0} does not provide a batch request method for {1}".format(self.plugin_name, name))
+
+    def handles_batch_request(self, name):
+        """Used by the transport to decide whether to send a batch of requests
+        to incoming_batch_request() or one at a time to incoming_request()
+
+        """
+        return self._batch_request_handlers.handles(name)
+
+    def handles_event(self, eventtype):
+        """Used by the transport to skip delivering events this plugin has no
+        handler for. Plugins that override received_event() get everything.
+
+        """
+        return self._event_handlers.handles(eventtype)
+
+    def handles_middleware_event(self, eventtype):
+        return self._middleware_handlers.handles(eventtype)
+
     ### Convenience methods for use by the plugin to install event listeners
-    def install_middleware(self, matchstr):
-        self.transport.install_middleware(matchstr, self)
+    def install_middleware(self, matchstr, **constraints):
+        self.transport.install_middleware(matchstr, self, **constraints)
+
+    def listen_for_event(self, matchstr, **constraints):
+        """Listen for events matching matchstr. Keyword arguments restrict
+        this to events with those attribute values, e.g.
+        self.listen_for_event("irc.on_privmsg", channel="#minecraft")
 
-    def listen_for_event(self, matchstr):
-        self.transport.listen_for_event(matchstr, self)
+        """
+        self.transport.listen_for_event(matchstr, self, **constraints)
+
+    def stop_listening_for_event(self, matchstr):
+        """Undoes listen_for_event() for matchstr, whatever the constraints"""
+        self.transport.stop_listening_for_event(matchstr, self)
 
-    def provides_request(self, name):
-        self.transport.provides_request(name, self)
+    def provides_request(self, name, **policy):
+        """Registers this plugin to handle the named request. See
+        Transport.provides_request() for the meaning of policy.
+
+        """
+        self.transport.provides_request(name, self, **policy)
 
 class EventWatcher(object):
     """This is a mixin for plugins that adds event watching features, which
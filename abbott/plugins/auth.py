@@ -7,6 +7,7 @@ from twisted.python import log
 from twisted.internet import defer, reactor
 
 from .. import command
+from ..transport import Event, RequestOverloaded
 from . import ircutil
 
 """
@@ -102,6 +103,7 @@ class Auth(command.CommandPluginSuperclass):
     
     """
     REQUIRES = ["ircutil.IRCWhois"]
+
     DEFAULT_CONFIG = {
             # Maps authnames to a list of (channel, perm string) tuples
             "perms": {},
@@ -232,23 +234,23 @@ class Auth(command.CommandPluginSuperclass):
                 ]:
             event.has_permission = functools.partial(self._has_permission, event.user)
             event.where_permission = functools.partial(self._where_permission, event.user)
+            event.get_authname = functools.partial(self._get_authname, event.user)
 
         return event
 
 
     @defer.inlineCallbacks
-    def _get_permissions(self, hostmask):
-        """This function returns the permissions granted to the given user,
-        identifying them in the process by doing a whois lookup if necessary.
+    def _get_authname(self, hostmask):
+        """Returns a deferred which fires with the authname of the user with
+        the given hostmask, or None if they could not be identified.
+
+        This function is installed as event.get_authname(), partially
+        evaluated with the hostmask.
 
-        It returns a deferred object which fires with an iterable over
-        (channel, permissionstr) tuples the user has, or an empty list of the
-        user does not have any permissions or the user could not be identified.
-        It does NOT include any default permissions, only permissions
-        explicitly granted to the user (along with any groups the user is in).
-        
         This method may send a whois to the server, in which case it looks for
-        an IRC 330 command back from the server indicating the user's authname
+        an IRC 330 command back from the server indicating the user's authname.
+        The answer is cached in authd_users, so the permission checks that
+        follow don't send another.
 
         """
         # Check if the user is already identified by a previous whois
@@ -262,7 +264,7 @@ class Auth(command.CommandPluginSuperclass):
             nick = hostmask.split("!")[0]
             try:
                 whois_info = (yield self.transport.issue_request("irc.whois", nick))
-            except ircutil.WhoisError as e:
+            except (ircutil.WhoisError, RequestOverloaded) as e:
                 log.msg("Whois failed: %s" % e)
                 whois_info = {}
 
@@ -278,6 +280,22 @@ class Auth(command.CommandPluginSuperclass):
             else:
                 authname = self.authd_users[hostmask] = whois_info["330"][1]
 
+        defer.returnValue(authname)
+
+    @defer.inlineCallbacks
+    def _get_permissions(self, hostmask):
+        """This function returns the permissions granted to the given user,
+        identifying them in the process by doing a whois lookup if necessary.
+
+        It returns a deferred object which fires with an iterable over
+        (channel, permissionstr) tuples the user has, or an empty list of the
+        user does not have any permissions or the user could not be identified.
+        It does NOT include any default permissions, only permissions
+        explicitly granted to the user (along with any groups the user is in).
+
+        """
+        authname = (yield self._get_authname(hostmask))
+
         # if authname is none at this point, it indicates the whois didn't
         # return any auth info. Remember this method does not account for
         # default permissions, so just return an empty set
@@ -368,6 +386,17 @@ class Auth(command.CommandPluginSuperclass):
         # Also turn groups into a defaultdict
         self.config['groups'] = defaultdict(list, self.config['groups'])
 
+        self._permissions_changed()
+
+    def _permissions_changed(self):
+        """Called whenever a change to the permissions, defaults or groups
+        could change what permissions someone has. Sends an
+        auth.permissions_changed event, so other plugins can tell when to
+        throw away what they worked out from them.
+
+        """
+        self.transport.send_event(Event("auth.permissions_changed"))
+
     ### The command plugin callbacks, installed above
 
     def permission_add(self, event, match):
@@ -381,6 +410,7 @@ class Auth(command.CommandPluginSuperclass):
         # must convert them on reload and also change the .remove() method in
         # permission_revoke()
         self.permissions[name].append([channel, perm])
+        self._permissions_changed()
         self.config.save()
 
         if channel:
@@ -414,6 +444,7 @@ class Auth(command.CommandPluginSuperclass):
                     usergroup = "Group" if name.startswith("%") else "User",
                     ))
         else:
+            self._permissions_changed()
             self.config.save()
             if channel:
                 event.reply("Permission {0} revoked for {usergroup} {1} in channel {2}".format(
@@ -488,6 +519,7 @@ class Auth(command.CommandPluginSuperclass):
         channel = groupdict.get("channel", None)
         if [channel, permission] not in self.config['defaultperms']:
             self.config['defaultperms'].append([channel, permission])
+            self._permissions_changed()
             self.config.save()
             if channel:
                 event.reply("Done! Everybody now has %s in %s!" % (permission, channel))
@@ -505,6 +537,7 @@ class Auth(command.CommandPluginSuperclass):
         except ValueError:
             event.reply("That permission is not in the default list")
         else:
+            self._permissions_changed()
             self.config.save()
             event.reply("Done. Revoked.")
 
@@ -542,6 +575,7 @@ class Auth(command.CommandPluginSuperclass):
                 user, group))
         else:
             permlist.append(group)
+            self._permissions_changed()
             self.config.save()
             event.reply("User {0} added as a member of group {1}".format(
                 user, group))
@@ -563,6 +597,7 @@ class Auth(command.CommandPluginSuperclass):
                 user, group))
         else:
             permlist.remove(group)
+            self._permissions_changed()
             self.config.save()
             event.reply("User {0} removed from group {1}".format(
                 user, group))
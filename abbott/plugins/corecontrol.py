@@ -1,8 +1,9 @@
 from collections import defaultdict
+import time
 
 from twisted.internet import reactor, defer
 
-from ..command import CommandPluginSuperclass
+from ..command import CommandPluginSuperclass, commands_version
 
 class CoreControl(CommandPluginSuperclass):
     def start(self):
@@ -23,6 +24,60 @@ class CoreControl(CommandPluginSuperclass):
                 helptext="Re-reads the config on disk and updates in-memory configuration",
                 )
 
+        statsgroup = self.install_cmdgroup(
+                grpname="stats",
+                permission="core.stats",
+                helptext="Bot performance statistics",
+                )
+
+        statsgroup.install_command(
+                cmdname="dispatch",
+                argmatch=r"(?P<top>\d+)?$",
+                callback=self.dispatch_stats,
+                cmdusage="[N]",
+                helptext="Lists the N (default 5) plugin handlers that have taken the most total time. Requires transport stats to be enabled in the core config",
+                )
+
+        statsgroup.install_command(
+                cmdname="queue",
+                callback=self.queue_stats,
+                helptext="Shows the event queue counters. Requires queued dispatch to be enabled in the core config",
+                )
+
+        statsgroup.install_command(
+                cmdname="requests",
+                callback=self.request_stats,
+                helptext="Shows the cache and limit counters of requests that have them",
+                )
+
+        statsgroup.install_command(
+                cmdname="health",
+                callback=self.health_stats,
+                helptext="Shows which plugins have had failing or slow event handlers, and which are cut off from events. Requires the circuit breaker to be enabled in the core config",
+                )
+
+        statsgroup.install_command(
+                cmdname="stalls",
+                argmatch=r"(?P<count>\d+)?$",
+                callback=self.stall_stats,
+                cmdusage="[N]",
+                helptext="Lists the last N (default 5) times the reactor was blocked, and the slowest plugin handler each time. Requires the stall monitor to be enabled in the core config",
+                )
+
+        statsgroup.install_command(
+                cmdname="ratelimit",
+                callback=self.ratelimit_stats,
+                helptext="Shows how many invocations of each command were dropped or held back for going over the rate limit. Requires command.ratelimit to be set in the config",
+                )
+
+        statsgroup.install_command(
+                cmdname="commands",
+                argmatch=r"(?P<top>\d+)?$",
+                callback=self.command_stats,
+                cmdusage="[N]",
+                helptext="Lists the N (default 5) commands that have taken the most total time, and the last N commands that were slow. Requires command.stats to be set in the config",
+                )
+
     def shutdown(self, event, match):
         event.reply("Goodbye")
         reactor.callLater(2, reactor.stop)
@@ -33,11 +88,127 @@ class CoreControl(CommandPluginSuperclass):
         except Exception:
             event.reply("There was a problem loading the new json. Check for syntax errors maybe? Full traceback in log")
             raise
+        self.transport.configure(self.pluginboss.config)
         # Each plugin will reload their individual json files when we call reload()
         for plugin in self.pluginboss.loaded_plugins.values():
             plugin.reload()
         event.reply("Config reloaded!")
+
+    @defer.inlineCallbacks
+    def dispatch_stats(self, event, match):
+        top = int(match.groupdict()['top'] or 5)
+        try:
+            rows = (yield self.transport.issue_request("transport.stats", top=top))
+        except NotImplementedError:
+            event.reply("Dispatch timing is turned off. Set core.transport.stats to true in the config and reload it.")
+            return
+
+        if not rows:
+            event.reply("No calls timed yet")
+            return
+        for row in rows:
+            event.reply("{plugin} {kind} {name}: {count} calls, {total:.3f}s total, p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms, max {max_ms:.2f}ms".format(
+                p50_ms=row['p50']*1000, p99_ms=row['p99']*1000,
+                max_ms=row['max']*1000, **row))
+
+    @defer.inlineCallbacks
+    def queue_stats(self, event, match):
+        try:
+            stats = (yield self.transport.issue_request("transport.queue"))
+        except NotImplementedError:
+            event.reply("Events are not being queued. Set core.transport.queue in the config and reload it.")
+            return
+
+        event.reply("{depth} events queued (max {max_depth}), {enqueued} queued, {dispatched} dispatched, {dropped} dropped, {inline} dispatched inline. Wait p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms, max {max_ms:.2f}ms".format(
+            p50_ms=stats['wait_p50']*1000, p99_ms=stats['wait_p99']*1000,
+            max_ms=stats['wait_max']*1000, **stats))
+
+    @defer.inlineCallbacks
+    def request_stats(self, event, match):
+        rows = (yield self.transport.issue_request("transport.requests"))
+        if not rows:
+            event.reply("No requests have caches or limits")
+            return
+        for row in rows:
+            event.reply("{name}: {hits} cache hits, {misses} misses, {coalesced} waited on a call in progress, {cached} cached, {in_flight} in progress, {waiting} waiting, {timeouts} timed out, {overloads} overloaded".format(**row))
+
+    @defer.inlineCallbacks
+    def health_stats(self, event, match):
+        try:
+            rows = (yield self.transport.issue_request("transport.health"))
+        except NotImplementedError:
+            event.reply("The circuit breaker is turned off. Set core.transport.breaker in the config and reload it.")
+            return
+
+        if not rows:
+            event.reply("No plugin has failed or been slow yet")
+            return
+        for row in rows:
+            if row['remaining'] is None:
+                state = "ok"
+            else:
+                state = "{0}, cut off for {1:.0f} more seconds".format(
+                        row['state'], row['remaining'])
+            event.reply("{plugin}: {state}. {failures} failures, {slow} slow calls, tripped {trips} times".format(
+                **dict(row, state=state)))
+
+    @defer.inlineCallbacks
+    def stall_stats(self, event, match):
+        count = int(match.groupdict()['count'] or 5)
+        try:
+            stalls = (yield self.transport.issue_request("transport.stalls"))
+        except NotImplementedError:
+            event.reply("The stall monitor is turned off. Set core.transport.stalls in the config and reload it.")
+            return
+
+        if not stalls:
+            event.reply("No stalls yet")
+            return
+        for stall in stalls[-count:]:
+            when = time.strftime("%H:%M:%S", time.localtime(stall['time']))
+            if stall['plugin'] is None:
+                culprit = "no plugin handler was called"
+            else:
+                culprit = "slowest call {plugin} {kind} {name} ({0:.0f}ms)".format(
+                        stall['elapsed']*1000, **stall)
+            event.reply("{0}: stalled {1:.0f}ms, {2}".format(
+                when, stall['stall']*1000, culprit))
         
+    @defer.inlineCallbacks
+    def ratelimit_stats(self, event, match):
+        try:
+            rows = (yield self.transport.issue_request("command.ratelimit"))
+        except NotImplementedError:
+            event.reply("Commands aren't rate limited. Set command.ratelimit in the config and reload it.")
+            return
+
+        if not rows:
+            event.reply("Nobody has gone over the rate limit yet")
+            return
+        for row in rows:
+            event.reply("{command}: {dropped} dropped, {delayed} held back".format(**row))
+
+    @defer.inlineCallbacks
+    def command_stats(self, event, match):
+        top = int(match.groupdict()['top'] or 5)
+        try:
+            stats = (yield self.transport.issue_request("command.stats", top=top))
+        except NotImplementedError:
+            event.reply("Command stats are turned off. Set command.stats in the config and reload it.")
+            return
+
+        if not stats['commands']:
+            event.reply("No commands run yet")
+            return
+        for row in stats['commands']:
+            event.reply("{plugin} {command}: {calls} calls, {denied} denied, {failed} failed, {total:.3f}s total, permission check p50 {check_p50_ms:.2f}ms, p50 {p50_ms:.2f}ms, p99 {p99_ms:.2f}ms, max {max_ms:.2f}ms".format(
+                check_p50_ms=row['check_p50']*1000, p50_ms=row['p50']*1000,
+                p99_ms=row['p99']*1000, max_ms=row['max']*1000, **row))
+        for slow in stats['slow'][-top:]:
+            when = time.strftime("%H:%M:%S", time.localtime(slow['time']))
+            event.reply("{0}: slow {command} from {user}, permission check {1:.0f}ms, callback {2:.0f}ms".format(
+                when, slow['check']*1000, slow['callback']*1000, **slow))
+
 class Help(CommandPluginSuperclass):
     def start(self):
         super(Help, self).start()
@@ -53,45 +224,84 @@ class Help(CommandPluginSuperclass):
                 helptext="Help on the help command. Displays a helpful help message about help, helps you help yourself use help. Helpful, huh?",
                 )
 
-    @defer.inlineCallbacks
-    def display_help(self, event, match):
-        command_groups = []
+        # how many auth.permissions_changed events there have been
+        self.permission_changes = 0
+        self.listen_for_event("auth.permissions_changed")
+        # (commands version, permission changes) that the help index and the
+        # cached listings were worked out for
+        self.help_versions = None
+        # list of (name, permissions) of the commands and groups to list, in
+        # order. A group is listed wherever any of its subcommands can be run.
+        self.help_index = []
+        # maps authnames to the (global commands, channel commands) listings
+        # for the users identified as them
+        self.help_cache = {}
+
+    def on_event_auth_permissions_changed(self, event):
+        self.permission_changes += 1
+
+    def _help_versions(self):
+        return (commands_version(self.transport), self.permission_changes)
+
+    def _build_help_index(self):
+        index = []
         for plugin in self.pluginboss.loaded_plugins.values():
-            try:
-                command_groups.extend(plugin.cmdgs)
-            except AttributeError:
-                pass
+            for group in getattr(plugin, "cmdgs", ()):
+                if not group.grpname:
+                    # This is a group of top-level commands. List each
+                    # command individually
+                    for cmdname, permission in group.subcmds:
+                        index.append((cmdname, [permission]))
+                else:
+                    index.append((group.grpname,
+                        [permission for cmdname, permission in group.subcmds]))
+        return index
+
+    @defer.inlineCallbacks
+    def _help_listing(self, event):
+        """Works out which commands the user can run where. Each permission
+        is only looked up once, and all at once; they don't need a whois, as
+        the user was identified before this is called.
+
+        """
+        permissions = list(set(permission for name, needed in
+            self.help_index for permission in needed))
+        wheres = (yield defer.gatherResults([event.where_permission(permission)
+            for permission in permissions]))
+        where = dict(zip(permissions, wheres))
 
         globalcommands = []
         channelcommands = defaultdict(list)
+        for name, needed in self.help_index:
+            chans = set()
+            for permission in needed:
+                chans.update(where[permission])
+            if None in chans:
+                globalcommands.append(name)
+            else:
+                for channel in chans:
+                    channelcommands[channel].append(name)
+        defer.returnValue((globalcommands, channelcommands))
 
-        for group in command_groups:
-            if not group.grpname:
-                # This is a group of top-level commands. List each command
-                # individually
-                for cmd in group.subcmds:
-                    # Get a list of channels where this permission applies for
-                    # this user
-                    where = (yield event.where_permission(cmd[1]))
-                    if None in where:
-                        globalcommands.append(cmd[0])
-                    else:
-                        for channel in where:
-                            channelcommands[channel].append(cmd[0])
+    @defer.inlineCallbacks
+    def display_help(self, event, match):
+        authname = (yield event.get_authname())
 
-            else:
-                # Go through the sub-commands and make sure there is at least
-                # one command we have access to. If so, just list the top-level
-                # metacommand
-                chans = set()
-                for cmd in group.subcmds:
-                    chans.update((yield event.where_permission(cmd[1])))
-
-                if None in chans:
-                    globalcommands.append(group.grpname)
-                else:
-                    for channel in chans:
-                        channelcommands[channel].append(group.grpname)
+        # The listing is worked out once per authname, until the commands or
+        # anybody's permissions change
+        versions = self._help_versions()
+        if versions != self.help_versions:
+            self.help_versions = versions
+            self.help_index = self._build_help_index()
+            self.help_cache = {}
+        try:
+            globalcommands, channelcommands = self.help_cache[authname]
+        except KeyError:
+            listing = (yield self._help_listing(event))
+            # Don't cache it if something changed in the meantime
+            if versions == self._help_versions():
+                self.help_cache[authname] = listing
+            globalcommands, channelcommands = listing
 
         try:
             prefix = self.pluginboss.config['command']['prefix']
@@ -13,7 +13,8 @@ from ..command import CommandPluginSuperclass
 """
 This module houses the bot plugins IRCBotPlugin and IRCController, and one
 twisted Protocol-derived object (IRCBot) used in conjunction with IRCBotPlugin
-(which is also a twisted ClientFactory)
+(which is also a twisted ClientFactory). ReplayIRCBotPlugin stands in for
+IRCBotPlugin when replaying a recording, see the recorder plugin.
 
 """
 
@@ -247,8 +248,18 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
     """
     maxDelay = 60*5
 
+    # Our nick changes on a nick change, and may change when we reconnect,
+    # after which we rejoin our channels
+    GETNICK_CACHE = dict(
+            cache_ttl=60,
+            invalidate_on=["irc.on_nick_change", "irc.on_join"],
+            )
+
     def start(self):
         self.client = None
+        # Callables called with each event broadcast from the network, before
+        # it is sent. See the recorder plugin.
+        self.event_observers = []
         self.listen_for_event("irc.do_*")
         self.connector = reactor.connectSSL(self.config['server'], self.config['port'], self, ClientContextFactory())
 
@@ -264,7 +275,7 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
             return d
         self.shutdown_trigger = reactor.addSystemEventTrigger("before", "shutdown", shutdown)
 
-        self.provides_request("irc.getnick")
+        self.provides_request("irc.getnick", **self.GETNICK_CACHE)
         self.provides_request("irc.get_channel_mode_params")
 
     def stop(self):
@@ -298,6 +309,8 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
         
         """
         event = Event(eventname, **kwargs)
+        for observer in self.event_observers:
+            observer(event)
         self.transport.send_event(event)
 
     def received_event(self, event):
@@ -352,6 +365,45 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
         return self.client.getChannelModeParams()
 
 
+class _NullTransport(object):
+    """A stand-in for the IRC connection's transport that throws away
+    everything written to it
+
+    """
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def loseConnection(self):
+        pass
+
+class ReplayIRCBotPlugin(IRCBotPlugin):
+    """Loaded in place of the IRCBotPlugin when replaying a recording. The
+    IRC protocol object is connected to a transport that discards everything
+    sent to it instead of to a server.
+
+    """
+    def start(self):
+        self.client = None
+        self.event_observers = []
+        self.listen_for_event("irc.do_*")
+
+        self.provides_request("irc.getnick", **self.GETNICK_CACHE)
+        self.provides_request("irc.get_channel_mode_params")
+
+        # Sets self.client
+        self.buildProtocol(None).makeConnection(_NullTransport())
+
+    def stop(self):
+        self.client = None
+
+
 class IRCController(CommandPluginSuperclass):
     """This plugin provides a few administrative tasks in conjunction with the
     IRCBotPlugin.
@@ -179,9 +179,10 @@ class OpProvider(EventWatcher, BotPlugin):
         self.event_buffer = defaultdict(set)
         self.connector_buffer = defaultdict(set)
 
-        # Register the requests we handle
+        # Register the requests we handle. Waiting for op alone may take 30
+        # seconds, so allow plenty of time for the rest.
         for operation in self.CONNECTOR_REQS | self.OTHER_REQS:
-            self.provides_request("ircop.{0}".format(operation))
+            self.provides_request("ircop.{0}".format(operation), timeout=60)
 
         # Events we listen for
         self.listen_for_event("ircutil.hasop.acquired")
@@ -1,12 +1,11 @@
 import re
 from collections import defaultdict
 
-from twisted.internet import reactor
 from twisted.python import log
 from twisted.internet import defer
 
 from ..command import CommandPluginSuperclass
-from ..transport import Event
+from ..transport import Event, RequestTimedOut
 from ..pluginbase import BotPlugin, EventWatcher, non_reentrant
 
 """
@@ -18,11 +17,35 @@ certain situations
 
 class WhoisError(Exception):
     pass
-class WhoisTimedout(WhoisError):
+class WhoisTimedout(WhoisError, RequestTimedOut):
     pass
 class NoSuchNick(WhoisError):
     pass
 
+def _nick(user):
+    """Returns the lowercase nick of a nick or a nick!user@host"""
+    return user.split("!")[0].lower()
+
+def _whois_invalidated(event, cache):
+    """Returns the nicks whose whoises a nick change or quit makes stale"""
+    if event.eventtype == "irc.on_nick_change":
+        return [_nick(event.oldnick), _nick(event.newnick)]
+    return [_nick(event.user)]
+
+def _names_invalidated(event, cache):
+    """Returns the channels whose names an event makes stale: the channel it
+    happened on, or those the user who quit or changed nick is in
+
+    """
+    if event.eventtype == "irc.on_nick_change":
+        nick = _nick(event.oldnick)
+    elif event.eventtype == "irc.on_user_quit":
+        nick = _nick(event.user)
+    else:
+        return [event.channel.lower()]
+    return [channel for channel, names in cache.answers()
+            if any(name.lstrip("@+").lower() == nick for name in names)]
+
 class IRCWhois(CommandPluginSuperclass):
     """Provides a request:
 
@@ -34,13 +57,36 @@ class IRCWhois(CommandPluginSuperclass):
     deferreds returned may also errback with one of the following exceptions:
     WhoisTimedout
     NoSuchNick
+    RequestOverloaded (if too many whoises are already waiting)
+
+    Batches of whoises issued with transport.issue_requests() are sent to the
+    server together, batch_targets nicks per WHOIS command.
 
     """
+    DEFAULT_CONFIG = {
+            # Servers that accept several nicks per WHOIS (see TARGMAX in
+            # their RPL_ISUPPORT) can be sent more than one at a time
+            "batch_targets": 1,
+            }
 
     def start(self):
         super(IRCWhois, self).start()
 
-        self.provides_request("irc.whois")
+        self.provides_request("irc.whois",
+                timeout=10,
+                timeout_error=WhoisTimedout,
+                max_concurrent=10,
+                queue=100,
+                cache_ttl=30,
+                cache_size=500,
+                cache_key=lambda nick: nick.lower(),
+                # Only the whoises of the nicks involved are dropped
+                invalidate_on=["irc.on_nick_change", "irc.on_user_quit"],
+                invalidate_keys=_whois_invalidated,
+                # Someone who isn't identified may identify at any moment,
+                # and auth whoises them again to find out
+                cache_if=lambda whois_info: "330" in whois_info,
+                )
 
         self.listen_for_event("irc.on_unknown")
 
@@ -73,51 +119,68 @@ class IRCWhois(CommandPluginSuperclass):
         command = event.command
         params = event.params
         if command == "RPL_WHOISUSER":
-            # Start a new one
-            if self.currentwhois:
-                log.msg("Error: Got a RPL_WHOISUSER but we're already in a whois!")
+            # Start a new one. A WHOIS for several nicks may only end with a
+            # single RPL_ENDOFWHOIS, so this also ends the previous one.
+            self._end_whois()
             nick = params[1].lower()  # Use lowercase nick otherwise we can't marry the server response to our request, if we provided a name in the wrong case.
             self.currentwhois = nick
             self.currentinfo = {command: params[1:]}
 
         elif command == "RPL_ENDOFWHOIS":
-            if not self.currentwhois or not self.pendingwhoises[self.currentwhois]:
-                return
-
-            for callback in self.pendingwhoises.pop(self.currentwhois):
-                callback.callback(dict(self.currentinfo))
-
-            self.currentwhois = None
+            self._end_whois()
 
         elif command == "ERR_NOSUCHNICK":
             nick = params[1].lower()
-            for callback in self.pendingwhoises.pop(nick):
+            for callback in self.pendingwhoises.pop(nick, ()):
                 callback.errback(NoSuchNick(params[2]))
 
         else:
             self.currentinfo[command] = params[1:]
 
+    def _end_whois(self):
+        """Answers the pending requests for the whois currently coming in"""
+        if not self.currentwhois:
+            return
+        for callback in self.pendingwhoises.pop(self.currentwhois, ()):
+            callback.callback(dict(self.currentinfo))
+        self.currentwhois = None
+
+    def _pending_whois(self, nick):
+        """Returns a deferred for the next whois of the given (lowercase)
+        nick
+
+        """
+        # The transport cancels the deferred if the server doesn't answer in
+        # time
+        d = defer.Deferred(lambda d: self.pendingwhoises[nick].discard(d))
+        self.pendingwhoises[nick].add(d)
+        return d
+
     def on_request_irc_whois(self, nick):
         nick = nick.lower()  # Use lowercase nick otherwise we can't marry the server response to our request, if we provided a name in the wrong case.
-        d = defer.Deferred()
-        self.pendingwhoises[nick].add(d)
+        d = self._pending_whois(nick)
 
         event = Event("irc.do_whois",
                 nickname=nick,
                 )
         self.transport.send_event(event)
 
-        def timeout():
-            d.errback(WhoisTimedout("No whois response from server"))
-            self.pendingwhoises[nick].remove(d)
-        timer = reactor.callLater(10, timeout)
-        def canceltimer(info):
-            timer.cancel()
-            return info
-        d.addBoth(canceltimer)
-
         return d
 
+    def on_batch_request_irc_whois(self, argsets):
+        nicks = [nick.lower() for (nick,) in argsets]
+        deferreds = [self._pending_whois(nick) for nick in nicks]
+
+        # Each nick only needs asking about once
+        unique = sorted(set(nicks))
+        per_command = max(1, self.config['batch_targets'])
+        for i in range(0, len(unique), per_command):
+            self.transport.send_event(Event("irc.do_whois",
+                nickname=",".join(unique[i:i+per_command]),
+                ))
+
+        return deferreds
+
     @defer.inlineCallbacks
     def do_whois(self, event, match):
         """A request from a !whois command"""
@@ -151,7 +214,26 @@ class Names(CommandPluginSuperclass):
     def start(self):
         super(Names, self).start()
 
-        self.provides_request("irc.names")
+        self.provides_request("irc.names",
+                timeout=10,
+                max_concurrent=10,
+                queue=100,
+                cache_ttl=30,
+                invalidate_on=[
+                    "irc.on_join",
+                    "irc.on_part",
+                    "irc.on_user_joined",
+                    "irc.on_user_part",
+                    "irc.on_user_quit",
+                    "irc.on_user_kick",
+                    "irc.on_nick_change",
+                    # Names are prefixed with @ or + for op and voice
+                    "irc.on_mode_change",
+                    ],
+                # Only the names of the channels involved are dropped
+                cache_key=lambda channel: channel.lower(),
+                invalidate_keys=_names_invalidated,
+                )
 
         self.listen_for_event("irc.on_unknown")
 
@@ -167,18 +249,17 @@ class Names(CommandPluginSuperclass):
         self.currentinfo = []
         self.pending = defaultdict(set)
 
-    @defer.inlineCallbacks
     def on_request_irc_names(self, channel):
         self.transport.send_event(Event("irc.do_raw",
                 line="NAMES " + channel))
         log.msg("NAMES line sent for channel %s. Awaiting reply..." % channel)
 
-        d = defer.Deferred()
+        # The transport cancels the deferred if the server doesn't answer in
+        # time
+        d = defer.Deferred(lambda d: self.pending[channel].discard(d))
         self.pending[channel].add(d)
 
-        names = (yield d)
-
-        defer.returnValue(names)
+        return d
 
     def on_event_irc_on_unknown(self, event):
         command = event.command
@@ -318,7 +399,10 @@ class HasOp(BotPlugin):
 
         self.has_op = {}
 
-        self.provides_request("irc.has_op")
+        self.provides_request("irc.has_op",
+                cache_ttl=60,
+                invalidate_on=["irc.on_join", "irc.on_part", "irc.on_mode_change"],
+                )
         self.listen_for_event("irc.on_join")
         self.listen_for_event("irc.on_mode_change")
 
@@ -379,7 +463,13 @@ class ChanMode(EventWatcher, BotPlugin):
 
         self.mode = {}
 
-        self.provides_request("irc.chanmode")
+        # _get_mode() has its own timeout since it's also called outside of
+        # requests. This one is a backstop.
+        self.provides_request("irc.chanmode",
+                timeout=10,
+                cache_ttl=300,
+                invalidate_on=["irc.on_join", "irc.on_mode_change"],
+                )
 
         self.listen_for_event("irc.on_join")
         self.listen_for_event("irc.on_mode_change")
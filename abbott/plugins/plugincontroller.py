@@ -8,6 +8,7 @@ except ImportError:
 from twisted.python import log
 
 from ..command import CommandPluginSuperclass
+from ..pluginbase import LazyPlugin
 
 
 class PluginController(CommandPluginSuperclass):
@@ -173,7 +174,8 @@ class PluginController(CommandPluginSuperclass):
         event.reply("Plugin %s removed from startup list" % plugin_name)
 
     def list_plugins(self, event, match):
-        plugins = list(self.pluginboss.loaded_plugins.keys())
+        plugins = [name + (" (lazy)" if isinstance(plugin, LazyPlugin) else "")
+                for name, plugin in self.pluginboss.loaded_plugins.items()]
 
         plugins.sort()
         event.reply("Plugins currently running: %s" % ", ".join(plugins))
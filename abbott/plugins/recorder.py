@@ -0,0 +1,157 @@
+import json
+import time
+from timeit import default_timer
+
+from twisted.internet import reactor, defer, task
+from twisted.python import log
+
+from ..pluginbase import BotPlugin
+
+"""
+Recording and replaying of the events that come in from the IRC network.
+
+The Recorder plugin appends every event broadcast by the IRCBotPlugin to a
+file, one JSON list per line: [timestamp, eventtype, attributes]. Only
+attributes that can be serialized to JSON are kept. A relative file name is
+taken relative to the config directory. The lines are written in batches, by
+a Worker of the bot's IOExecutor, every flush_interval seconds or every
+flush_events events, whichever comes first.
+
+A recording can be fed back through a full set of plugins, with no network
+connection, by the replay script (see abbott.entrypt.replay), which loads
+irc.ReplayIRCBotPlugin in place of the IRCBotPlugin. This is used to
+reproduce real load and measure throughput offline.
+
+"""
+
+class Recorder(BotPlugin):
+    REQUIRES = ["irc.IRCBotPlugin"]
+    DEFAULT_CONFIG = {
+            "filename": "events.jsonl",
+            "flush_interval": 1,
+            "flush_events": 100,
+            }
+
+    def start(self):
+        filename = self.pluginboss.config_path(self.config['filename'])
+        # The file is only used from this thread
+        self._worker = self.pluginboss.io.worker(filename)
+        self._worker.call(self._open, filename).addErrback(log.err,
+                "Opening the recording failed")
+        # lines not yet handed to the worker
+        self._pending = []
+        self._flush_call = None
+
+        self.ircplugin = self.pluginboss.loaded_plugins['irc.IRCBotPlugin']
+        self.ircplugin.event_observers.append(self.record)
+
+    def stop(self):
+        """Returns a deferred that fires once the events recorded so far are
+        written and the file is closed
+
+        """
+        try:
+            self.ircplugin.event_observers.remove(self.record)
+        except ValueError:
+            pass
+        self.flush()
+        return self._worker.call(self._close)
+
+    def record(self, event):
+        attrs = {}
+        for name, value in event.__dict__.items():
+            if name == "eventtype":
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            attrs[name] = value
+
+        self._pending.append(json.dumps([round(time.time(), 3),
+            event.eventtype, attrs], separators=(",", ":")) + "\n")
+        if len(self._pending) >= self.config['flush_events']:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self.config['flush_interval'],
+                    self.flush)
+
+    def flush(self):
+        """Writes the events recorded so far. Returns a deferred that fires
+        once they are written.
+
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        lines, self._pending = self._pending, []
+        d = self._worker.call(self._write, lines)
+        d.addErrback(log.err, "Writing the recording failed")
+        return d
+
+    def _open(self, filename):
+        self.file = open(filename, "a")
+
+    def _close(self):
+        self.file.close()
+
+    def _write(self, lines):
+        if lines:
+            self.file.write("".join(lines))
+            self.file.flush()
+
+def replay_events(ircplugin, filename, speed=0):
+    """Broadcasts the events recorded in the given file through ircplugin.
+
+    If speed is 0 the events are sent as fast as possible, yielding to the
+    reactor in between. Otherwise, events are sent at speed times the rate
+    they were recorded.
+
+    Returns a deferred that fires with (number of events, elapsed seconds)
+    once every event has been sent.
+
+    """
+    sent = [0]
+    started = default_timer()
+
+    def events():
+        first_timestamp = None
+        with open(filename, "r") as inp:
+            for line in inp:
+                timestamp, eventtype, attrs = json.loads(line)
+                if speed:
+                    if first_timestamp is None:
+                        first_timestamp = timestamp
+                    delay = ((timestamp - first_timestamp) / speed -
+                            (default_timer() - started))
+                    if delay > 0:
+                        yield task.deferLater(reactor, delay, lambda: None)
+
+                ircplugin.broadcast_message(eventtype, **attrs)
+                sent[0] += 1
+                yield
+
+    d = task.cooperate(events()).whenDone()
+    d.addCallback(lambda _: (sent[0], default_timer() - started))
+    return d
+
+@defer.inlineCallbacks
+def replay(pluginboss, transport, filename, speed=0):
+    """Replays a recording through the plugins loaded by pluginboss and logs
+    the throughput. The IRCBotPlugin must have been loaded as an
+    irc.ReplayIRCBotPlugin.
+
+    """
+    ircplugin = pluginboss.loaded_plugins['irc.IRCBotPlugin']
+    count, elapsed = (yield replay_events(ircplugin, filename, speed))
+    log.msg("Replayed %d events in %.2f seconds (%.0f events/s)" % (
+        count, elapsed, count / elapsed if elapsed else 0))
+
+    try:
+        rows = (yield transport.issue_request("transport.stats", top=10))
+    except NotImplementedError:
+        pass
+    else:
+        for row in rows:
+            log.msg("{plugin} {kind} {name}: {count} calls, {total:.3f}s total, max {max:.4f}s".format(**row))
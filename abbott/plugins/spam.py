@@ -46,6 +46,9 @@ class Spam(CommandPluginSuperclass):
         # The config may have changed, and we may need a larger deque
         self._initdeque()
 
+    def privmsg_channels(self):
+        return [self.config['channel']]
+
     def _initdeque(self):
         LS_THRESH = self.config['LS_THRESH']
         REPEAT_THRESH = self.config['REPEAT_THRESH']
@@ -99,12 +102,14 @@ class Spam(CommandPluginSuperclass):
         else:
             self.config['channel'] = channel
             self.config.save()
+            self.update_privmsg_listener()
             event.reply("Spam detection is now on for {0}".format(channel))
 
     @require_channel
     def spamoff(self, event, match):
         channel = event.channel
         self.config['channel'] = None
+        self.update_privmsg_listener()
         event.reply("Spam detection is now off in {0}.".format(channel))
         self.config.save()
         
@@ -204,6 +209,10 @@ class ServerAd(pluginbase.EventWatcher, CommandPluginSuperclass):
     def reload(self):
         super(ServerAd, self).reload()
 
+    def privmsg_channels(self):
+        # For watch_user()
+        return [self.config['channel']]
+
     def start(self):
         super(ServerAd, self).start()
         self.listen_for_event("irc.on_user_joined")
@@ -232,12 +241,14 @@ class ServerAd(pluginbase.EventWatcher, CommandPluginSuperclass):
         else:
             self.config['channel'] = channel
             self.config.save()
+            self.update_privmsg_listener()
             event.reply("Server Ad detection is now on for {0}".format(channel))
 
     @require_channel
     def off(self, event, match):
         channel = event.channel
         self.config['channel'] = None
+        self.update_privmsg_listener()
         event.reply("Server ad detection is now off in {0}.".format(channel))
         self.config.save()
 
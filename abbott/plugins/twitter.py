@@ -70,6 +70,9 @@ class Twitter(CommandPluginSuperclass):
         super(Twitter, self).reload()
         self.tweets_processed.clear()
 
+    def privmsg_channels(self):
+        return self.config["channels"] or []
+
     def on_event_irc_on_privmsg(self, event):
         super(Twitter, self).on_event_irc_on_privmsg(event)
 
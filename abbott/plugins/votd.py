@@ -182,23 +182,37 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         if self.started:
             self._set_timer()
 
-        old_save = self.config.save
-        def add_probs_and_save():
-            # Add the probability to the saved config for convenience of
-            # external apps that may want to read this data but not have
-            # to calculate the odds themselves
-            total = 0
-            self.config['chance'] = {}
-            for name, count in self.config['counter'].items():
-                ecount = count * self.config['multipliers'][name] * self.config['scalefactor']
-                ecount = int(ecount)
-                self.config['chance'][name] = ecount
-                total += ecount
+        self.config.before_flush.append(self._add_probs)
+
+    def privmsg_channels(self):
+        return [self.config.get('channel')]
+
+    def _add_probs(self):
+        # Add the probability to the saved config for convenience of
+        # external apps that may want to read this data but not have
+        # to calculate the odds themselves. Done only when the config is
+        # actually written, not on every save(), and only the chances that
+        # changed are set, so only those are written
+        entries = self._effective_entries()
+        total = sum(entries.values())
+        chance = self.config.setdefault('chance', {})
+        for name in list(chance):
+            if name not in entries:
+                del chance[name]
+        for name, ecount in entries.items():
             if total:
-                for name, ecount in list(self.config['chance'].items()):
-                    self.config['chance'][name] = ecount / total
-            old_save()
-        self.config.save = add_probs_and_save
+                ecount = ecount / total
+            if chance.get(name) != ecount:
+                chance[name] = ecount
+
+    def _effective_entries(self):
+        """Returns a dict mapping each user in the counter to their number of
+        entries in the drawing
+
+        """
+        return dict((name, int(count * self.config['multipliers'][name] *
+                self.config['scalefactor']))
+                for name, count in self.config['counter'].items())
 
     def _set_timer(self):
         if self.timer:
@@ -225,6 +239,7 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         self.config["channel"] = channel
         self.config.save()
         self._set_timer()
+        self.update_privmsg_listener()
         event.reply("Done. Next scheduled drawing is {0} seconds".format(
                 find_time_until(self.config['hour']).seconds
             ))
@@ -235,6 +250,7 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         self.config["channel"] = None
         self.config.save()
         self._set_timer()
+        self.update_privmsg_listener()
         event.reply("Voice of the Day disabled for {0}".format(channel))
 
     @require_channel
@@ -566,14 +582,7 @@ class VoiceOfTheDay(EventWatcher, CommandPluginSuperclass):
         if user not in self.config['counter']:
             return
 
-        total = 0
-        for name, count in self.config['counter'].items():
-            # compute the effective entry count
-            ecount = count * self.config['multipliers'][name] * self.config['scalefactor']
-            ecount = int(ecount)
-            total += ecount
-
-        my_ecount = self.config['counter'][user] * self.config['multipliers'][user] * self.config['scalefactor']
-        my_chances = int(my_ecount) / total * 100
+        entries = self._effective_entries()
+        my_chances = entries[user] / sum(entries.values()) * 100
         event.reply(notice=True, direct=True, msg=u"{1} {0:.2f}% with {2} points and a multiplier of {3:.3f}".format(my_chances, msg, self.config['counter'][user], self.config['multipliers'][user]))
         event.reply(notice=True, direct=True, msg=msg2)
@@ -139,6 +139,9 @@ class WordOfTheDay(EventWatcher, CommandPluginSuperclass):
         if self.started:
             self._set_timer()
 
+    def privmsg_channels(self):
+        return [self.config['channel']]
+
     def _set_timer(self):
         if self.timer:
             self.timer.cancel()
@@ -219,16 +222,14 @@ class WordOfTheDay(EventWatcher, CommandPluginSuperclass):
         # De-voice anyone that still has it.
         # intersect current channel set with a set of current voices
         current_voices = set("+"+x for x in self.config['winners']) & names
-        reqs = []
-        for v in current_voices:
-            reqs.append(
-                    self.transport.issue_request("ircop.devoice", channel, v.lstrip("+"))
-                    )
+        devoiced = self.transport.issue_requests("ircop.devoice",
+                [(channel, v.lstrip("+")) for v in current_voices])
         self.config['winners'] = []
         self.winlines = []
         self.lastwintime = 0
-        for r in reqs:
-            yield r
+        for success, result in (yield devoiced):
+            if not success:
+                result.raiseException()
 
         # Announce what the winning word was.
         if self.config['theword']:
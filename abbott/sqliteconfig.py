@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+
+from twisted.internet import defer, reactor
+
+from .trackedconfig import REPLACED, TrackedPluginConfig
+
+"""
+An SQLite backing store for plugin configs, for plugins with large configs
+that change often, such as vote counters.
+
+Each top-level key of the config is one row of the "config" table, holding
+the value as json. A top-level key whose value is a dict can instead be given
+a table of its own, with one row per item of the dict, by listing it in
+tables. Only the rows of the keys and items that were changed since the
+config was last written are written, inside one transaction, so saving costs
+about the size of the change and not the size of the config. When the
+config is given the bot's IOExecutor, the database is only used from a
+Worker thread of its own, so commits never block the reactor.
+
+Plugins select this store in the "core" section of config.json:
+
+    "config_storage": {
+        "votd.VoiceOfTheDay": {
+            "engine": "sqlite",
+            "tables": ["counter", "multipliers", "win_counter"]
+        }
+    }
+
+The first time a plugin's config is loaded this way, its existing json file
+is copied into a new <plugin name>.sqlite file and renamed to
+<plugin name>.json.migrated. See PluginBoss.get_plugin_config().
+
+"""
+
+def _table_name(key):
+    return '"{0}"'.format(("table_" + key).replace('"', '""'))
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True)
+
+class SQLitePluginConfig(TrackedPluginConfig):
+    """A PluginConfig stored in an SQLite database. Saving works the same as
+    for PluginConfig, write-behind included. What to write is found out as
+    for abbott.trackedconfig.TrackedPluginConfig.
+
+    tables is a list of the top-level keys that are stored in tables of their
+    own. Such a key whose value is not a dict is stored as a row of the
+    config table instead, for as long as it is not a dict.
+
+    """
+    def __init__(self, dbfile, tables=(), interval=0, changes=1,
+            clock=reactor, io=None):
+        self._tables = frozenset(tables)
+        # Without an IOExecutor, the database is used right away from the
+        # calling thread, as by migrate()
+        self._worker = None if io is None else io.worker(dbfile)
+        self._db = self._run(self._connect, dbfile)
+
+        TrackedPluginConfig.__init__(self, dbfile, interval=interval,
+                changes=changes, clock=clock, io=io)
+
+    def _run(self, func, *args):
+        """Calls func(*args) in the worker thread, and waits for it"""
+        if self._worker is None:
+            return func(*args)
+        return self._worker.run(func, *args)
+
+    def _connect(self, dbfile):
+        db = sqlite3.connect(dbfile)
+        db.execute("CREATE TABLE IF NOT EXISTS config "
+                "(key TEXT PRIMARY KEY, value TEXT)")
+        return db
+
+    def _read(self):
+        return self._run(self._read_db)
+
+    def _read_db(self):
+        plain = dict(self._db.execute("SELECT key, value FROM config"))
+
+        data = dict((key, json.loads(value)) for key, value in plain.items())
+        existing = set(name for (name,) in self._db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"))
+        for key in self._tables:
+            # A row in the config table means the value was not a dict when
+            # it was last written, and the table is out of date
+            if "table_" + key not in existing or key in plain:
+                continue
+            data[key] = dict((subkey, json.loads(value)) for subkey, value in
+                    self._db.execute("SELECT key, value FROM {0}".format(
+                        _table_name(key))))
+        return data
+
+    def _write_changes(self, touched):
+        # (sql, rows) to pass to executemany, or (sql, None) to execute. The
+        # json is made here, so the thread only sees strings.
+        statements = []
+        for key, slots in touched.items():
+            value = self.data.get(key)
+            if key not in self._tables or not isinstance(value, dict):
+                if key in self.data:
+                    statements.append(("INSERT OR REPLACE INTO config "
+                            "(key, value) VALUES (?, ?)", [(key, _dumps(value))]))
+                else:
+                    statements.append(("DELETE FROM config WHERE key=?",
+                            [(key,)]))
+                if key in self._tables and slots is REPLACED:
+                    statements.append(("DROP TABLE IF EXISTS {0}".format(
+                        _table_name(key)), None))
+                continue
+
+            table = _table_name(key)
+            if slots is REPLACED:
+                statements.append(("DELETE FROM config WHERE key=?", [(key,)]))
+                statements.append(("DROP TABLE IF EXISTS {0}".format(table),
+                        None))
+                slots = value
+            statements.append(("CREATE TABLE IF NOT EXISTS {0} "
+                    "(key TEXT PRIMARY KEY, value TEXT)".format(table), None))
+            removed = [(subkey,) for subkey in slots if subkey not in value]
+            changed = [(subkey, _dumps(value[subkey])) for subkey in slots
+                    if subkey in value]
+            if removed:
+                statements.append(("DELETE FROM {0} WHERE key=?".format(table),
+                        removed))
+            if changed:
+                statements.append(("INSERT OR REPLACE INTO {0} "
+                        "(key, value) VALUES (?, ?)".format(table), changed))
+
+        if self._worker is None:
+            return self._commit(statements)
+        return self._worker.call(self._commit, statements)
+
+    def _commit(self, statements):
+        """Runs statements in one transaction"""
+        with self._db:
+            for sql, rows in statements:
+                if rows is None:
+                    self._db.execute(sql)
+                else:
+                    self._db.executemany(sql, rows)
+
+    def close(self):
+        """Writes any unwritten changes and closes the database, once they
+        are committed. Returns a deferred that fires once it is closed.
+
+        """
+        TrackedPluginConfig.close(self)
+        if self._worker is None:
+            self._db.close()
+            return defer.succeed(None)
+        return self._worker.call(self._db.close)
+
+def migrate(jsonfile, dbfile, tables=()):
+    """Copies the config in jsonfile into a new SQLite config in dbfile, and
+    renames jsonfile to jsonfile.migrated
+
+    """
+    with open(jsonfile, "r") as inp:
+        data = json.load(inp)
+
+    config = SQLitePluginConfig(dbfile, tables)
+    config.update(data)
+    config.save()
+    config.close()
+
+    os.rename(jsonfile, jsonfile + ".migrated")
@@ -0,0 +1,35 @@
+from twisted.internet import defer
+
+from abbott.journalconfig import JournalPluginConfig
+
+"""
+Stand-ins for the parts of a running bot that the tests don't need for real
+
+"""
+
+class StubConfig(dict):
+    def save(self):
+        pass
+
+class SyncJournalPluginConfig(JournalPluginConfig):
+    """Compacts without a thread pool"""
+    _in_thread = staticmethod(defer.maybeDeferred)
+
+class StubClient(object):
+    nickname = "abbott"
+
+class StubIRC(object):
+    client = StubClient()
+
+class StubBoss(object):
+    """Stands in for the PluginBoss. Plugins get a StubConfig, or what
+    plugin_config returns if it is given.
+
+    """
+    def __init__(self, prefix=None, plugin_config=None):
+        self.config = {"command": {"prefix": prefix}}
+        self.loaded_plugins = {"irc.IRCBotPlugin": StubIRC()}
+        self._plugin_config = plugin_config or StubConfig
+
+    def get_plugin_config(self, plugin_name, reread=False):
+        return self._plugin_config()
@@ -0,0 +1,494 @@
+import re
+import time
+import unittest
+
+from twisted.internet import defer, task
+
+from abbott import command
+from abbott.command import CommandPluginSuperclass, _Alternation, _RateLimiter
+from abbott.plugins.spam import ServerAd, Spam
+from abbott.test.stubs import StubBoss
+from abbott.transport import Transport, Event
+
+
+class StubAuth(object):
+    permissions = {}
+
+class Commands(CommandPluginSuperclass):
+    def start(self):
+        super(Commands, self).start()
+        self.calls = []
+        self.install_command(
+                cmdname="echo",
+                argmatch="(?P<text>.*)$",
+                callback=lambda event, match: self.calls.append(
+                    ("echo", match.group("text"))),
+                )
+        self.install_command(
+                cmdname="kick",
+                cmdmatch="kick|gtfo",
+                argmatch="(?P<nick>\\w+)$",
+                prefix=".",
+                callback=lambda event, match: self.calls.append(
+                    ("kick", match.group("nick"))),
+                )
+        group = self.install_cmdgroup(grpname="stats", helptext="Stats")
+        group.install_command(
+                cmdname="queue",
+                callback=lambda event, match: self.calls.append(("queue",)),
+                )
+
+class Watcher(CommandPluginSuperclass):
+    def start(self):
+        super(Watcher, self).start()
+        self.seen = []
+
+    def on_event_irc_on_privmsg(self, event):
+        super(Watcher, self).on_event_irc_on_privmsg(event)
+        self.seen.append(event.message)
+
+class ChannelWatcher(Watcher):
+    channels = ["#a"]
+
+    def privmsg_channels(self):
+        return self.channels
+
+class CountingSpam(Spam):
+    def start(self):
+        super(CountingSpam, self).start()
+        self.seen = []
+
+    def on_event_irc_on_privmsg(self, event):
+        self.seen.append(event.channel)
+        return super(CountingSpam, self).on_event_irc_on_privmsg(event)
+
+class TestCommandRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.boss = StubBoss(prefix="!")
+        self.plugin = Commands("test.Commands", self.transport, self.boss)
+        self.plugin.start()
+        self.replies = []
+
+    def privmsg(self, message, direct=False):
+        event = Event("irc.on_privmsg", message=message, direct=direct,
+                user="alice!a@example.com", channel="#test",
+                has_permission=lambda perm, channel: defer.succeed(True),
+                where_permission=lambda perm: defer.succeed([None]),
+                reply=lambda msg="", **kwargs: self.replies.append(msg))
+        self.transport.send_event(event)
+
+    def test_nick_prefix(self):
+        self.privmsg("abbott: echo hello there")
+        self.assertEqual([("echo", "hello there")], self.plugin.calls)
+
+    def test_global_prefix(self):
+        self.privmsg("!echo hi")
+        self.assertEqual([("echo", "hi")], self.plugin.calls)
+
+    def test_direct(self):
+        self.privmsg("echo hi", direct=True)
+        self.assertEqual([("echo", "hi")], self.plugin.calls)
+
+    def test_command_prefix_and_alternatives(self):
+        self.privmsg(".gtfo bob")
+        self.privmsg("!kick carol")
+        self.assertEqual([("kick", "bob"), ("kick", "carol")], self.plugin.calls)
+
+    def test_group(self):
+        self.privmsg("!stats queue")
+        self.assertEqual([("queue",)], self.plugin.calls)
+
+    def test_not_a_command(self):
+        self.privmsg("echo hi")
+        self.privmsg("!echoes")
+        self.privmsg("!nothing here")
+        self.assertEqual([], self.plugin.calls)
+        self.assertEqual([], self.replies)
+
+    def test_help(self):
+        self.privmsg("!help echo")
+        self.assertTrue(self.replies[0].startswith("Usage: !echo"))
+
+    def test_group_help(self):
+        self.privmsg("!help stats")
+        self.assertEqual(["Stats"], self.replies[:1])
+        del self.replies[:]
+        self.privmsg("!help statsfoo")
+        self.assertEqual([], self.replies)
+
+    def test_each_plugin_gets_its_commands(self):
+        other = Commands("test.Other", self.transport, self.boss)
+        other.start()
+        self.privmsg("!echo hi")
+        self.assertEqual([("echo", "hi")], self.plugin.calls)
+        self.assertEqual([("echo", "hi")], other.calls)
+
+    def test_unhook(self):
+        self.transport.unhook_plugin(self.plugin)
+        self.privmsg("!echo hi")
+        self.assertEqual([], self.plugin.calls)
+
+    def test_overridden_handler_sees_everything(self):
+        watcher = Watcher("test.Watcher", self.transport, self.boss)
+        watcher.start()
+        self.privmsg("just chatting")
+        self.privmsg("!echo hi")
+        self.assertEqual(["just chatting", "!echo hi"], watcher.seen)
+        self.assertEqual([("echo", "hi")], self.plugin.calls)
+
+    def test_first_matching_command_wins(self):
+        for argmatch in ("(?P<arg>\\d+)$", "(?P<arg>\\w+)$", "(?P<arg>.*)$"):
+            self.plugin.install_command(
+                    cmdname="add",
+                    argmatch=argmatch,
+                    callback=lambda event, match, argmatch=argmatch:
+                        self.plugin.calls.append((argmatch, match.group("arg"))),
+                    )
+        self.privmsg("!add 12")
+        self.assertEqual([("(?P<arg>\\d+)$", "12")], self.plugin.calls)
+        self.assertEqual([], self.replies)
+
+        # As before commands were combined, help for an earlier command that
+        # didn't match wins over a later command
+        self.privmsg("!add x")
+        self.assertEqual(1, len(self.plugin.calls))
+        self.assertTrue(self.replies[0].startswith("Usage: !add"))
+
+class TestAlternation(unittest.TestCase):
+
+    def test_first_in_order(self):
+        regexes = [re.compile("a(?P<x>b)$"), None, re.compile("a(?P<x>.)"),
+                re.compile("(?P<y>a)")]
+        alternation = _Alternation(regexes)
+        self.assertEqual(1, len(alternation.chunks))
+
+        pos, m = alternation.first("ab")
+        self.assertEqual(0, pos)
+        self.assertEqual("b", m.group("x"))
+
+        pos, m = alternation.first("ac")
+        self.assertEqual(2, pos)
+        self.assertEqual("c", m.group("x"))
+
+        pos, m = alternation.first("a")
+        self.assertEqual(3, pos)
+        self.assertEqual("a", m.group("y"))
+
+        self.assertEqual((None, None), alternation.first("b"))
+
+    def test_group_limit(self):
+        regexes = [re.compile("(a)(b)(c)%d$" % i) for i in range(100)]
+        alternation = _Alternation(regexes)
+        self.assertEqual(5, len(alternation.chunks))
+        for i in (0, 24, 25, 99):
+            pos, m = alternation.first("abc%d" % i)
+            self.assertEqual(i, pos)
+            self.assertEqual(("a", "b", "c"), m.groups())
+
+    def test_uncombinable(self):
+        regexes = [re.compile("a$"), re.compile("(?P<x>b)(?P=x)"),
+                re.compile("(b)\\1"), re.compile("bb")]
+        alternation = _Alternation(regexes)
+        self.assertEqual(4, len(alternation.chunks))
+        self.assertEqual(1, alternation.first("bb")[0])
+
+    def test_conditional_groups(self):
+        regexes = [re.compile("a$"), re.compile("(?P<x><)?b(?(x)>)$"),
+                re.compile("(<)?c(?(1)>)$"), re.compile("d")]
+        alternation = _Alternation(regexes)
+        self.assertEqual(4, len(alternation.chunks))
+        self.assertEqual(1, alternation.first("<b>")[0])
+        self.assertEqual(2, alternation.first("c")[0])
+        self.assertEqual(3, alternation.first("d")[0])
+
+    def test_compile_failure_fallback(self):
+        original = command._UNCOMBINABLE
+        command._UNCOMBINABLE = re.compile("(?!)")
+        self.addCleanup(setattr, command, "_UNCOMBINABLE", original)
+        regexes = [re.compile("a$"), re.compile("(?P<x><)?b(?(x)>)$"),
+                re.compile("c")]
+        alternation = _Alternation(regexes)
+        self.assertEqual(3, len(alternation.chunks))
+        self.assertEqual(0, alternation.first("a")[0])
+        pos, m = alternation.first("<b>")
+        self.assertEqual(1, pos)
+        self.assertEqual("<", m.group("x"))
+        self.assertEqual(2, alternation.first("c")[0])
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_burst_and_refill(self):
+        limiter = _RateLimiter({"rate": 0.5, "burst": 2}, self.clock)
+        user = "alice!a@example.com"
+        self.assertEqual(0, limiter.take(user, "odds"))
+        self.assertEqual(0, limiter.take(user, "odds"))
+        self.assertEqual(None, limiter.take(user, "odds"))
+        # Other commands and other users have buckets of their own
+        self.assertEqual(0, limiter.take(user, "whoami"))
+        self.assertEqual(0, limiter.take("bob!b@example.net", "odds"))
+        # A new nick from the same host doesn't get a new bucket
+        self.assertEqual(None, limiter.take("alice_!a@example.com", "odds"))
+
+        self.clock.advance(2)
+        self.assertEqual(0, limiter.take(user, "odds"))
+        self.assertEqual(None, limiter.take(user, "odds"))
+        self.assertEqual([dict(command="odds", dropped=3, delayed=0)],
+                limiter.summary())
+
+    def test_delay(self):
+        limiter = _RateLimiter({"rate": 1, "burst": 1, "delay": 2}, self.clock)
+        user = "alice!a@example.com"
+        self.assertEqual(0, limiter.take(user, "help"))
+        self.assertEqual(1, limiter.take(user, "help"))
+        self.assertEqual(2, limiter.take(user, "help"))
+        self.assertEqual(None, limiter.take(user, "help"))
+        self.assertEqual([dict(command="help", dropped=1, delayed=2)],
+                limiter.summary())
+
+    def test_per_command_limits(self):
+        limiter = _RateLimiter({"rate": 1, "burst": 1,
+            "commands": {"help": {"burst": 3}}}, self.clock)
+        user = "alice!a@example.com"
+        self.assertEqual([0, 0, 0, None],
+                [limiter.take(user, "help") for _ in range(4)])
+        self.assertEqual([0, None],
+                [limiter.take(user, "odds") for _ in range(2)])
+
+    def test_eviction(self):
+        limiter = _RateLimiter({"rate": 1, "burst": 2, "size": 3}, self.clock)
+        for i in range(5):
+            limiter.take("user!u@host%d" % i, "odds")
+        self.assertEqual(3, len(limiter.buckets))
+        self.assertEqual([("u@host%d" % i, "odds") for i in (2, 3, 4)],
+                list(limiter.buckets))
+
+        # Buckets that have filled up again are forgotten
+        self.clock.advance(1)
+        limiter.take("user!u@host5", "odds")
+        self.assertEqual([("u@host5", "odds")], list(limiter.buckets))
+
+class TestCommandRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(self.clock)
+        self.boss = StubBoss(prefix="!")
+        self.boss.config["command"]["ratelimit"] = {"rate": 1, "burst": 1,
+                "delay": 1}
+        self.plugin = Commands("test.Commands", self.transport, self.boss)
+        self.plugin.start()
+        self.replies = []
+
+    privmsg = TestCommandRouter.__dict__["privmsg"]
+
+    def test_throttled(self):
+        for i in range(3):
+            self.privmsg("!echo %d" % i)
+        self.assertEqual([("echo", "0")], self.plugin.calls)
+        self.clock.advance(1)
+        self.assertEqual([("echo", "0"), ("echo", "1")], self.plugin.calls)
+
+        # Help for any command counts against "help"
+        self.privmsg("!help echo")
+        self.privmsg("!help stats")
+        self.privmsg("!help stats")
+        self.assertEqual(["Usage: !echo"], [reply[:12] for reply in
+            self.replies if reply.startswith("Usage:")])
+        self.clock.advance(1)
+        self.assertEqual(["Stats"], [reply for reply in self.replies
+            if reply == "Stats"])
+
+        rows = []
+        self.transport.issue_request("command.ratelimit").addCallback(
+                rows.extend)
+        self.assertEqual([
+            dict(command="echo", dropped=1, delayed=1),
+            dict(command="help", dropped=1, delayed=1),
+            ], rows)
+
+    def test_turned_off(self):
+        del self.boss.config["command"]["ratelimit"]
+        self.plugin.reload()
+        for i in range(3):
+            self.privmsg("!echo %d" % i)
+        self.assertEqual(3, len(self.plugin.calls))
+        failures = []
+        self.transport.issue_request("command.ratelimit").addErrback(
+                failures.append)
+        failures[0].trap(NotImplementedError)
+
+class TestCommandStats(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(self.clock)
+        self.boss = StubBoss(prefix="!")
+        self.boss.config["command"]["stats"] = {"slow": 0, "keep": 2}
+        self.plugin = Commands("test.Commands", self.transport, self.boss)
+        self.plugin.start()
+        self.replies = []
+
+        self.pending = []
+        self.plugin.install_command(cmdname="later",
+                callback=lambda event, match: self.pending.append(
+                    defer.Deferred()) or self.pending[-1])
+        self.plugin.install_command(cmdname="secret", permission="admin",
+                callback=lambda event, match: self.fail())
+
+    def privmsg(self, message, allowed=True):
+        event = Event("irc.on_privmsg", message=message, direct=False,
+                user="alice!a@example.com", channel="#test",
+                has_permission=lambda perm, channel: defer.succeed(allowed),
+                reply=lambda msg="", **kwargs: self.replies.append(msg))
+        self.transport.send_event(event)
+
+    def stats(self):
+        result = []
+        self.transport.issue_request("command.stats").addCallback(
+                result.append)
+        stats = result[0]
+        return dict((row['command'], row) for row in stats['commands']), stats['slow']
+
+    def test_counts(self):
+        self.privmsg("!echo hi")
+        self.privmsg("!echo again")
+        commands, slow = self.stats()
+        self.assertEqual(["echo"], list(commands))
+        self.assertEqual(2, commands["echo"]['calls'])
+        self.assertEqual(0, commands["echo"]['denied'])
+        self.assertEqual(2, len(slow))
+        self.assertEqual("echo", slow[-1]['command'])
+        self.assertEqual("alice!a@example.com", slow[-1]['user'])
+
+    def test_deferred_timed_until_it_fires(self):
+        self.privmsg("!later")
+        commands, slow = self.stats()
+        self.assertNotIn("later", commands)
+
+        self.pending[0].callback(None)
+        commands, slow = self.stats()
+        self.assertEqual(1, commands["later"]['calls'])
+
+        self.privmsg("!later")
+        failures = []
+        self.pending[1].errback(ValueError())
+        self.pending[1].addErrback(failures.append)
+        commands, slow = self.stats()
+        self.assertEqual(2, commands["later"]['calls'])
+        self.assertEqual(1, commands["later"]['failed'])
+        # The failure is passed on
+        self.assertEqual(1, len(failures))
+
+    def test_denied(self):
+        self.boss.loaded_plugins['auth.Auth'] = StubAuth()
+        self.privmsg("!secret", allowed=False)
+        commands, slow = self.stats()
+        self.assertEqual(1, commands["secret"]['calls'])
+        self.assertEqual(1, commands["secret"]['denied'])
+        self.assertEqual(0, commands["secret"]['p50'])
+        self.assertEqual([], slow)
+        self.assertEqual(["Sorry, you don't have access to that command"],
+                self.replies)
+
+class TestCommandAccounting(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(self.clock)
+        self.transport.configure({"core": {"transport": {
+            "stats": True,
+            "breaker": {"slow": 0.01, "slow_calls": 2},
+            }}})
+        self.boss = StubBoss(prefix="!")
+        self.slow = Commands("test.Slow", self.transport, self.boss)
+        self.slow.start()
+        self.slow.install_command(cmdname="slow",
+                callback=lambda event, match: time.sleep(0.02))
+        self.fast = Commands("test.Fast", self.transport, self.boss)
+        self.fast.start()
+        self.replies = []
+
+    privmsg = TestCommandRouter.__dict__["privmsg"]
+
+    def test_slow_plugin_does_not_stop_others(self):
+        self.privmsg("!slow")
+        self.privmsg("!slow")
+        self.privmsg("!echo hi")
+
+        health = self.transport._health
+        self.assertIn(self.slow, health.tripped)
+        self.assertEqual([], [obj for obj in health.tripped
+            if obj is not self.slow])
+        # The tripped plugin is skipped; the others still get commands
+        self.assertEqual([("echo", "hi")], self.fast.calls)
+        self.assertEqual([], self.slow.calls)
+        self.privmsg("!echo again")
+        self.assertEqual([], self.slow.calls)
+        self.assertEqual([("echo", "hi"), ("echo", "again")], self.fast.calls)
+
+        # The time is charged to the plugin, not the router
+        rows = dict((row['plugin'], row) for row in
+                self.transport._stats.summary())
+        self.assertGreaterEqual(rows["test.Slow"]['total'], 0.04)
+        self.assertLess(rows["command.CommandRouter"]['total'], 0.02)
+
+
+class TestPrivmsgChannels(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.boss = StubBoss(prefix="!")
+
+    def privmsg(self, message, channel):
+        event = Event("irc.on_privmsg", message=message, direct=False,
+                user="alice!a@example.com", channel=channel,
+                has_permission=lambda perm, channel: defer.succeed(True),
+                where_permission=lambda perm: defer.succeed([None]),
+                reply=lambda msg="", **kwargs: None)
+        self.transport.send_event(event)
+
+    def test_only_listed_channels(self):
+        plugin = ChannelWatcher("test.ChannelWatcher", self.transport, self.boss)
+        plugin.start()
+        self.privmsg("one", "#a")
+        self.privmsg("two", "#b")
+        self.assertEqual(["one"], plugin.seen)
+
+        plugin.channels = ["#b"]
+        plugin.update_privmsg_listener()
+        self.privmsg("three", "#a")
+        self.privmsg("four", "#b")
+        self.assertEqual(["one", "four"], plugin.seen)
+
+    def test_spam_channel(self):
+        plugin = CountingSpam("spam.Spam", self.transport, self.boss)
+        plugin.start()
+        self.privmsg("hello", "#test")
+        self.assertEqual([], plugin.seen)
+
+        self.privmsg("!spam on", "#test")
+        self.privmsg("hello", "#other")
+        self.privmsg("hello", "#test")
+        self.assertEqual(["#test"], plugin.seen)
+
+        self.privmsg("!spam off", "#test")
+        self.privmsg("hello", "#test")
+        self.assertEqual(["#test"], plugin.seen)
+
+    def test_serverad_channel(self):
+        # The command router parses commands, so ServerAd is only subscribed
+        # to irc.on_privmsg for watch_user() if it asks to be
+        plugin = ServerAd("spam.ServerAd", self.transport, self.boss)
+        plugin.start()
+        self.privmsg("!serverad on", "#test")
+        seen = []
+        plugin.wait_for(Event("irc.on_privmsg", channel="#test")
+                ).addCallback(seen.append)
+        self.privmsg("hello", "#other")
+        self.privmsg("hello", "#test")
+        self.assertEqual(["#test"], [event.channel for event in seen])
@@ -0,0 +1,77 @@
+import unittest
+
+from twisted.internet import defer
+
+from abbott.plugins.corecontrol import Help
+from abbott.transport import Transport, Event
+from abbott.test.stubs import StubBoss
+from abbott.test.test_command import Commands
+
+class TestHelp(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.boss = StubBoss(prefix="!")
+        self.help = Help("corecontrol.Help", self.transport, self.boss)
+        self.commands = Commands("test.Commands", self.transport, self.boss)
+        self.boss.loaded_plugins["corecontrol.Help"] = self.help
+        self.boss.loaded_plugins["test.Commands"] = self.commands
+        self.help.start()
+        self.commands.start()
+
+        # maps permissions to where_permission() answers
+        self.where = {None: [None]}
+        self.lookups = []
+
+    def where_permission(self, permission):
+        self.lookups.append(permission)
+        return defer.succeed(self.where.get(permission, []))
+
+    def ask(self):
+        replies = []
+        event = Event("irc.on_privmsg", message="!help", direct=False,
+                user="alice!a@example.com", channel="#test",
+                has_permission=lambda perm, channel: defer.succeed(True),
+                where_permission=self.where_permission,
+                get_authname=lambda: defer.succeed("alice"),
+                reply=lambda msg="", **kwargs: replies.append(msg))
+        self.transport.send_event(event)
+        return replies
+
+    def test_listing(self):
+        replies = self.ask()
+        self.assertIn("Global commands you have access to: help, echo, kick, stats",
+                replies)
+        # Each permission is looked up once
+        self.assertEqual([None], self.lookups)
+
+    def test_cached(self):
+        first = self.ask()
+        self.ask()
+        self.assertEqual(1, len(self.lookups))
+        self.assertEqual(first, self.ask())
+
+    def test_permissions_changed(self):
+        group = self.commands.install_cmdgroup(grpname="admin",
+                permission="admin")
+        group.install_command(cmdname="reload", callback=lambda e, m: None)
+        self.assertNotIn("admin", self.ask()[1])
+
+        self.where["admin"] = ["#test"]
+        self.ask()
+        self.assertEqual(2, len(self.lookups))
+
+        self.transport.send_event(Event("auth.permissions_changed"))
+        self.assertIn("In #test you can execute: admin", self.ask())
+
+    def test_commands_changed(self):
+        self.ask()
+        self.commands.install_command(cmdname="ping",
+                callback=lambda e, m: None)
+        self.assertIn("Global commands you have access to: help, echo, kick, ping, stats",
+                self.ask())
+
+        self.transport.unhook_plugin(self.commands)
+        del self.boss.loaded_plugins["test.Commands"]
+        self.assertIn("Global commands you have access to: help",
+                self.ask())
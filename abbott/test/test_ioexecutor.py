@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from twisted.internet import defer
+
+from abbott.ioexecutor import IOExecutor, Worker, write_file
+
+
+class HeldThread(object):
+    """Stands in for deferToThread. Runs nothing until release() is called,
+    so the tests can see what is waiting.
+
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, func, *args):
+        d = defer.Deferred()
+        self.calls.append((func, args, d))
+        return d
+
+    def release(self):
+        func, args, d = self.calls.pop(0)
+        try:
+            func(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(None)
+
+
+class TestIOExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "test.json")
+        self.thread = HeldThread()
+        self.io = IOExecutor(self.thread)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def contents(self):
+        with open(self.filename) as inp:
+            return inp.read()
+
+    def test_write(self):
+        done = []
+        self.io.write(self.filename, "one").addCallback(done.append)
+        self.assertFalse(os.path.exists(self.filename))
+        self.thread.release()
+        self.assertEqual("one", self.contents())
+        self.assertEqual([None], done)
+
+    def test_coalesces_while_writing(self):
+        done = []
+        for text in ("one", "two", "three"):
+            self.io.write(self.filename, text).addCallback(
+                    lambda _, text=text: done.append(text))
+        self.assertEqual(1, len(self.thread.calls))
+        self.assertEqual("three", self.io.read(self.filename))
+
+        self.thread.release()
+        self.assertEqual("one", self.contents())
+        self.assertEqual(["one"], done)
+        self.assertEqual(1, len(self.thread.calls))
+        self.thread.release()
+        self.assertEqual("three", self.contents())
+        self.assertEqual(["one", "two", "three"], done)
+
+    def test_files_are_independent(self):
+        other = os.path.join(self.dir, "other.json")
+        self.io.write(self.filename, "one")
+        self.io.write(other, "two")
+        self.assertEqual(2, len(self.thread.calls))
+
+    def test_failure(self):
+        failures = []
+        missing = os.path.join(self.dir, "nodir", "test.json")
+        self.io.write(missing, "one").addErrback(failures.append)
+        self.thread.release()
+        self.assertEqual(1, len(failures))
+        self.assertEqual({}, self.io._writing)
+
+    def test_wait(self):
+        waited = []
+        self.io.wait().addCallback(waited.append)
+        self.assertEqual(1, len(waited))
+
+        self.io.write(self.filename, "one")
+        self.io.write(self.filename, "two")
+        self.io.wait().addCallback(waited.append)
+        self.thread.release()
+        self.assertEqual(1, len(waited))
+        self.thread.release()
+        self.assertEqual(2, len(waited))
+
+    def test_write_file_replaces(self):
+        write_file(self.filename, "one")
+        write_file(self.filename, "two")
+        self.assertEqual("two", self.contents())
+        self.assertEqual(["test.json"], os.listdir(self.dir))
+
+    def test_before_reactor_runs(self):
+        # The reactor is not running in these tests, so nothing may be left
+        # for a thread that would never start
+        done = []
+        IOExecutor().write(self.filename, "one").addCallback(done.append)
+        self.assertEqual("one", self.contents())
+        self.assertEqual([None], done)
+
+
+class TestWorker(unittest.TestCase):
+
+    def test_runs_in_order_in_its_thread(self):
+        worker = Worker("test")
+        threads = []
+        for n in range(3):
+            worker.call(lambda n=n: threads.append(
+                (n, threading.current_thread().name)))
+        self.assertEqual("done", worker.run(lambda: "done"))
+        self.assertEqual([(0, "test"), (1, "test"), (2, "test")], threads)
+
+    def test_exception(self):
+        worker = Worker("test")
+        self.assertRaises(ZeroDivisionError, worker.run, lambda: 1 // 0)
+        failures = []
+        worker.call(lambda: 1 // 0).addErrback(failures.append)
+        self.assertEqual(1, len(failures))
+        self.assertEqual(2, worker.run(lambda: 2))
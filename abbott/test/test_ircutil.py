@@ -0,0 +1,30 @@
+import unittest
+
+from twisted.internet import task
+
+from abbott.plugins.ircutil import _names_invalidated, _whois_invalidated
+from abbott.transport import Event, RequestCache
+
+
+class TestInvalidation(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = RequestCache("irc.names", {}, task.Clock())
+        self.cache.store("#a", ["@Alice", "bob"], 0)
+        self.cache.store("#b", ["+carol"], 0)
+
+    def test_whois(self):
+        event = Event("irc.on_nick_change", oldnick="Alice", newnick="Al")
+        self.assertEqual(["alice", "al"], _whois_invalidated(event, None))
+        event = Event("irc.on_user_quit", user="Bob", message="bye")
+        self.assertEqual(["bob"], _whois_invalidated(event, None))
+
+    def test_names_on_channel(self):
+        event = Event("irc.on_user_part", user="bob", channel="#A")
+        self.assertEqual(["#a"], _names_invalidated(event, self.cache))
+
+    def test_names_of_channels_user_is_in(self):
+        event = Event("irc.on_user_quit", user="alice", message="bye")
+        self.assertEqual(["#a"], _names_invalidated(event, self.cache))
+        event = Event("irc.on_nick_change", oldnick="Carol", newnick="c")
+        self.assertEqual(["#b"], _names_invalidated(event, self.cache))
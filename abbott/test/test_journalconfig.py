@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import defaultdict
+
+from abbott.ioexecutor import IOExecutor
+from abbott.journalconfig import JournalPluginConfig
+from abbott.test.stubs import SyncJournalPluginConfig
+
+
+class TestJournalPluginConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.jsonfile = os.path.join(self.dir, "test.Plugin.json")
+        self.journalfile = os.path.join(self.dir, "test.Plugin.journal")
+        with open(self.jsonfile, "w") as out:
+            json.dump({"counter": {"alice": 1}, "laters": [[1, "a"]]}, out)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, compact_after=1000):
+        return SyncJournalPluginConfig(self.jsonfile, compact_after=compact_after)
+
+    def journal(self):
+        with open(self.journalfile) as inp:
+            return [json.loads(line) for line in inp]
+
+    def snapshot(self):
+        with open(self.jsonfile) as inp:
+            return json.load(inp)
+
+    def test_records_changes_only(self):
+        config = self.open()
+        config['counter']['alice'] += 1
+        config['counter']['bob'] = 1
+        config['laters'].append([2, "b"])
+        config.save()
+        self.assertEqual(sorted([
+            ["set", ["counter", "alice"], 2],
+            ["set", ["counter", "bob"], 1],
+            ["splice", ["laters"], 1, [[2, "b"]]],
+            ]), sorted(self.journal()))
+        self.assertEqual({"counter": {"alice": 1}, "laters": [[1, "a"]]},
+                self.snapshot())
+
+    def test_replay(self):
+        config = self.open()
+        config['counter']['alice'] += 1
+        config['laters'] = []
+        config['new'] = True
+        config.save()
+        del config['counter']['alice']
+        del config['new']
+        config.save()
+        expected = dict(config)
+        config.close()
+        self.assertEqual(expected, dict(self.open()))
+
+    def test_truncated_record(self):
+        config = self.open()
+        config['counter']['alice'] = 5
+        config.save()
+        config.close()
+        with open(self.journalfile, "a") as out:
+            out.write('["set",["counter","alice"],')
+        self.assertEqual(5, self.open()['counter']['alice'])
+
+    def test_nested_change(self):
+        config = self.open()
+        config['opmethod'] = defaultdict(dict)
+        config.save()
+        config['opmethod']['#chan']['op'] = "chanserv"
+        config.save()
+        self.assertEqual(["set", ["opmethod", "#chan"], {"op": "chanserv"}],
+                self.journal()[-1])
+
+    def test_torn_record_then_more(self):
+        config = self.open()
+        config['counter']['alice'] = 5
+        config.save()
+        config.close()
+        with open(self.journalfile, "a") as out:
+            out.write('["set",["counter","alice"],')
+
+        config = self.open()
+        config['counter']['bob'] = 2
+        config.save()
+        config.close()
+        self.assertEqual({"alice": 5, "bob": 2}, self.open()['counter'])
+
+    def test_bad_record_skipped(self):
+        with open(self.journalfile + ".1", "w") as out:
+            out.write('["del",["counter"]]\n'
+                    '["set",["counter","alice"],2]\n'
+                    '["set",["laters"],[]]\n')
+        self.assertEqual({"laters": []}, dict(self.open()))
+
+    def test_compaction(self):
+        config = self.open(compact_after=2)
+        config['counter']['alice'] = 2
+        config.save()
+        config['counter']['bob'] = 3
+        config.save()
+        self.assertEqual({"alice": 2, "bob": 3}, self.snapshot()['counter'])
+        self.assertEqual([], self.journal())
+        self.assertFalse(os.path.exists(self.journalfile + ".1"))
+        self.assertEqual(0, config.records)
+
+    def test_interrupted_compaction(self):
+        config = self.open()
+        config['counter']['alice'] = 2
+        config.save()
+        config.close()
+        os.rename(self.journalfile, self.journalfile + ".1")
+
+        config = self.open()
+        self.assertEqual(2, config['counter']['alice'])
+        self.assertEqual(2, self.snapshot()['counter']['alice'])
+        self.assertFalse(os.path.exists(self.journalfile + ".1"))
+
+    def test_worker_thread(self):
+        io = IOExecutor()
+        threads = []
+        class ThreadRecordingConfig(JournalPluginConfig):
+            def _append(self, lines):
+                threads.append(threading.current_thread())
+                JournalPluginConfig._append(self, lines)
+        config = ThreadRecordingConfig(self.jsonfile, compact_after=2, io=io)
+        config['counter']['alice'] = 2
+        config.save()
+        config['counter']['bob'] = 3
+        config.save()
+        config.close()
+        self.assertEqual(2, len(threads))
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual({"alice": 2, "bob": 3}, self.snapshot()['counter'])
+        self.assertFalse(os.path.exists(self.journalfile + ".1"))
+
+        config = JournalPluginConfig(self.jsonfile, io=io)
+        self.assertEqual({"alice": 2, "bob": 3}, config['counter'])
+        config.close()
+
+    def test_keys_as_in_snapshot(self):
+        config = self.open()
+        config[5] = True
+        config['counter'][7] = 2
+        config.save()
+        replayed = dict(self.open())
+        config.compact()
+        self.assertEqual(self.snapshot(), replayed)
+        self.assertEqual(2, replayed['counter']["7"])
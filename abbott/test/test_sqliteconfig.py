@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from abbott.ioexecutor import IOExecutor
+from abbott.sqliteconfig import SQLitePluginConfig, migrate
+
+
+class TestSQLitePluginConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.dir, "test.Plugin.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self):
+        return SQLitePluginConfig(self.dbfile, tables=["counter"])
+
+    def rows(self, table):
+        db = sqlite3.connect(self.dbfile)
+        try:
+            return dict(db.execute("SELECT key, value FROM " + table))
+        finally:
+            db.close()
+
+    def test_round_trip(self):
+        config = self.open()
+        config['channel'] = "#test"
+        config['counter'] = {"alice": 3, "bob": 1}
+        config.save()
+        config.close()
+
+        config = self.open()
+        self.assertEqual({"channel": "#test", "counter": {"alice": 3, "bob": 1}},
+                dict(config))
+        self.assertEqual({"alice": "3", "bob": "1"}, self.rows("table_counter"))
+        self.assertEqual({"channel": '"#test"'}, self.rows("config"))
+
+    def test_writes_only_changes(self):
+        config = self.open()
+        config['counter'] = {"alice": 3, "bob": 1}
+        config.save()
+
+        statements = []
+        config._db.set_trace_callback(statements.append)
+        config['counter']['alice'] += 1
+        config.save()
+        writes = [s for s in statements if s.startswith(("INSERT", "DELETE"))]
+        self.assertEqual(1, len(writes))
+        self.assertIn("'alice'", writes[0])
+
+    def test_replaced_table(self):
+        config = self.open()
+        config['counter'] = {"alice": 3, "bob": 1}
+        config.save()
+        config['counter'] = {"carol": {"wins": 1}}
+        config.save()
+        config['counter']['carol']['wins'] += 1
+        config.save()
+        self.assertEqual({"carol": '{"wins": 2}'}, self.rows("table_counter"))
+
+    def test_deletes(self):
+        config = self.open()
+        config['counter'] = {"alice": 3, "bob": 1}
+        config['channel'] = None
+        config.save()
+        del config['counter']['bob']
+        del config['channel']
+        config.save()
+        self.assertEqual({"alice": "3"}, self.rows("table_counter"))
+        self.assertEqual({}, self.rows("config"))
+
+    def test_table_key_not_a_dict(self):
+        config = self.open()
+        config['counter'] = {"alice": 3}
+        config.save()
+        config['counter'] = None
+        config.save()
+        config.close()
+        self.assertIsNone(self.open()['counter'])
+
+    def test_worker_thread(self):
+        # The connection is made in the worker's thread, so sqlite3 raises if
+        # it is used from any other
+        io = IOExecutor()
+        config = SQLitePluginConfig(self.dbfile, ["counter"], io=io)
+        config['counter'] = {"alice": 3}
+        config.save()
+        config['counter']['alice'] += 1
+        config.save()
+        config.close()
+
+        config = SQLitePluginConfig(self.dbfile, ["counter"], io=io)
+        self.assertEqual({"alice": 4}, config['counter'])
+        config.close()
+
+    def test_migrate(self):
+        jsonfile = os.path.join(self.dir, "test.Plugin.json")
+        with open(jsonfile, "w") as out:
+            json.dump({"counter": {"alice": 2}, "hour": [12, 0]}, out)
+        migrate(jsonfile, self.dbfile, ["counter"])
+
+        self.assertFalse(os.path.exists(jsonfile))
+        self.assertTrue(os.path.exists(jsonfile + ".migrated"))
+        self.assertEqual({"counter": {"alice": 2}, "hour": [12, 0]},
+                dict(self.open()))
@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import defaultdict
+
+from twisted.internet import task
+
+from abbott.trackedconfig import REPLACED, TrackedPluginConfig
+
+
+class RecordingConfig(TrackedPluginConfig):
+    def _write_changes(self, touched):
+        self.written.append(touched)
+
+
+class TestTrackedPluginConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        jsonfile = os.path.join(self.dir, "test.Plugin.json")
+        with open(jsonfile, "w") as out:
+            json.dump({"counter": {"alice": 1, "bob": {"wins": 0}},
+                "laters": [[1, "a"], [2, "b"], [3, "c"]], "channel": "#a"}, out)
+        self.config = RecordingConfig(jsonfile)
+        self.config.written = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def touched(self):
+        self.config.save()
+        return self.config.written[-1]
+
+    def test_dict_items(self):
+        self.config['counter']['alice'] += 1
+        self.config['counter']['bob']['wins'] += 1
+        self.config['counter'].pop("carol", None)
+        self.assertEqual({"counter": set(["alice", "bob"])}, self.touched())
+
+    def test_list_lowest_index(self):
+        self.config['laters'].append([4, "d"])
+        self.config['laters'][1][1] = "B"
+        self.assertEqual({"laters": set([1, 3])}, self.touched())
+        del self.config['laters'][0]
+        self.config['laters'][0].append(True)
+        self.assertEqual({"laters": set([0])}, self.touched())
+
+    def test_replaced(self):
+        self.config['channel'] = "#b"
+        del self.config['counter']
+        self.config['laters'] = []
+        self.config['laters'].append(1)
+        self.assertEqual({"channel": REPLACED, "counter": REPLACED,
+            "laters": REPLACED}, self.touched())
+
+    def test_detached_values_ignored(self):
+        old = self.config['laters'][0]
+        self.config['laters'][0] = [0, "z"]
+        self.touched()
+        old.append(True)
+        counter = self.config.pop('counter')
+        self.touched()
+        counter['alice'] = 5
+        self.assertEqual({}, self.touched())
+
+    def test_defaultdict(self):
+        self.config['groups'] = defaultdict(list)
+        self.touched()
+        self.config['groups']['alice'].append("admins")
+        self.assertEqual({"groups": set(["alice"])}, self.touched())
+        self.assertEqual({"alice": ["admins"]}, self.config['groups'])
+
+    def test_failed_write_kept(self):
+        def fail(touched):
+            raise IOError("disk full")
+        self.config.interval = 30
+        self.config.changes = 2
+        self.config._clock = task.Clock()
+        self.config._write_changes = fail
+        done = []
+        self.config['counter']['alice'] = 2
+        self.config.save().addBoth(done.append)
+        self.assertRaises(IOError, self.config.save)
+        self.assertEqual([], done)
+        del self.config._write_changes
+        self.config['counter']['bob'] = 3
+        self.assertEqual({"counter": set(["alice", "bob"])}, self.touched())
+        # The save() from before the failed write fired once it was stored
+        self.assertEqual([None], done)
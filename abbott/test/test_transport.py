@@ -0,0 +1,845 @@
+import unittest
+
+from twisted.internet import task, defer
+
+from abbott.transport import Transport, Event, SubscriptionTrie, Histogram, \
+        RequestTimedOut, RequestOverloaded
+from abbott.pluginbase import BotPlugin
+from abbott.test.stubs import StubBoss
+
+
+class Recorder(object):
+    """A stand-in for a plugin that records every event it receives"""
+    def __init__(self, plugin_name="test.Recorder"):
+        self.plugin_name = plugin_name
+        self.received = []
+
+    def received_event(self, event):
+        self.received.append(event.eventtype)
+
+    def received_middleware_event(self, event):
+        self.received.append("middleware:" + event.eventtype)
+        return event
+
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.plugin = Recorder()
+
+    def test_exact_name(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_notice"))
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_globs_do_not_transcend_dots(self):
+        self.transport.listen_for_event("irc.on_*", self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.do_msg"))
+        self.transport.send_event(Event("irc.on_privmsg.extra"))
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_all_events(self):
+        self.transport.listen_for_event("*.*", self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("ircutil.hasop.acquired"))
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_glob_chars_are_literal(self):
+        self.transport.listen_for_event("irc.on_priv+msg", self.plugin)
+        self.transport.send_event(Event("irc.on_privvmsg"))
+        self.assertEqual([], self.plugin.received)
+
+    def test_middleware_before_listeners(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin)
+        self.transport.install_middleware("irc.*", self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(["middleware:irc.on_privmsg", "irc.on_privmsg"],
+                self.plugin.received)
+
+    def test_middleware_globs_skip_spaces(self):
+        # As they always have, unlike those of listeners
+        self.transport.install_middleware("irc.*", self.plugin)
+        self.transport.install_middleware("irc.on_*", self.plugin)
+        self.transport.listen_for_event("irc.*", self.plugin)
+        self.transport.send_event(Event("irc.on_two words"))
+        self.assertEqual(["irc.on_two words"], self.plugin.received)
+
+    def test_cached_route_sees_new_listeners(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+
+        other = Recorder()
+        self.transport.listen_for_event("irc.on_*", other)
+        self.transport.send_event(Event("irc.on_privmsg"))
+
+        self.assertEqual(["irc.on_privmsg"] * 2, self.plugin.received)
+        self.assertEqual(["irc.on_privmsg"], other.received)
+
+    def test_unhook(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.unhook_plugin(self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_unhook_prunes(self):
+        other = Recorder()
+        self.transport.listen_for_event("irc.on_*", self.plugin)
+        self.transport.listen_for_event("irc.on_*", other)
+        self.transport.install_middleware("irc.do_*", self.plugin)
+        self.transport.unhook_plugin(self.plugin)
+
+        self.assertNotIn("irc.do_*", self.transport._middleware_listeners)
+        self.assertNotIn("irc.do_*", self.transport._middleware_trie)
+        self.assertIn("irc.on_*", self.transport._event_trie)
+        self.assertNotIn(self.plugin, self.transport._subscriptions)
+
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(["irc.on_privmsg"], other.received)
+        self.assertEqual([], self.plugin.received)
+
+    def test_unhooked_by_earlier_listener(self):
+        transport = self.transport
+        victim = Recorder()
+
+        class Unhooker(Recorder):
+            def received_event(self, event):
+                transport.unhook_plugin(victim)
+
+        transport.listen_for_event("irc.on_privmsg", Unhooker())
+        transport.listen_for_event("irc.*", victim)
+        transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual([], victim.received)
+
+    def test_subscribed_by_earlier_listener(self):
+        transport = self.transport
+        latecomer = Recorder()
+
+        class Subscriber(Recorder):
+            def received_event(self, event):
+                transport.listen_for_event("irc.on_privmsg", latecomer)
+
+        transport.listen_for_event("irc.on_privmsg", Subscriber())
+        transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual([], latecomer.received)
+        transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(["irc.on_privmsg"], latecomer.received)
+
+    def test_middleware_swallows_event(self):
+        class Swallower(Recorder):
+            def received_middleware_event(self, event):
+                return None
+
+        self.transport.install_middleware("irc.on_privmsg", Swallower())
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual([], self.plugin.received)
+
+
+class TestConstraints(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.plugin = Recorder()
+
+    def send(self, **kwargs):
+        self.transport.send_event(Event("irc.on_privmsg", **kwargs))
+
+    def test_single_constraint(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin,
+                channel="#minecraft")
+        self.send(channel="#minecraft")
+        self.send(channel="#other")
+        self.send()
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_multiple_constraints(self):
+        self.transport.listen_for_event("irc.*", self.plugin,
+                channel="#minecraft", direct=False)
+        self.send(channel="#minecraft", direct=False)
+        self.send(channel="#minecraft", direct=True)
+        self.send(channel="#minecraft")
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_delivered_once(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin,
+                channel="#minecraft")
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin,
+                direct=False)
+        self.send(channel="#minecraft", direct=False)
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_unhashable_attribute(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin,
+                channel="#minecraft")
+        self.send(channel=["#minecraft"])
+        self.assertEqual([], self.plugin.received)
+
+    def test_unhook(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin,
+                channel="#minecraft")
+        self.transport.unhook_plugin(self.plugin)
+        self.send(channel="#minecraft")
+        self.assertEqual([], self.plugin.received)
+
+    def test_stop_listening(self):
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin,
+                channel="#minecraft")
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin,
+                channel="#other")
+        self.transport.listen_for_event("irc.on_join", self.plugin)
+        self.transport.stop_listening_for_event("irc.on_privmsg", self.plugin)
+        self.send(channel="#minecraft")
+        self.send(channel="#other")
+        self.transport.send_event(Event("irc.on_join"))
+        self.assertEqual(["irc.on_join"], self.plugin.received)
+
+
+class Handlers(BotPlugin):
+    def on_event_irc_on_privmsg(self, event):
+        self.received.append(event.eventtype)
+
+    def on_request_test_double(self, n):
+        return n * 2
+
+class TestHandlerDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.plugin = Handlers("test.Handlers", self.transport, StubBoss())
+        self.plugin.received = []
+
+    def test_handles_event(self):
+        self.assertTrue(self.plugin.handles_event("irc.on_privmsg"))
+        self.assertFalse(self.plugin.handles_event("irc.on_notice"))
+        self.assertFalse(self.plugin.handles_middleware_event("irc.on_privmsg"))
+
+    def test_catchall_handles_everything(self):
+        class CatchAll(Handlers):
+            def received_event(self, event):
+                pass
+        plugin = CatchAll("test.CatchAll", self.transport, StubBoss())
+        self.assertTrue(plugin.handles_event("irc.on_notice"))
+
+    def test_unhandled_events_not_delivered(self):
+        self.plugin.received_event = lambda event: self.fail("delivered")
+        self.plugin.listen_for_event("irc.on_notice")
+        self.transport.send_event(Event("irc.on_notice"))
+
+    def test_dispatch(self):
+        self.plugin.listen_for_event("irc.*")
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_notice"))
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_request(self):
+        self.plugin.provides_request("test.double")
+        results = []
+        self.transport.issue_request("test.double", 4).addCallback(results.append)
+        self.assertEqual([8], results)
+
+    def test_maps_are_per_class(self):
+        class Subclass(Handlers):
+            def on_event_irc_on_notice(self, event):
+                pass
+        plugin = Subclass("test.Subclass", self.transport, StubBoss())
+        self.assertTrue(plugin.handles_event("irc.on_notice"))
+        self.assertFalse(self.plugin.handles_event("irc.on_notice"))
+
+
+class TestDispatchStats(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.plugin = Handlers("test.Handlers", self.transport, StubBoss())
+        self.plugin.received = []
+        self.plugin.listen_for_event("irc.on_privmsg")
+        self.plugin.provides_request("test.double")
+
+    def enable(self, enabled=True):
+        self.transport.configure({"core": {"transport": {"stats": enabled}}})
+
+    def stats(self):
+        results = []
+        self.transport.issue_request("transport.stats").addCallback(results.append)
+        return results[0]
+
+    def test_disabled_by_default(self):
+        self.transport.configure({"core": {}})
+        failures = []
+        self.transport.issue_request("transport.stats").addErrback(failures.append)
+        self.assertTrue(failures[0].check(NotImplementedError))
+
+    def test_counts_calls(self):
+        self.enable()
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.issue_request("test.double", 2)
+
+        rows = dict(((row['kind'], row['name']), row) for row in self.stats())
+        self.assertEqual(2, rows[("event", "irc.on_privmsg")]['count'])
+        self.assertEqual(1, rows[("request", "test.double")]['count'])
+        self.assertEqual("test.Handlers", rows[("event", "irc.on_privmsg")]['plugin'])
+
+    def test_disable(self):
+        self.enable()
+        self.enable(False)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+        self.assertNotIn("transport.stats", self.transport._request_listeners)
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.add(0.000003)
+        histogram.add(0.5)
+        self.assertEqual(100, histogram.count)
+        self.assertEqual(0.000004, histogram.percentile(0.5))
+        self.assertEqual(0.5, histogram.percentile(1))
+
+
+class Failing(Recorder):
+    """A Recorder whose handlers raise after recording the event"""
+    def received_event(self, event):
+        Recorder.received_event(self, event)
+        raise ValueError(event.eventtype)
+
+    def received_middleware_event(self, event):
+        Recorder.received_middleware_event(self, event)
+        raise ValueError(event.eventtype)
+
+class TestPluginHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(clock=self.clock)
+        self.failing = Failing("test.Failing")
+        self.healthy = Recorder("test.Healthy")
+        self.transport.listen_for_event("irc.on_privmsg", self.failing)
+        self.transport.listen_for_event("irc.on_privmsg", self.healthy)
+        self.transport.configure({"core": {"transport": {"breaker":
+            {"failures": 3, "window": 60, "cooldown": 300}}}})
+        self.health = self.transport._health
+
+    def health_rows(self):
+        results = []
+        self.transport.issue_request("transport.health").addCallback(results.append)
+        return dict((row['plugin'], row) for row in results[0])
+
+    def send(self, count):
+        for _ in range(count):
+            self.transport.send_event(Event("irc.on_privmsg"))
+
+    def test_trips_after_failures(self):
+        self.send(5)
+        self.assertEqual(3, len(self.failing.received))
+        self.assertEqual(5, len(self.healthy.received))
+        row = self.health_rows()["test.Failing"]
+        self.assertEqual("failing", row['state'])
+        self.assertEqual(300, row['remaining'])
+        self.assertEqual((3, 1), (row['failures'], row['trips']))
+
+    def test_recovers_after_cooldown(self):
+        self.send(3)
+        self.clock.advance(300)
+        self.send(1)
+        self.assertEqual(4, len(self.failing.received))
+        self.assertEqual("ok", self.health_rows()["test.Failing"]['state'])
+
+    def test_failures_outside_window(self):
+        self.send(2)
+        self.clock.advance(61)
+        self.send(1)
+        self.assertNotIn(self.failing, self.health.tripped)
+
+    def test_tripped_middleware_passes_events(self):
+        middleware = Failing("test.FailingMiddleware")
+        self.transport.install_middleware("irc.on_notice", middleware)
+        self.transport.listen_for_event("irc.on_notice", self.healthy)
+        for _ in range(4):
+            self.transport.send_event(Event("irc.on_notice"))
+        self.assertEqual(3, len(middleware.received))
+        self.assertEqual(["irc.on_notice"] * 4, self.healthy.received)
+
+    def test_slow_calls(self):
+        self.health.configure({"slow": 0.5, "slow_calls": 2})
+        self.health.timed(self.healthy, 0.1)
+        self.health.timed(self.healthy, 0.6)
+        self.assertNotIn(self.healthy, self.health.tripped)
+        self.health.timed(self.healthy, 0.7)
+        self.assertEqual("too slow", self.health.tripped[self.healthy][0])
+
+    def test_unhook_cancels_cooldown(self):
+        self.send(3)
+        self.transport.unhook_plugin(self.failing)
+        self.assertEqual({}, self.health.tripped)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_disable(self):
+        self.send(3)
+        self.transport.configure({"core": {"transport": {}}})
+        self.send(1)
+        self.assertEqual(4, len(self.failing.received))
+        self.assertNotIn("transport.health", self.transport._request_listeners)
+
+
+class TestStallMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(clock=self.clock)
+        self.plugin = Recorder()
+        self.transport.listen_for_event("irc.on_privmsg", self.plugin)
+        self.enable(keep=2)
+
+    def enable(self, **settings):
+        settings.setdefault("interval", 0.1)
+        settings.setdefault("threshold", 0.25)
+        self.transport.configure({"core": {"transport": {"stalls": settings}}})
+
+    def stalls(self):
+        results = []
+        self.transport.issue_request("transport.stalls").addCallback(results.append)
+        return results[0]
+
+    def test_on_time(self):
+        self.clock.pump([0.1] * 10)
+        self.assertEqual([], self.stalls())
+
+    def test_blames_slowest_call(self):
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.clock.advance(0.5)
+        stall, = self.stalls()
+        self.assertAlmostEqual(0.4, stall['stall'])
+        self.assertEqual(("test.Recorder", "event", "irc.on_privmsg"),
+                (stall['plugin'], stall['kind'], stall['name']))
+
+    def test_blames_slowest_request(self):
+        self.transport.issue_request("transport.stalls")
+        self.clock.advance(0.5)
+        stall, = self.stalls()
+        self.assertEqual(("transport.StallMonitor", "request"),
+                (stall['plugin'], stall['kind']))
+
+    def test_no_call(self):
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.clock.advance(0.1)
+        self.clock.advance(0.5)
+        stall, = self.stalls()
+        self.assertIsNone(stall['plugin'])
+
+    def test_keeps_last_stalls(self):
+        for _ in range(3):
+            self.clock.advance(0.5)
+        self.assertEqual(2, len(self.stalls()))
+
+    def test_disable(self):
+        self.transport.configure({"core": {"transport": {}}})
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertNotIn("transport.stalls", self.transport._request_listeners)
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(clock=self.clock)
+        self.plugin = Recorder()
+        self.transport.listen_for_event("irc.*", self.plugin)
+
+    def enable(self, **settings):
+        self.transport.configure({"core": {"transport": {"queue": settings}}})
+
+    def turn(self):
+        """Runs one reactor turn's worth of delayed calls. Clock.advance()
+        would also run the calls scheduled while advancing.
+
+        """
+        calls, self.clock.calls = self.clock.calls, []
+        for call in calls:
+            call.func(*call.args, **call.kw)
+
+    def queue_stats(self):
+        results = []
+        self.transport.issue_request("transport.queue").addCallback(results.append)
+        return results[0]
+
+    def test_dispatched_on_next_turn(self):
+        self.enable()
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual([], self.plugin.received)
+        self.clock.advance(0)
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_not_reentrant(self):
+        transport = self.transport
+
+        class Replier(Recorder):
+            def received_event(self, event):
+                Recorder.received_event(self, event)
+                transport.send_event(Event("irc.do_msg"))
+                self.received.append("returned")
+
+        replier = Replier()
+        transport.listen_for_event("irc.on_privmsg", replier)
+        self.enable()
+        transport.send_event(Event("irc.on_privmsg"))
+        self.clock.advance(0)
+        self.assertEqual(["irc.on_privmsg", "returned"], replier.received)
+        self.assertEqual(["irc.on_privmsg", "irc.do_msg"], self.plugin.received)
+
+    def test_batches(self):
+        self.enable(batch=2)
+        for _ in range(5):
+            self.transport.send_event(Event("irc.on_privmsg"))
+        self.turn()
+        self.assertEqual(2, len(self.plugin.received))
+        self.turn()
+        self.turn()
+        self.assertEqual(5, len(self.plugin.received))
+        self.assertEqual(0, self.queue_stats()['depth'])
+
+    def test_priorities(self):
+        self.enable(batch=4, priorities={"irc.do_*": 3})
+        for _ in range(4):
+            self.transport.send_event(Event("irc.on_privmsg"))
+            self.transport.send_event(Event("irc.do_msg"))
+        self.turn()
+        self.assertEqual(["irc.do_msg"] * 3 + ["irc.on_privmsg"],
+                self.plugin.received)
+
+    def test_drop_oldest(self):
+        self.enable(max_size=2, priorities={"irc.do_*": 2})
+        self.transport.send_event(Event("irc.do_msg"))
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_notice"))
+        self.clock.advance(0)
+        self.assertEqual(["irc.do_msg", "irc.on_notice"], self.plugin.received)
+        self.assertEqual(1, self.queue_stats()['dropped'])
+
+    def test_drop_newest(self):
+        self.enable(max_size=1, drop="newest")
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_notice"))
+        self.clock.advance(0)
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+
+    def test_inline_when_full(self):
+        self.enable(max_size=1, drop="inline")
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_notice"))
+        self.assertEqual(["irc.on_notice"], self.plugin.received)
+        self.assertEqual(1, self.queue_stats()['inline'])
+
+    def test_disable_flushes(self):
+        self.enable()
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.configure({"core": {}})
+        self.assertEqual(["irc.on_privmsg"], self.plugin.received)
+        self.transport.send_event(Event("irc.on_notice"))
+        self.assertEqual(["irc.on_privmsg", "irc.on_notice"], self.plugin.received)
+
+
+class SlowProvider(object):
+    """A request provider that answers when told to"""
+    plugin_name = "test.SlowProvider"
+
+    def __init__(self):
+        self.pending = []
+        self.cancelled = 0
+
+    def incoming_request(self, name, value=None):
+        d = defer.Deferred(self.cancel)
+        self.pending.append((d, value))
+        return d
+
+    def cancel(self, d):
+        self.cancelled += 1
+        self.pending = [x for x in self.pending if x[0] is not d]
+
+    def answer(self):
+        d, value = self.pending.pop(0)
+        d.callback(value)
+
+class TestRequestPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(clock=self.clock)
+        self.provider = SlowProvider()
+
+    def issue(self, value=None):
+        results = []
+        self.transport.issue_request("test.slow", value).addBoth(results.append)
+        return results
+
+    def test_timeout(self):
+        self.transport.provides_request("test.slow", self.provider, timeout=5)
+        results = self.issue()
+        self.clock.advance(4)
+        self.assertEqual([], results)
+        self.clock.advance(1)
+        self.assertTrue(results[0].check(RequestTimedOut))
+        self.assertEqual(1, self.provider.cancelled)
+
+    def test_answered_in_time(self):
+        self.transport.provides_request("test.slow", self.provider, timeout=5)
+        results = self.issue(3)
+        self.provider.answer()
+        self.clock.advance(10)
+        self.assertEqual([3], results)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_concurrency_and_queue(self):
+        self.transport.provides_request("test.slow", self.provider,
+                max_concurrent=1, queue=1)
+        first, second, third = self.issue(1), self.issue(2), self.issue(3)
+        self.assertEqual(1, len(self.provider.pending))
+        self.assertTrue(third[0].check(RequestOverloaded))
+
+        self.provider.answer()
+        self.assertEqual([1], first)
+        self.assertEqual(1, len(self.provider.pending))
+        self.provider.answer()
+        self.assertEqual([2], second)
+
+    def test_timed_out_while_waiting(self):
+        self.transport.provides_request("test.slow", self.provider,
+                max_concurrent=1, queue=1, timeout=5)
+        self.issue(1)
+        self.clock.advance(1)
+        second = self.issue(2)
+        self.clock.advance(4.5)
+        self.assertEqual(1, len(self.provider.pending))
+        self.assertEqual(2, self.provider.pending[0][1])
+        self.clock.advance(1)
+        self.assertTrue(second[0].check(RequestTimedOut))
+        self.assertEqual([], self.provider.pending)
+
+    def test_config_overrides_provider(self):
+        self.transport.provides_request("test.slow", self.provider, timeout=5)
+        self.transport.configure({"core": {"transport": {
+            "request_defaults": {"timeout": 1},
+            "requests": {"test.slow": {"timeout": 20}},
+            }}})
+        results = self.issue()
+        self.clock.advance(10)
+        self.assertEqual([], results)
+        self.clock.advance(10)
+        self.assertTrue(results[0].check(RequestTimedOut))
+
+    def test_custom_timeout_error(self):
+        class SlowTimedOut(RequestTimedOut):
+            pass
+        self.transport.provides_request("test.slow", self.provider,
+                timeout=5, timeout_error=SlowTimedOut)
+        results = self.issue()
+        self.clock.advance(5)
+        self.assertTrue(results[0].check(SlowTimedOut))
+
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport(clock=self.clock)
+        self.provider = SlowProvider()
+
+    def provide(self, **policy):
+        self.transport.provides_request("test.slow", self.provider, **policy)
+
+    def issue(self, value=None):
+        results = []
+        self.transport.issue_request("test.slow", value).addBoth(results.append)
+        return results
+
+    def counters(self):
+        results = []
+        self.transport.issue_request("transport.requests").addCallback(results.append)
+        return dict((row['name'], row) for row in results[0])['test.slow']
+
+    def test_hit(self):
+        self.provide(cache_ttl=10)
+        self.issue(1)
+        self.provider.answer()
+        self.assertEqual([1], self.issue(1))
+        self.assertEqual([], self.provider.pending)
+        self.issue(2)
+        self.assertEqual(1, len(self.provider.pending))
+
+        counters = self.counters()
+        self.assertEqual(1, counters['hits'])
+        self.assertEqual(2, counters['misses'])
+
+    def test_expiry(self):
+        self.provide(cache_ttl=10)
+        self.issue(1)
+        self.provider.answer()
+        self.clock.advance(11)
+        self.assertEqual([], self.issue(1))
+        self.assertEqual(1, len(self.provider.pending))
+
+    def test_concurrent_calls_share_answer(self):
+        self.provide(cache_ttl=10)
+        first, second = self.issue(1), self.issue(1)
+        self.assertEqual(1, len(self.provider.pending))
+        self.provider.answer()
+        self.assertEqual([1], first)
+        self.assertEqual([1], second)
+
+    def test_coalesced_not_counted_as_hits(self):
+        self.provide(cache_ttl=10)
+        self.issue(1)
+        self.issue(1)
+        self.provider.answer()
+        counters = self.counters()
+        self.assertEqual(0, counters['hits'])
+        self.assertEqual(1, counters['misses'])
+        self.assertEqual(1, counters['coalesced'])
+
+    def test_size_zero_turns_cache_off(self):
+        self.provide(cache_ttl=10, cache_size=0)
+        self.assertIsNone(self.transport._request_policies["test.slow"].cache)
+        self.issue(1)
+        self.provider.answer()
+        self.assertEqual([], self.issue(1))
+        self.assertEqual(1, len(self.provider.pending))
+
+    def test_negative_size_rejected(self):
+        self.assertRaises(ValueError, self.provide, cache_size=-1)
+
+    def test_cache_if(self):
+        self.provide(cache_ttl=10, cache_if=lambda answer: answer != "nobody")
+        self.issue("nobody")
+        self.provider.answer()
+        self.assertEqual([], self.issue("nobody"))
+        self.provider.answer()
+        self.issue("alice")
+        self.provider.answer()
+        self.assertEqual(["alice"], self.issue("alice"))
+
+    def test_lru(self):
+        self.provide(cache_size=2)
+        for value in (1, 2, 1, 3):
+            self.issue(value)
+            if self.provider.pending:
+                self.provider.answer()
+        self.assertEqual([1], self.issue(1))
+        self.assertEqual([], self.issue(2))
+
+    def test_invalidate_on_event(self):
+        self.provide(cache_ttl=10, invalidate_on=["irc.on_nick_change"])
+        self.issue(1)
+        self.provider.answer()
+        self.transport.send_event(Event("irc.on_nick_change"))
+        self.assertEqual([], self.issue(1))
+
+    def test_invalidate_keys(self):
+        self.provide(cache_ttl=10, invalidate_on=["irc.on_nick_change"],
+                cache_key=lambda value: value.lower(),
+                invalidate_keys=lambda event, cache: [event.oldnick])
+        for nick in ("alice", "bob", "carol"):
+            self.issue(nick)
+            self.provider.answer()
+        self.issue("dave")
+        self.transport.send_event(Event("irc.on_nick_change", oldnick="alice"))
+        self.transport.send_event(Event("irc.on_nick_change", oldnick="dave"))
+        self.provider.answer()
+        self.assertEqual(["bob"], self.issue("Bob"))
+        self.assertEqual(["carol"], self.issue("carol"))
+        # Dropped, along with the answer that was on its way
+        self.assertEqual([], self.issue("alice"))
+        self.assertEqual([], self.issue("dave"))
+
+    def test_errors_not_cached(self):
+        self.provide(cache_ttl=10, timeout=5)
+        self.issue(1)
+        self.clock.advance(5)
+        self.assertEqual([], self.issue(1))
+        self.assertEqual(1, len(self.provider.pending))
+
+    def test_unhook_removes_cache(self):
+        self.provide(invalidate_on=["irc.on_nick_change"])
+        self.transport.unhook_plugin(self.provider)
+        self.assertNotIn("test.slow", self.transport._request_policies)
+        self.assertEqual(0, len(self.transport._event_listeners["irc.on_nick_change"]))
+
+
+class Batcher(Handlers):
+    def on_batch_request_test_double(self, argsets):
+        self.batches.append(argsets)
+        return [n * 2 for (n,) in argsets]
+
+class TestBatchRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+
+    def issue(self, argsets):
+        results = []
+        self.transport.issue_requests("test.double", argsets).addCallback(results.append)
+        return results[0]
+
+    def test_fallback_to_single_requests(self):
+        plugin = Handlers("test.Handlers", self.transport, StubBoss())
+        plugin.provides_request("test.double")
+        results = self.issue([(1,), (2,), ("x", "y")])
+        self.assertEqual([(True, 2), (True, 4)], results[:2])
+        self.assertFalse(results[2][0])
+        self.assertTrue(results[2][1].check(TypeError))
+
+    def test_batch_handler(self):
+        plugin = Batcher("test.Batcher", self.transport, StubBoss())
+        plugin.batches = []
+        plugin.provides_request("test.double")
+        self.assertEqual([(True, 2), (True, 4)], self.issue([(1,), (2,)]))
+        self.assertEqual([[(1,), (2,)]], plugin.batches)
+
+    def test_batch_uses_cache(self):
+        plugin = Batcher("test.Batcher", self.transport, StubBoss())
+        plugin.batches = []
+        plugin.provides_request("test.double", cache_ttl=10)
+        self.transport.issue_request("test.double", 1)
+        self.assertEqual([(True, 2), (True, 4)], self.issue([(1,), (2,)]))
+        self.assertEqual([(True, 2), (True, 4)], self.issue([(1,), (2,)]))
+        self.assertEqual([[(2,)]], plugin.batches)
+
+
+class TestSubscriptionTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = SubscriptionTrie()
+        for matchstr in ["irc.on_privmsg", "irc.on_*", "irc.*", "*.*",
+                "*.on_*", "ircutil.hasop.*", "irc.do_*"]:
+            self.trie.add(matchstr)
+
+    def test_match_in_insertion_order(self):
+        self.assertEqual(
+                ["irc.on_privmsg", "irc.on_*", "irc.*", "*.*", "*.on_*"],
+                self.trie.match("irc.on_privmsg"))
+
+    def test_segment_count_must_agree(self):
+        self.assertEqual(["ircutil.hasop.*"],
+                self.trie.match("ircutil.hasop.acquired"))
+        self.assertEqual([], self.trie.match("irc"))
+
+    def test_glob_needs_a_character(self):
+        self.assertEqual(["irc.*", "*.*"], self.trie.match("irc.on_"))
+
+    def test_remove_prunes(self):
+        self.trie.remove("ircutil.hasop.*")
+        self.assertEqual([], self.trie.match("ircutil.hasop.acquired"))
+        self.assertNotIn("ircutil", self.trie._root.exact)
+
+        self.trie.remove("irc.on_*")
+        self.assertEqual(["irc.on_privmsg", "irc.*", "*.*", "*.on_*"],
+                self.trie.match("irc.on_privmsg"))
+        self.assertIn("irc", self.trie._root.exact)
+        self.assertEqual(5, len(self.trie))
+
+
+if __name__ == "__main__":
+    unittest.main()
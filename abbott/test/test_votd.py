@@ -0,0 +1,65 @@
+# encoding: UTF-8
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from abbott.plugins.votd import VoiceOfTheDay
+from abbott.test.stubs import StubBoss, SyncJournalPluginConfig
+from abbott.transport import Transport, Event
+
+
+class TestVoiceOfTheDayOdds(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        jsonfile = os.path.join(self.dir, "votd.VoiceOfTheDay.json")
+        self.journalfile = os.path.join(self.dir, "votd.VoiceOfTheDay.journal")
+        with open(jsonfile, "w") as out:
+            json.dump({"counter": {"alice": 3, "bob": 1},
+                "chance": {"alice": 0.5}}, out)
+        self.plugin = VoiceOfTheDay("votd.VoiceOfTheDay", Transport(),
+                StubBoss(prefix="!", plugin_config=lambda:
+                    SyncJournalPluginConfig(jsonfile)))
+        self.plugin.config.save()
+        self.plugin.config.flush()
+
+    def tearDown(self):
+        self.plugin.config.close()
+        shutil.rmtree(self.dir)
+
+    def journal(self):
+        with open(self.journalfile) as inp:
+            return [json.loads(line) for line in inp]
+
+    def test_chance_stored(self):
+        self.assertEqual({"alice": 0.75, "bob": 0.25},
+                self.plugin.config['chance'])
+        written = len(self.journal())
+        self.plugin.config['counter']['alice'] += 1
+        self.plugin.config['counter']['carol'] = 0
+        self.plugin.config['multipliers']['carol'] = 1
+        self.plugin.config.save()
+        self.plugin.config.flush()
+        # Only the chances that changed are written
+        self.assertEqual(sorted([["set", ["counter", "alice"], 4],
+                ["set", ["counter", "carol"], 0],
+                ["set", ["multipliers", "carol"], 1],
+                ["set", ["chance", "alice"], 0.8],
+                ["set", ["chance", "bob"], 0.2],
+                ["set", ["chance", "carol"], 0.0]]),
+                sorted(self.journal()[written:]))
+
+    def test_odds(self):
+        replies = []
+        event = Event("irc.on_privmsg", user="alice!a@example.com",
+                channel="#test",
+                reply=lambda msg, **kwargs: replies.append(msg))
+        match = re.match("(?P<user>[^ ]+)?$", "bob")
+        self.plugin.check_prob(event, match)
+        self.assertEqual("bob’s chance of winning the next VOTD is 25.00% "
+                "with 1 points and a multiplier of 0.010", replies[0])
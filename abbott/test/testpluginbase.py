@@ -1,9 +1,16 @@
+import json
+import os
 from functools import wraps
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
-from ..pluginbase import non_reentrant
+from ..pluginbase import non_reentrant, PluginConfig, PluginBoss, \
+        BotPlugin, DependencyCycle, LazyPlugin
+from ..transport import Transport, Event
+from ..ioexecutor import IOExecutor
+from ..command import CommandPluginSuperclass
+from .stubs import StubIRC
 
 
 class TestNonReentrant(unittest.TestCase):
@@ -104,3 +111,275 @@ class TestNonReentrant(unittest.TestCase):
         self.assertEquals(5, (yield r1))
         self.assertEquals(7, (yield r2))
 
+
+
+class TestPluginConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.filename = self.mktemp()
+        with open(self.filename, "w") as out:
+            json.dump({"counter": 0}, out)
+        self.config = PluginConfig(self.filename, interval=30, changes=3,
+                clock=self.clock)
+
+    def on_disk(self):
+        with open(self.filename) as inp:
+            return json.load(inp)
+
+    def test_write_behind(self):
+        self.config['counter'] = 1
+        self.config.save()
+        self.assertEqual({"counter": 0}, self.on_disk())
+        self.clock.advance(30)
+        self.assertEqual({"counter": 1}, self.on_disk())
+        self.assertEqual(0, self.config.dirty)
+
+    def test_flush_after_changes(self):
+        for i in range(3):
+            self.config['counter'] = i
+            self.config.save()
+        self.assertEqual({"counter": 2}, self.on_disk())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_write_through(self):
+        config = PluginConfig(self.filename, clock=self.clock)
+        config['counter'] = 5
+        config.save()
+        self.assertEqual({"counter": 5}, self.on_disk())
+
+    def test_before_flush(self):
+        calls = []
+        self.config.before_flush.append(lambda: calls.append(1))
+        self.config.save()
+        self.config.save()
+        self.assertEqual([], calls)
+        self.config.flush()
+        self.config.flush()
+        self.assertEqual([1], calls)
+
+    def test_save_deferred(self):
+        io = IOExecutor(lambda func, *args: defer.Deferred())
+        config = PluginConfig(self.filename, io=io)
+        done = []
+        config['counter'] = 1
+        config.save().addCallback(done.append)
+        self.assertEqual([], done)
+        self.assertEqual({"counter": 0}, self.on_disk())
+        # A config read while the write is pending sees the change
+        self.assertEqual(1, PluginConfig(self.filename, io=io)['counter'])
+
+    def test_failed_write_logged_once(self):
+        writes = []
+        io = IOExecutor(lambda func, *args: writes.append(defer.Deferred())
+                or writes[-1])
+        config = PluginConfig(self.filename, io=io)
+        done = []
+        config['counter'] = 1
+        config.save().addBoth(done.append)
+        writes[-1].errback(IOError("disk full"))
+        self.assertEqual(1, len(self.flushLoggedErrors(IOError)))
+        self.assertEqual([], done)
+        self.assertEqual(1, config.dirty)
+        # The next write stores the change and fires the earlier waiter
+        config['counter'] = 2
+        config.save()
+        writes[-1].callback(None)
+        self.assertEqual([None], done)
+
+
+class StartupPlugin(BotPlugin):
+    """Records the order plugins start in. Set the class attributes with
+    make_plugin()
+
+    """
+    started = None
+    starting = None
+
+    def reload(self):
+        pass
+
+    def start(self):
+        self.started.append(self.plugin_name)
+        return self.starting.get(self.plugin_name)
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        self.configdir = self.mktemp()
+        os.mkdir(self.configdir)
+        with open(os.path.join(self.configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": []}}, out)
+        self.boss = PluginBoss(self.configdir, Transport())
+        self.started = []
+        self.starting = {}
+
+    def plugins(self, **requires):
+        """Configures a plugin for each keyword, requiring the listed ones"""
+        for name, deps in sorted(requires.items()):
+            plugin_name = "test." + name
+            self.boss.config['core']['plugins'].append(plugin_name)
+            self.boss.plugin_overrides[plugin_name] = type(name,
+                    (StartupPlugin,), dict(REQUIRES=["test." + dep for dep in deps],
+                        started=self.started, starting=self.starting))
+
+    def test_dependencies_first(self):
+        self.plugins(a=["c"], b=[], c=["b"])
+        self.boss.load_all_plugins()
+        self.assertEqual(["test.b", "test.c", "test.a"], self.started)
+
+    def test_waits_for_deferred_start(self):
+        self.plugins(a=[], b=["a"], c=[])
+        self.starting["test.a"] = defer.Deferred()
+        times = []
+        self.boss.load_all_plugins().addCallback(times.append)
+        self.assertEqual(["test.a", "test.c"], self.started)
+        self.assertEqual([], times)
+        self.starting["test.a"].callback(None)
+        self.assertEqual(["test.a", "test.c", "test.b"], self.started)
+        self.assertEqual(set(["test.a", "test.b", "test.c"]), set(times[0]))
+
+    def test_failed_dependency(self):
+        self.plugins(a=[], b=["a"], c=["b"], d=[])
+        self.starting["test.a"] = defer.fail(ValueError("no"))
+        times = []
+        self.boss.load_all_plugins().addCallback(times.append)
+        self.assertEqual(["test.a", "test.d"], self.started)
+        self.assertEqual(["test.d"], list(times[0]))
+        self.assertNotIn("test.a", self.boss.loaded_plugins)
+        self.flushLoggedErrors(ValueError)
+
+    def test_cycle(self):
+        self.plugins(a=["b"], b=["c"], c=["b"], d=[])
+        self.assertRaises(DependencyCycle, self.boss.load_all_plugins)
+        self.assertEqual([], self.started)
+
+
+class TestSharedPluginConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.configdir = self.mktemp()
+        os.mkdir(self.configdir)
+        with open(os.path.join(self.configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": [], "config_storage": {
+                "test.Journal": {"engine": "journal"}},
+                "config_flush": {"interval": 0, "changes": 1}}}, out)
+        self.boss = PluginBoss(self.configdir, Transport())
+
+    def test_other_callers_share_the_live_config(self):
+        owned = self.boss.get_plugin_config("test.Journal", reread=True)
+        shared = self.boss.get_plugin_config("test.Journal")
+        self.assertIs(owned, shared)
+        shared['nick'] = "abbott2"
+        shared.save()
+        # The owner's journal is still open
+        owned['count'] = 1
+        owned.save()
+
+        reread = self.boss.get_plugin_config("test.Journal", reread=True)
+        self.assertIsNot(owned, reread)
+        self.assertEqual({"nick": "abbott2", "count": 1}, dict(reread))
+        reread.close()
+
+class LazilyLoaded(BotPlugin):
+    loaded = []
+
+    def reload(self):
+        pass
+
+    def start(self):
+        self.loaded.append(self)
+        self.received = []
+        self.listen_for_event("irc.on_privmsg")
+        self.provides_request("test.double")
+
+    def on_event_irc_on_privmsg(self, event):
+        self.received.append(event.message)
+
+    def on_request_test_double(self, n):
+        return n * 2
+
+class TestLazyPlugins(unittest.TestCase):
+
+    def setUp(self):
+        self.configdir = self.mktemp()
+        os.mkdir(self.configdir)
+        with open(os.path.join(self.configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": ["test.Lazy"], "lazy_plugins": {
+                "test.Lazy": {"requests": ["test.double"],
+                    "commands": ["double"], "prefixes": ["."]}}}}, out)
+        self.transport = Transport()
+        self.boss = PluginBoss(self.configdir, self.transport)
+        LazilyLoaded.loaded = []
+        self.boss.plugin_overrides["test.Lazy"] = LazilyLoaded
+        self.boss.load_all_plugins()
+
+    def privmsg(self, message, direct=False):
+        self.transport.send_event(Event("irc.on_privmsg", message=message,
+            direct=direct))
+
+    def test_not_loaded(self):
+        self.privmsg("hello")
+        self.privmsg("double 2")
+        self.assertEqual([], LazilyLoaded.loaded)
+        self.assertIsInstance(self.boss.loaded_plugins["test.Lazy"], LazyPlugin)
+
+    def test_loaded_by_request(self):
+        results = []
+        self.transport.issue_request("test.double", 4).addCallback(results.append)
+        self.assertEqual([8], results)
+        self.assertEqual(1, len(LazilyLoaded.loaded))
+        self.assertIs(LazilyLoaded.loaded[0], self.boss.loaded_plugins["test.Lazy"])
+
+    def test_loaded_by_command(self):
+        self.privmsg(".double 2")
+        plugin, = LazilyLoaded.loaded
+        self.assertEqual([".double 2"], plugin.received)
+        self.privmsg("hello")
+        self.assertEqual([".double 2", "hello"], plugin.received)
+
+    def test_loaded_by_direct_help(self):
+        self.privmsg("help double", direct=True)
+        self.assertEqual(1, len(LazilyLoaded.loaded))
+
+class LazyCommands(CommandPluginSuperclass):
+    loaded = []
+
+    def start(self):
+        super(LazyCommands, self).start()
+        self.loaded.append(self)
+        self.doubled = []
+        self.install_command(
+                cmdname="double",
+                argmatch=r"(?P<n>\d+)$",
+                callback=lambda event, match: self.doubled.append(
+                    int(match.group("n")) * 2),
+                )
+
+class TestLazyCommandPlugin(unittest.TestCase):
+
+    def setUp(self):
+        self.configdir = self.mktemp()
+        os.mkdir(self.configdir)
+        with open(os.path.join(self.configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": ["test.LazyCommands"],
+                "lazy_plugins": {"test.LazyCommands": {"commands": ["double"]}}},
+                "command": {"prefix": "!"}}, out)
+        self.transport = Transport()
+        self.boss = PluginBoss(self.configdir, self.transport)
+        LazyCommands.loaded = []
+        self.boss.plugin_overrides["test.LazyCommands"] = LazyCommands
+        self.boss.load_all_plugins()
+        self.boss.loaded_plugins["irc.IRCBotPlugin"] = StubIRC()
+
+    def privmsg(self, message):
+        self.transport.send_event(Event("irc.on_privmsg", message=message,
+            direct=False, user="alice!a@example.com", channel="#test",
+            has_permission=lambda perm, channel: defer.succeed(True)))
+
+    def test_activating_command_runs(self):
+        self.privmsg("!double 2")
+        plugin, = LazyCommands.loaded
+        self.assertEqual([4], plugin.doubled)
+        self.privmsg("!double 3")
+        self.assertEqual([4, 6], plugin.doubled)
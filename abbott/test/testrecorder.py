@@ -0,0 +1,114 @@
+import json
+import os
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ..pluginbase import BotPlugin, PluginBoss
+from ..transport import Transport, Event
+from ..plugins import recorder
+
+
+class SessionIRC(BotPlugin):
+    """Stands in for the IRCBotPlugin. Broadcasts events like it, and keeps
+    what the other plugins ask it to send.
+
+    """
+    def start(self):
+        self.event_observers = []
+        self.sent = []
+        self.listen_for_event("irc.do_*")
+
+    def broadcast_message(self, eventname, **kwargs):
+        event = Event(eventname, **kwargs)
+        for observer in self.event_observers:
+            observer(event)
+        self.transport.send_event(event)
+
+    def on_event_irc_do_msg(self, event):
+        self.sent.append((event.user, event.message))
+
+class Shouter(BotPlugin):
+    def start(self):
+        self.listen_for_event("irc.on_privmsg")
+
+    def on_event_irc_on_privmsg(self, event):
+        self.transport.send_event(Event("irc.do_msg", user=event.channel,
+            message=event.message.upper()))
+
+class TestRecorder(unittest.TestCase):
+
+    def boss(self, plugins):
+        configdir = self.mktemp()
+        os.mkdir(configdir)
+        with open(os.path.join(configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": plugins}}, out)
+        boss = PluginBoss(configdir, Transport())
+        boss.plugin_overrides["irc.IRCBotPlugin"] = SessionIRC
+        boss.plugin_overrides["test.Shouter"] = Shouter
+        boss.load_all_plugins()
+        return boss
+
+    def session(self, ircplugin):
+        ircplugin.broadcast_message("irc.on_privmsg", user="alice!a@b",
+                channel="#test", message="hello", reply=lambda msg: None)
+        ircplugin.broadcast_message("irc.on_user_joined", user="bob!b@c",
+                channel="#test")
+        ircplugin.broadcast_message("irc.on_privmsg", user="bob!b@c",
+                channel="#test", message="hi alice")
+
+    def read(self, filename):
+        with open(filename) as inp:
+            return [json.loads(line) for line in inp]
+
+    @defer.inlineCallbacks
+    def test_record(self):
+        boss = self.boss(["irc.IRCBotPlugin", "recorder.Recorder"])
+        plugin = boss.loaded_plugins["recorder.Recorder"]
+        filename = boss.config_path("events.jsonl")
+        self.session(boss.loaded_plugins["irc.IRCBotPlugin"])
+        # Written in batches
+        self.assertEqual([], self.read(filename))
+
+        yield plugin.flush()
+        events = self.read(filename)
+        self.assertEqual(["irc.on_privmsg", "irc.on_user_joined",
+            "irc.on_privmsg"], [eventtype for _, eventtype, _ in events])
+        # reply can't be serialized
+        self.assertEqual({"user": "alice!a@b", "channel": "#test",
+            "message": "hello"}, events[0][2])
+        boss.unload_plugin("recorder.Recorder")
+
+    @defer.inlineCallbacks
+    def test_flush_events(self):
+        boss = self.boss(["irc.IRCBotPlugin"])
+        config = boss.get_plugin_config("recorder.Recorder")
+        config['flush_events'] = 3
+        config.save()
+        boss.load_plugin("recorder.Recorder")
+        self.session(boss.loaded_plugins["irc.IRCBotPlugin"])
+        yield boss.io.wait()
+        self.assertEqual(3, len(self.read(boss.config_path("events.jsonl"))))
+        boss.unload_plugin("recorder.Recorder")
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        live = self.boss(["irc.IRCBotPlugin", "recorder.Recorder",
+            "test.Shouter"])
+        self.session(live.loaded_plugins["irc.IRCBotPlugin"])
+        live.unload_plugin("recorder.Recorder")
+        recording = live.config_path("events.jsonl")
+
+        replayed = self.boss(["irc.IRCBotPlugin", "test.Shouter"])
+        ircplugin = replayed.loaded_plugins["irc.IRCBotPlugin"]
+        count, elapsed = (yield recorder.replay_events(ircplugin, recording))
+        self.assertEqual(3, count)
+        self.assertEqual([("#test", "HELLO"), ("#test", "HI ALICE")],
+                ircplugin.sent)
+        self.assertEqual(live.loaded_plugins["irc.IRCBotPlugin"].sent,
+                ircplugin.sent)
+
+        # replay() logs the throughput
+        ircplugin.sent = []
+        yield recorder.replay(replayed, replayed._transport, recording)
+        self.assertEqual(2, len(ircplugin.sent))
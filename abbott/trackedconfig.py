@@ -0,0 +1,288 @@
+from .pluginbase import PluginConfig
+
+"""
+Finding out what changed in a plugin config without looking at all of it.
+
+The stores in abbott.journalconfig and abbott.sqliteconfig only write what
+changed since they last wrote. Comparing the whole config against what was
+written costs as much as writing all of it, so instead the dicts and lists in
+a TrackedPluginConfig report their own changes: each top-level value that is
+a dict or a list is kept as a TrackedDict or TrackedList, and so is every dict
+and list inside it. A change anywhere inside a top-level value is recorded as
+a change to the item of that value it is in, so the config knows which items
+to write:
+
+    config['counter']['alice'] += 1      # item "alice" of "counter" changed
+    config['opmethod'][channel]['op'] = x   # item channel of "opmethod"
+    config['laters'].append(later)       # "laters" from index len-1 onward
+
+Values are copied when they are stored in the config or in one of its
+containers, so keep changing them through the config afterwards, not through
+the object that was stored. A defaultdict is copied into a TrackedDict with
+the same default_factory.
+
+"""
+
+# Recorded for a top-level key whose whole value was replaced or deleted
+REPLACED = "replaced"
+
+def track(value, changed):
+    """Returns a tracked copy of value if it is a dict or a list, and value
+    otherwise. changed is called with the key or index of an item of the copy
+    whenever that item changes.
+
+    """
+    if isinstance(value, dict):
+        return TrackedDict(value, changed,
+                getattr(value, "default_factory", None))
+    if isinstance(value, list):
+        return TrackedList(value, changed)
+    return value
+
+class TrackedDict(dict):
+    """A dict that reports changes to its items. Behaves like a defaultdict
+    if default_factory is given.
+
+    """
+    def __init__(self, items, changed, default_factory=None):
+        dict.__init__(self)
+        self._changed = changed
+        self.default_factory = default_factory
+        for key, value in items.items():
+            dict.__setitem__(self, key, self._track(key, value))
+
+    def _track(self, key, value):
+        def item_changed(_):
+            # Only while it is still in this dict
+            if dict.get(self, key) is child:
+                self._changed(key)
+        child = track(value, item_changed)
+        return child
+
+    def __missing__(self, key):
+        if self.default_factory is None:
+            raise KeyError(key)
+        self[key] = self.default_factory()
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, self._track(key, value))
+        self._changed(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed(key)
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.pop(self, key)
+        self._changed(key)
+        return value
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._changed(key)
+        return key, value
+
+class TrackedList(list):
+    """A list that reports changes. Since any change can move the items after
+    it, it reports the lowest index that changed.
+
+    """
+    def __init__(self, items, changed):
+        list.__init__(self)
+        self._changed = changed
+        list.extend(self, [self._track(item) for item in items])
+
+    def _track(self, value):
+        def item_changed(_):
+            for index, item in enumerate(self):
+                if item is child:
+                    self._changed(index)
+                    return
+        child = track(value, item_changed)
+        return child
+
+    def _start(self, index):
+        """Returns the lowest index that index, an int or a slice, refers to"""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return start if step == 1 else 0
+        if index < 0:
+            index += len(self)
+        return max(0, min(index, len(self)))
+
+    def __setitem__(self, index, value):
+        start = self._start(index)
+        if isinstance(index, slice):
+            value = [self._track(item) for item in value]
+        else:
+            value = self._track(value)
+        list.__setitem__(self, index, value)
+        self._changed(start)
+
+    def __delitem__(self, index):
+        start = self._start(index)
+        list.__delitem__(self, index)
+        self._changed(start)
+
+    # Python 2 calls these for simple slices
+    def __setslice__(self, i, j, value):
+        self[max(0, i):max(0, j)] = value
+
+    def __delslice__(self, i, j):
+        del self[max(0, i):max(0, j)]
+
+    def append(self, value):
+        list.append(self, self._track(value))
+        self._changed(len(self) - 1)
+
+    def extend(self, values):
+        start = len(self)
+        list.extend(self, [self._track(item) for item in values])
+        self._changed(start)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, times):
+        items = list(self)
+        self[:] = items * times
+        return self
+
+    def insert(self, index, value):
+        start = self._start(index)
+        list.insert(self, index, self._track(value))
+        self._changed(start)
+
+    def pop(self, index=-1):
+        start = self._start(index)
+        value = list.pop(self, index)
+        self._changed(start)
+        return value
+
+    def remove(self, value):
+        start = self.index(value)
+        list.__delitem__(self, start)
+        self._changed(start)
+
+    def clear(self):
+        del self[:]
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed(0)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed(0)
+
+class TrackedPluginConfig(PluginConfig):
+    """A PluginConfig that records what changed in it since it was last
+    written. Subclasses implement _write_changes() instead of _write().
+
+    """
+    def __init__(self, *args, **kwargs):
+        # Maps the changed top-level keys to REPLACED, or to the set of keys
+        # or indexes of the items of their values that changed
+        self._touched = {}
+        PluginConfig.__init__(self, *args, **kwargs)
+        self.data = dict((key, self._track(key, value)) for key, value in
+                self.data.items())
+
+    def _track(self, key, value):
+        def item_changed(slot):
+            if self.data.get(key) is child:
+                self._touch(key, slot)
+        child = track(value, item_changed)
+        return child
+
+    def _touch(self, key, slot):
+        slots = self._touched.setdefault(key, set())
+        if slots is not REPLACED:
+            slots.add(slot)
+
+    def __setitem__(self, key, value):
+        self.data[key] = self._track(key, value)
+        self._touched[key] = REPLACED
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self._touched[key] = REPLACED
+
+    # UserDict implements these on self.data directly in Python 2
+    def clear(self):
+        for key in list(self.data):
+            del self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self.data:
+            self[key] = default
+        return self.data[key]
+
+    def pop(self, key, *default):
+        if key not in self.data:
+            return self.data.pop(key, *default)
+        value = self.data[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        key, value = self.data.popitem()
+        self._touched[key] = REPLACED
+        return key, value
+
+    def _write(self):
+        touched, self._touched = self._touched, {}
+        try:
+            written = self._write_changes(touched)
+        except Exception:
+            self._untouch(touched)
+            raise
+        if written is not None:
+            written.addErrback(self._write_failed, touched)
+        return written
+
+    def _write_failed(self, failure, touched):
+        self._untouch(touched)
+        return failure
+
+    def _untouch(self, touched):
+        """Records the changes in touched again, after writing them failed"""
+        for key, slots in touched.items():
+            if slots is REPLACED or self._touched.get(key) is REPLACED:
+                self._touched[key] = REPLACED
+            else:
+                self._touched.setdefault(key, set()).update(slots)
+
+    def _write_changes(self, touched):
+        """Stores the changes recorded in touched, which maps each changed
+        top-level key to REPLACED or to the set of keys or indexes of the
+        items of its value that changed. Returns a deferred if they are stored
+        later.
+
+        """
+        raise NotImplementedError()
@@ -1,9 +1,11 @@
 import re
-from collections import defaultdict
+from collections import Counter, defaultdict, deque, OrderedDict
 from itertools import chain
+from timeit import default_timer
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.python import log
+from twisted.python.failure import Failure
 
 """
 About the Abbott event system:
@@ -22,6 +24,11 @@ glob event names such as irc.* or irc.on_*
 Globs do not transcend dots, so you must do something like *.* to receive all
 events.
 
+Registrations may also carry attribute constraints, such as
+channel="#minecraft" or direct=True. The transport only notifies that listener
+of events whose attributes have those values, so a plugin that only cares
+about one channel never sees traffic from the others.
+
 There are two ways to register an event: as a normal listener, or as a
 middleware listener. There are two differences: all middleware listeners are
 called before normal listeners, and middleware listeners have an opportunity to
@@ -48,64 +55,1436 @@ Other notes about requests: only one plugin may provide a request handler for a
 particular request name. If more than one handler tries to provide a particular
 request, the behavior is undefined.
 
+The transport can optionally time every middleware, listener and request call
+it makes. Set "transport": {"stats": true} in the "core" section of config.json
+to turn it on. The collected histograms are available with the transport.stats
+request.
+
+By default send_event() dispatches the event before returning, so an event sent
+from an event handler is handled in full inside the handler. Setting a "queue"
+dict in the same "transport" section switches to queued dispatch instead:
+send_event() only queues the event, and the queue is drained a batch at a time
+per reactor turn. See the EventQueue class for its settings.
+
+Requests may be given limits: a timeout, a maximum number of calls in progress
+at once and a maximum number of calls waiting for one of those to finish. A
+provider declares the defaults for its requests as keyword arguments to
+provides_request(). They can be overridden in config.json, in the "transport"
+section, with a "requests" dict mapping request names to settings dicts, and
+given for all requests with a "request_defaults" settings dict. See the
+RequestPolicy class for the settings.
+
+The same settings can make a request cached, for requests that are lookups
+whose answers don't change often. Cached answers are returned without calling
+the provider until they expire or until an event that invalidates them is
+sent. See the RequestCache class.
+
+A plugin whose event handlers keep raising exceptions or keep taking too long
+can be cut off for a while by setting a "breaker" settings dict in the same
+"transport" section. See the PluginHealth class.
+
+Setting a "stalls" settings dict there turns on a monitor that notices when
+the reactor was blocked, and which plugin handler was to blame. See the
+StallMonitor class.
+
 """
 
+# What a * matches in the globs of event listeners, and in those of
+# middleware, which as always does not match spaces either
+EVENT_WILDCARD = "[^.]+"
+MIDDLEWARE_WILDCARD = "[^. ]+"
+
+def compile_glob(matchstr, wildcard=EVENT_WILDCARD):
+    """Compiles an event name glob such as irc.on_* into a regular expression
+    object. Globs do not transcend dots.
+
+    """
+    parts = [re.escape(x) for x in matchstr.split("*")]
+    return re.compile(wildcard.join(parts) + "$")
+
+class _TrieNode(object):
+    __slots__ = ["exact", "star", "globs", "terminal"]
+    def __init__(self):
+        # maps literal segments to child nodes
+        self.exact = {}
+        # child node for a segment that is entirely "*"
+        self.star = None
+        # maps partial glob segments such as "on_*" to (compiled regex, child
+        # node) tuples
+        self.globs = {}
+        # The glob ending at this node, if any
+        self.terminal = None
+
+class SubscriptionTrie(object):
+    """An index of event name globs keyed on dot-separated name segments.
+
+    Since globs never cross a dot, finding every glob that matches an event
+    type takes one step per segment of the event type, no matter how many
+    globs are stored. match() returns globs in the order they were added.
+    wildcard is what a * matches, EVENT_WILDCARD or MIDDLEWARE_WILDCARD.
+
+    """
+    def __init__(self, wildcard=EVENT_WILDCARD):
+        self._wildcard = wildcard
+        self._star = re.compile(wildcard + "$")
+        self._root = _TrieNode()
+        # maps globs to the order in which they were added
+        self._order = {}
+        self._counter = 0
+
+    def __contains__(self, matchstr):
+        return matchstr in self._order
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, matchstr):
+        if matchstr in self._order:
+            return
+        node = self._root
+        for segment in matchstr.split("."):
+            if segment == "*":
+                if node.star is None:
+                    node.star = _TrieNode()
+                node = node.star
+            elif "*" in segment:
+                if segment not in node.globs:
+                    node.globs[segment] = (compile_glob(segment,
+                        self._wildcard), _TrieNode())
+                node = node.globs[segment][1]
+            else:
+                node = node.exact.setdefault(segment, _TrieNode())
+        node.terminal = matchstr
+        self._order[matchstr] = self._counter
+        self._counter += 1
+
+    def remove(self, matchstr):
+        """Removes the glob and prunes any nodes left empty"""
+        if self._order.pop(matchstr, None) is None:
+            return
+        path = []
+        node = self._root
+        for segment in matchstr.split("."):
+            path.append((node, segment))
+            if segment == "*":
+                node = node.star
+            elif "*" in segment:
+                node = node.globs[segment][1]
+            else:
+                node = node.exact[segment]
+        node.terminal = None
+
+        for parent, segment in reversed(path):
+            if (node.terminal is not None or node.exact or node.globs
+                    or node.star is not None):
+                break
+            if segment == "*":
+                parent.star = None
+            elif "*" in segment:
+                del parent.globs[segment]
+            else:
+                del parent.exact[segment]
+            node = parent
+
+    def match(self, eventtype):
+        """Returns a list of every glob matching the given event type"""
+        nodes = [self._root]
+        for segment in eventtype.split("."):
+            next_nodes = []
+            for node in nodes:
+                child = node.exact.get(segment)
+                if child is not None:
+                    next_nodes.append(child)
+                if segment:
+                    if node.star is not None and self._star.match(segment):
+                        next_nodes.append(node.star)
+                    for regex, child in node.globs.values():
+                        if regex.match(segment):
+                            next_nodes.append(child)
+            if not next_nodes:
+                return []
+            nodes = next_nodes
+
+        matches = [node.terminal for node in nodes if node.terminal is not None]
+        matches.sort(key=self._order.__getitem__)
+        return matches
+
+_MISSING = object()
+
+class _Subscribers(object):
+    """The objects subscribed to one event glob.
+
+    Subscriptions may carry attribute constraints, e.g. channel="#minecraft",
+    in which case the object is only notified of events whose attributes are
+    equal to the given values. Constrained subscriptions are indexed by the
+    first of their constraints so that non-matching subscribers are never
+    looked at.
+
+    The subscriber collections are immutable and are replaced, never
+    modified, when a subscription changes. A dispatch in progress keeps
+    iterating over the ones it started with without having to copy them.
+
+    """
+    def __init__(self):
+        # Tuple of unconstrained subscribers
+        self.plain = ()
+        # maps attribute names to a dict mapping attribute values to tuples
+        # of (object, remaining constraints) tuples
+        self.filtered = {}
+        # maps each subscribed object to its number of subscriptions here
+        self._members = {}
+
+    def __contains__(self, obj):
+        return obj in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def __iter__(self):
+        return iter(list(self._members))
+
+    def add(self, obj, constraints=None):
+        if not constraints:
+            if obj in self.plain:
+                return
+            self.plain = self.plain + (obj,)
+        else:
+            items = sorted(constraints.items())
+            (attr, value), rest = items[0], tuple(items[1:])
+            by_value = self.filtered.get(attr, {})
+            subs = by_value.get(value, ())
+            if (obj, rest) in subs:
+                return
+            filtered = dict(self.filtered)
+            filtered[attr] = dict(by_value)
+            filtered[attr][value] = subs + ((obj, rest),)
+            self.filtered = filtered
+        self._members[obj] = self._members.get(obj, 0) + 1
+
+    def discard(self, obj):
+        if self._members.pop(obj, None) is None:
+            return
+        if obj in self.plain:
+            self.plain = tuple(x for x in self.plain if x is not obj)
+
+        filtered = {}
+        for attr, by_value in self.filtered.items():
+            new_by_value = {}
+            for value, subs in by_value.items():
+                subs = tuple(x for x in subs if x[0] is not obj)
+                if subs:
+                    new_by_value[value] = subs
+            if new_by_value:
+                filtered[attr] = new_by_value
+        self.filtered = filtered
+
+    def select_filtered(self, event):
+        """Returns the constrained subscribers that should be notified of
+        event, leaving out any that are also subscribed without constraints.
+
+        """
+        selected = ()
+        for attr, by_value in self.filtered.items():
+            value = getattr(event, attr, _MISSING)
+            try:
+                subs = by_value.get(value)
+            except TypeError:
+                # unhashable attribute value, can't be equal to any
+                # constraint
+                continue
+            if not subs:
+                continue
+            for obj, rest in subs:
+                if (obj not in selected and obj not in self.plain and
+                        all(getattr(event, rattr, _MISSING) == rvalue
+                            for rattr, rvalue in rest)):
+                    selected += (obj,)
+        return selected
+
+class Histogram(object):
+    """Fixed-size histogram of call durations.
+
+    Bucket i counts the calls that took between 2**(i-1) and 2**i
+    microseconds, so percentiles are only known to within a factor of two.
+
+    """
+    BUCKETS = 32
+
+    __slots__ = ["buckets", "count", "total", "max"]
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[min(bucket, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Returns an upper bound in seconds on the given fraction of call
+        durations, e.g. percentile(0.99)
+
+        """
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min((1 << bucket) / 1000000.0, self.max)
+        return self.max
+
+class DispatchStats(object):
+    """Times the calls the transport makes into plugins.
+
+    Durations are kept in a Histogram per (plugin name, kind, name), where
+    kind is "middleware", "event" or "request" and name is the event type or
+    request name. Only the time spent inside the call is measured; time spent
+    waiting on a returned deferred is not, since that doesn't hold up the
+    reactor.
+
+    This object provides the transport.stats request.
+
+    """
+    plugin_name = "transport.DispatchStats"
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, obj, kind, name, elapsed):
+        """Records a call that took elapsed seconds"""
+        key = (getattr(obj, "plugin_name", None) or repr(obj), kind, name)
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(elapsed)
+
+    def summary(self, top=None):
+        """Returns a list of dicts describing each histogram, most expensive
+        (by total time) first. Times are in seconds.
+
+        """
+        rows = []
+        for (plugin_name, kind, name), histogram in self.histograms.items():
+            rows.append(dict(
+                plugin=plugin_name,
+                kind=kind,
+                name=name,
+                count=histogram.count,
+                total=histogram.total,
+                max=histogram.max,
+                p50=histogram.percentile(0.5),
+                p99=histogram.percentile(0.99),
+                ))
+        rows.sort(key=lambda row: row['total'], reverse=True)
+        if top is not None:
+            rows = rows[:top]
+        return rows
+
+    def handles_event(self, eventtype):
+        return False
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def incoming_request(self, name, top=None):
+        return self.summary(top)
+
+class PluginHealth(object):
+    """A circuit breaker for event handlers. Stops sending events to a plugin
+    whose handlers keep raising exceptions or keep blocking the reactor, and
+    starts again after a cooldown.
+
+    Settings:
+    failures: how many exceptions within window seconds trip the breaker
+    slow: how many seconds a single handler call may take before it counts
+        as a slow call
+    slow_calls: how many slow calls within window seconds trip the breaker
+    window: see above
+    cooldown: how many seconds a tripped plugin gets no events for
+
+    Only event and middleware calls are watched. While a plugin's breaker is
+    tripped its middleware lets events through unchanged. Trips and
+    recoveries are logged once each.
+
+    This object provides the transport.health request.
+
+    """
+    plugin_name = "transport.PluginHealth"
+
+    def __init__(self, settings, clock=reactor):
+        self._clock = clock
+        # maps tripped objects to (reason, time of recovery, DelayedCall)
+        self.tripped = {}
+        # map objects to deques of the times of their recent failures and
+        # slow calls
+        self._failures = {}
+        self._slow = {}
+        # maps plugin names to [failures, slow calls, trips] counters
+        self.totals = defaultdict(lambda: [0, 0, 0])
+        self.configure(settings)
+
+    def configure(self, settings):
+        self.failures = settings.get("failures", 5)
+        self.slow = settings.get("slow", 0.5)
+        self.slow_calls = settings.get("slow_calls", 5)
+        self.window = settings.get("window", 60)
+        self.cooldown = settings.get("cooldown", 300)
+        self._failures.clear()
+        self._slow.clear()
+
+    @staticmethod
+    def _name(obj):
+        return getattr(obj, "plugin_name", None) or repr(obj)
+
+    def failed(self, obj):
+        self.totals[self._name(obj)][0] += 1
+        self._count(self._failures, self.failures, obj, "failing")
+
+    def timed(self, obj, elapsed):
+        if elapsed >= self.slow:
+            self.totals[self._name(obj)][1] += 1
+            self._count(self._slow, self.slow_calls, obj, "too slow")
+
+    def _count(self, recent, limit, obj, reason):
+        now = self._clock.seconds()
+        try:
+            times = recent[obj]
+        except KeyError:
+            times = recent[obj] = deque(maxlen=max(1, limit))
+        times.append(now)
+        if len(times) == times.maxlen and now - times[0] <= self.window:
+            self._trip(obj, reason)
+
+    def _trip(self, obj, reason):
+        if obj in self.tripped:
+            return
+        name = self._name(obj)
+        self.totals[name][2] += 1
+        log.msg("Plugin {0} is {1}. Not sending it any events for {2} seconds".format(
+            name, reason, self.cooldown))
+        timer = self._clock.callLater(self.cooldown, self._recover, obj)
+        self.tripped[obj] = (reason, self._clock.seconds() + self.cooldown, timer)
+        self._failures.pop(obj, None)
+        self._slow.pop(obj, None)
+
+    def _recover(self, obj):
+        del self.tripped[obj]
+        log.msg("Plugin {0} is receiving events again".format(self._name(obj)))
+
+    def forget(self, obj):
+        """Called when obj is unhooked from the transport"""
+        self._failures.pop(obj, None)
+        self._slow.pop(obj, None)
+        tripped = self.tripped.pop(obj, None)
+        if tripped is not None:
+            tripped[2].cancel()
+
+    def summary(self):
+        """Returns a list of dicts, one for each plugin that has had a failure
+        or a slow call. A tripped plugin's state is its reason, others' is
+        "ok". remaining is how many seconds a tripped plugin has left to wait.
+
+        """
+        now = self._clock.seconds()
+        tripped = dict((self._name(obj), (reason, until - now)) for obj,
+                (reason, until, timer) in self.tripped.items())
+        rows = []
+        for name, (failures, slow, trips) in sorted(self.totals.items()):
+            reason, remaining = tripped.get(name, ("ok", None))
+            rows.append(dict(plugin=name, state=reason, remaining=remaining,
+                failures=failures, slow=slow, trips=trips))
+        return rows
+
+    def handles_event(self, eventtype):
+        return False
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def incoming_request(self, name):
+        return self.summary()
+
+class StallMonitor(object):
+    """Measures how late the reactor runs a timed call, to notice when
+    something blocked it. Every event, middleware and request call the
+    transport makes is timed while the monitor is on, and each stall is
+    blamed on the slowest of those since the previous check.
+
+    Settings:
+    interval: how many seconds apart to schedule the checks
+    threshold: how many seconds late a check must be to count as a stall
+    keep: how many of the most recent stalls to remember
+
+    Stalls are logged as they are noticed. The remembered ones are served by
+    the transport.stalls request, oldest first, as dicts with the keys time,
+    stall (seconds late), and plugin, kind, name and elapsed of the slowest
+    call. Those are None if no call was made, i.e. something outside the
+    transport blocked the reactor.
+
+    """
+    plugin_name = "transport.StallMonitor"
+
+    def __init__(self, settings, clock=reactor):
+        self._clock = clock
+        self._call = None
+        self._expected = None
+        self.stalls = deque()
+        # (elapsed, obj, kind, name) of the slowest call since the last check
+        self.slowest = None
+        self.configure(settings)
+
+    def configure(self, settings):
+        self.interval = settings.get("interval", 0.1)
+        self.threshold = settings.get("threshold", 0.25)
+        self.stalls = deque(self.stalls, maxlen=settings.get("keep", 20))
+        self.stop()
+        self._schedule()
+
+    def _schedule(self):
+        self._expected = self._clock.seconds() + self.interval
+        self._call = self._clock.callLater(self.interval, self._check)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def record(self, obj, kind, name, elapsed):
+        """Records a call that took elapsed seconds"""
+        if self.slowest is None or elapsed > self.slowest[0]:
+            self.slowest = (elapsed, obj, kind, name)
+
+    def _check(self):
+        stall = self._clock.seconds() - self._expected
+        slowest, self.slowest = self.slowest, None
+        self._schedule()
+        if stall < self.threshold:
+            return
+
+        report = dict(time=self._clock.seconds(), stall=stall, plugin=None,
+                kind=None, name=None, elapsed=None)
+        if slowest is None:
+            log.msg("Reactor stalled for {0:.0f}ms. No plugin handler was called".format(
+                stall * 1000))
+        else:
+            elapsed, obj, kind, name = slowest
+            report.update(plugin=getattr(obj, "plugin_name", None) or repr(obj),
+                    kind=kind, name=name, elapsed=elapsed)
+            log.msg("Reactor stalled for {0:.0f}ms. Slowest call: {plugin} {kind} {name} ({1:.0f}ms)".format(
+                stall * 1000, elapsed * 1000, **report))
+        self.stalls.append(report)
+
+    def handles_event(self, eventtype):
+        return False
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def incoming_request(self, name):
+        return list(self.stalls)
+
+class EventQueue(object):
+    """Holds the events sent while the transport is in queued dispatch mode,
+    and drains them a bounded batch at a time per reactor turn.
+
+    Events are put in one queue per priority. The priority of an event type
+    is the highest priority of the globs matching it in the "priorities"
+    setting, or 1 if none match or it is lower. Each round, a queue gets to
+    dispatch as many events as its priority, highest priority first, so busy
+    high priority traffic can't starve the rest. The "batch" setting is the
+    number of events dispatched per reactor turn.
+
+    When max_size events are waiting, new events are handled according to
+    the "drop" setting: "oldest" drops the oldest event of the lowest
+    priority, "newest" drops the new event, and "inline" dispatches the new
+    event right away, slowing down whoever is sending them.
+
+    This object provides the transport.queue request, which returns its
+    counters.
+
+    """
+    plugin_name = "transport.EventQueue"
+
+    DEFAULT_PRIORITIES = {
+            # Replies go out before new messages are taken in
+            "irc.do_*": 4,
+            "irc.on_*": 2,
+            }
+
+    def __init__(self, dispatch, settings, clock=reactor):
+        self._dispatch = dispatch
+        self._clock = clock
+        self._scheduled = None
+
+        # list of (priority, deque of (time queued, event)) tuples, highest
+        # priority first
+        self._levels = []
+        self.depth = 0
+
+        self.max_depth = 0
+        self.enqueued = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.inline = 0
+        self.waits = Histogram()
+
+        self.configure(settings)
+
+    def configure(self, settings):
+        self.batch = settings.get("batch", 100)
+        self.max_size = settings.get("max_size", 10000)
+        self.drop = settings.get("drop", "oldest")
+
+        self._priorities = dict(settings.get("priorities",
+            self.DEFAULT_PRIORITIES))
+        self._priority_trie = SubscriptionTrie()
+        for matchstr in self._priorities:
+            self._priority_trie.add(matchstr)
+        # maps event types to their deque
+        self._level_cache = {}
+
+        # Re-queue anything waiting under the new priorities
+        pending = sorted((item for priority, level in self._levels
+            for item in level), key=lambda item: item[0])
+        self._levels = []
+        for item in pending:
+            self._level(item[1].eventtype).append(item)
+
+    def _level(self, eventtype):
+        """Returns the deque events of the given type are queued in"""
+        try:
+            return self._level_cache[eventtype]
+        except KeyError:
+            pass
+
+        # Every queue must get at least one event per round
+        priority = max([int(self._priorities[matchstr]) for matchstr in
+            self._priority_trie.match(eventtype)] + [1])
+        for levelpriority, level in self._levels:
+            if levelpriority == priority:
+                break
+        else:
+            level = deque()
+            self._levels.append((priority, level))
+            self._levels.sort(key=lambda x: x[0], reverse=True)
+
+        self._level_cache[eventtype] = level
+        return level
+
+    def put(self, event):
+        if self.depth >= self.max_size:
+            if self.drop == "newest":
+                self.dropped += 1
+                return
+            elif self.drop == "inline":
+                self.inline += 1
+                self._dispatch(event)
+                return
+            else:
+                for priority, level in reversed(self._levels):
+                    if level:
+                        level.popleft()
+                        self.depth -= 1
+                        self.dropped += 1
+                        break
+
+        self._level(event.eventtype).append((default_timer(), event))
+        self.depth += 1
+        self.enqueued += 1
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+
+        if self._scheduled is None:
+            self._scheduled = self._clock.callLater(0, self._drain)
+
+    def _drain(self):
+        self._scheduled = None
+        self._dispatch_batch(self.batch)
+        if self.depth and self._scheduled is None:
+            self._scheduled = self._clock.callLater(0, self._drain)
+
+    def _dispatch_batch(self, budget):
+        while budget > 0 and self.depth:
+            for priority, level in self._levels:
+                for _ in range(min(priority, budget, len(level))):
+                    queued_at, event = level.popleft()
+                    self.depth -= 1
+                    budget -= 1
+                    self.waits.add(default_timer() - queued_at)
+                    self.dispatched += 1
+                    self._dispatch(event)
+                if budget <= 0:
+                    break
+
+    def flush(self):
+        """Dispatches everything in the queue right away"""
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+            self._scheduled = None
+        while self.depth:
+            self._dispatch_batch(self.depth)
+
+    def summary(self):
+        """Returns a dict of the queue's counters. Times are in seconds."""
+        return dict(
+                depth=self.depth,
+                max_depth=self.max_depth,
+                enqueued=self.enqueued,
+                dispatched=self.dispatched,
+                dropped=self.dropped,
+                inline=self.inline,
+                wait_p50=self.waits.percentile(0.5),
+                wait_p99=self.waits.percentile(0.99),
+                wait_max=self.waits.max,
+                levels=[(priority, len(level)) for priority, level in self._levels],
+                )
+
+    def handles_event(self, eventtype):
+        return False
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def incoming_request(self, name):
+        return self.summary()
+
+class RequestTimedOut(Exception):
+    """A request was not answered within its timeout"""
+    pass
+
+class RequestOverloaded(Exception):
+    """A request was refused because too many calls to it were already in
+    progress or waiting
+
+    """
+    pass
+
+class _PendingRequest(object):
+    __slots__ = ["call", "result", "timer", "provider_d"]
+
+    def __init__(self, call, result):
+        self.call = call
+        self.result = result
+        self.timer = None
+        self.provider_d = None
+
+class RequestCache(object):
+    """Caches the answers to one request name, keyed by the request's
+    arguments.
+
+    Settings:
+    cache_ttl: seconds an answer is kept for. None keeps it until it's
+        invalidated.
+    cache_size: the maximum number of answers kept. The least recently used
+        is dropped first. Defaults to 100. 0 turns the cache off.
+    invalidate_on: a list of event globs. The whole cache is cleared when a
+        matching event is sent, unless invalidate_keys is given.
+    invalidate_keys: a function called with each matching event and the
+        cache, which returns the keys of the answers the event makes stale,
+        or None to clear the whole cache. answers() gives the cached answers
+        for those that depend on them.
+    cache_key: a function called with the request's arguments, which
+        returns the key its answer is cached under, e.g. a lowercased nick.
+        By default the arguments themselves are the key.
+    cache_if: a function called with each answer, which returns whether it
+        may be cached. By default every answer may be.
+
+    Only successful answers are cached. Calls with the same arguments made
+    while the first is still in progress wait for its answer instead of
+    calling the provider again; those are counted as coalesced, not as hits.
+    Calls with unhashable arguments are never cached.
+
+    Cached answers are shared between callers and must not be modified.
+
+    The transport subscribes this object to the invalidate_on globs.
+
+    """
+    def __init__(self, name, settings, clock=reactor):
+        self.plugin_name = "transport.RequestCache({0})".format(name)
+        self.settings = settings
+        self.ttl = settings.get("cache_ttl")
+        self.size = settings.get("cache_size", 100)
+        self.cache_if = settings.get("cache_if")
+        self.cache_key = settings.get("cache_key")
+        self.invalidate_on = list(settings.get("invalidate_on", []))
+        self.invalidate_keys = settings.get("invalidate_keys")
+        self._clock = clock
+
+        # maps keys to (expiry time, answer) tuples, least recently used first
+        self.entries = OrderedDict()
+        # maps keys to lists of deferreds waiting for a call in progress
+        self.in_flight = {}
+        # Incremented by clear() so answers to calls made before then aren't
+        # stored
+        self.generation = 0
+        # maps keys to how many calls for them are in progress, batched ones
+        # included
+        self.calls = Counter()
+        # keys forgotten while calls for them were in progress, whose answers
+        # are stale and so aren't stored
+        self.stale = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, args, kwargs, call):
+        """Returns a deferred for the answer to a request with the given
+        arguments. call is a function that calls the provider and returns its
+        deferred, called on a miss.
+
+        """
+        key = self.key(args, kwargs, self.cache_key)
+        if key is None:
+            self.misses += 1
+            return call()
+
+        answer = self.lookup(key)
+        if answer is not _MISSING:
+            self.hits += 1
+            return defer.succeed(answer)
+
+        if key in self.in_flight:
+            self.coalesced += 1
+            d = defer.Deferred()
+            self.in_flight[key].append(d)
+            return d
+
+        self.misses += 1
+        self.in_flight[key] = []
+        self.started(key)
+        generation = self.generation
+
+        def answered(result):
+            waiters = self.in_flight.pop(key, [])
+            if self.finished(key) and not isinstance(result, Failure):
+                self.store(key, result, generation)
+            for d in waiters:
+                d.callback(result)
+            return result
+        return call().addBoth(answered)
+
+    @staticmethod
+    def key(args, kwargs, cache_key=None):
+        """Returns the cache key for the given request arguments, or None if
+        they can't be cached
+
+        """
+        if cache_key is not None:
+            key = cache_key(*args, **kwargs)
+        else:
+            key = (tuple(args), frozenset(kwargs.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def lookup(self, key):
+        """Returns the unexpired answer for the given key or _MISSING. Doesn't
+        count as a hit or miss.
+
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or (entry[0] is not None and
+                entry[0] <= self._clock.seconds()):
+            return _MISSING
+        # Put it back as the most recently used
+        self.entries[key] = entry
+        return entry[1]
+
+    def store(self, key, answer, generation):
+        """Caches an answer, unless the cache has been cleared since the
+        given generation, when the call was made
+
+        """
+        if generation != self.generation:
+            return
+        if self.cache_if is not None and not self.cache_if(answer):
+            return
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = self._clock.seconds() + self.ttl
+        self.entries[key] = (expires, answer)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def answers(self):
+        """Returns a list of (key, answer) for the unexpired cached answers.
+        Doesn't count as hits.
+
+        """
+        now = self._clock.seconds()
+        return [(key, answer) for key, (expires, answer) in
+                self.entries.items() if expires is None or expires > now]
+
+    def started(self, key):
+        """Counts a call for key as in progress"""
+        self.calls[key] += 1
+
+    def finished(self, key):
+        """Counts a call for key as done. Returns whether its answer may be
+        stored, which it may not if key was forgotten while it was in
+        progress.
+
+        """
+        fresh = key not in self.stale
+        self.calls[key] -= 1
+        if not self.calls[key]:
+            del self.calls[key]
+            self.stale.discard(key)
+        return fresh
+
+    def forget(self, key):
+        """Drops the answer cached under key, and those of the calls for it
+        in progress
+
+        """
+        self.entries.pop(key, None)
+        if key in self.calls:
+            self.stale.add(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.stale.clear()
+        self.generation += 1
+
+    def received_event(self, event):
+        if self.invalidate_keys is None:
+            self.clear()
+            return
+        keys = self.invalidate_keys(event, self)
+        if keys is None:
+            self.clear()
+            return
+        for key in keys:
+            self.forget(key)
+
+    def handles_event(self, eventtype):
+        return True
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+class RequestPolicy(object):
+    """Enforces the limits on the calls to one request name.
+
+    Settings:
+    timeout: seconds after which the caller's deferred errbacks with
+        timeout_error and the provider's deferred is cancelled.
+    max_concurrent: how many calls may be in progress at once
+    queue: how many more calls may wait for one of those to finish. Calls
+        beyond that errback with overload_error right away.
+
+    Missing or None settings are unlimited. timeout_error and overload_error
+    are exception classes, RequestTimedOut and RequestOverloaded unless the
+    provider gives others (which should subclass them).
+
+    If any of the RequestCache settings are given, the policy's cache is
+    checked before the limits apply.
+
+    """
+    CACHE_SETTINGS = ("cache_ttl", "cache_size", "invalidate_on",
+            "invalidate_keys", "cache_key", "cache_if")
+
+    def __init__(self, name, settings, clock=reactor):
+        self.name = name
+        self._clock = clock
+        self.cache = None
+        self.in_flight = 0
+        self.waiting = deque()
+        self.timeouts = 0
+        self.overloads = 0
+        self.configure(settings)
+
+    def configure(self, settings):
+        self.timeout = settings.get("timeout")
+        self.max_concurrent = settings.get("max_concurrent")
+        self.queue = settings.get("queue") or 0
+        self.timeout_error = settings.get("timeout_error", RequestTimedOut)
+        self.overload_error = settings.get("overload_error", RequestOverloaded)
+
+        cache_settings = dict((key, settings[key]) for key in
+                self.CACHE_SETTINGS if settings.get(key) is not None)
+        if cache_settings.get("cache_size", 100) < 0:
+            raise ValueError("cache_size of {0} must not be negative".format(
+                self.name))
+        if not cache_settings or cache_settings.get("cache_size") == 0:
+            self.cache = None
+        elif self.cache is None or self.cache.settings != cache_settings:
+            self.cache = RequestCache(self.name, cache_settings, self._clock)
+
+        self._start_waiting()
+
+    def issue(self, call, args=(), kwargs={}):
+        """call is a function that issues the request to the provider and
+        returns its deferred. args and kwargs are the request's arguments,
+        used as the cache key. Returns the deferred for the caller.
+
+        """
+        if self.cache is not None:
+            return self.cache.get(args, kwargs, lambda: self.limit(call))
+        return self.limit(call)
+
+    def limit(self, call):
+        """Like issue() but without the cache"""
+        full = (self.max_concurrent is not None and
+                self.in_flight >= self.max_concurrent)
+        if full and len(self.waiting) >= self.queue:
+            self.overloads += 1
+            return defer.fail(self.overload_error(
+                "Too many {0} requests in progress".format(self.name)))
+
+        pending = _PendingRequest(call, defer.Deferred())
+        if self.timeout is not None:
+            pending.timer = self._clock.callLater(self.timeout,
+                    self._timed_out, pending)
+        if full:
+            self.waiting.append(pending)
+        else:
+            self._start(pending)
+        return pending.result
+
+    def _start(self, pending):
+        self.in_flight += 1
+        pending.provider_d = pending.call()
+        pending.provider_d.addBoth(self._finished, pending)
+
+    def _start_waiting(self):
+        while self.waiting and (self.max_concurrent is None or
+                self.in_flight < self.max_concurrent):
+            self._start(self.waiting.popleft())
+
+    def _finished(self, outcome, pending):
+        self.in_flight -= 1
+        if pending.timer is not None and pending.timer.active():
+            pending.timer.cancel()
+        # The caller has already been told if it timed out
+        if not pending.result.called:
+            pending.result.callback(outcome)
+        self._start_waiting()
+
+    def _timed_out(self, pending):
+        self.timeouts += 1
+        pending.result.errback(self.timeout_error(
+            "No answer to {0} request within {1} seconds".format(
+                self.name, self.timeout)))
+        if pending.provider_d is None:
+            self.waiting.remove(pending)
+        else:
+            # Give the provider a chance to clean up. This also frees the
+            # slot for a waiting call.
+            pending.provider_d.cancel()
+
+class RequestStats(object):
+    """Provides the transport.requests request, which returns a list of dicts
+    of the counters of each request that has a RequestPolicy
+
+    """
+    plugin_name = "transport.RequestStats"
+
+    def __init__(self, policies):
+        self._policies = policies
+
+    def handles_event(self, eventtype):
+        return False
+
+    def handles_middleware_event(self, eventtype):
+        return False
+
+    def incoming_request(self, name):
+        rows = []
+        for reqname, policy in sorted(self._policies.items()):
+            row = dict(
+                    name=reqname,
+                    in_flight=policy.in_flight,
+                    waiting=len(policy.waiting),
+                    timeouts=policy.timeouts,
+                    overloads=policy.overloads,
+                    cached=0,
+                    hits=0,
+                    misses=0,
+                    coalesced=0,
+                    )
+            if policy.cache is not None:
+                row.update(
+                        cached=len(policy.cache.entries),
+                        hits=policy.cache.hits,
+                        misses=policy.cache.misses,
+                        coalesced=policy.cache.coalesced,
+                        )
+            rows.append(row)
+        return rows
+
 class Transport(object):
     """A generalized transport layer to send messages from one plugin to another.
     
     There is one instance of this class per bot, shared among all the plugins
     """
 
-    def __init__(self):
-        # maps event names to sets of objects
-        self._middleware_listeners = defaultdict(set)
-        self._event_listeners = defaultdict(set)
+    def __init__(self, clock=reactor):
+        self._clock = clock
+
+        # maps event names to _Subscribers objects
+        self._middleware_listeners = defaultdict(_Subscribers)
+        self._event_listeners = defaultdict(_Subscribers)
         self._request_listeners = {}
 
+        # Indexes of the globs in the two dictionaries above, used to find
+        # the globs matching an event type without trying each one
+        self._middleware_trie = SubscriptionTrie(MIDDLEWARE_WILDCARD)
+        self._event_trie = SubscriptionTrie()
+
+        # maps concrete event types to a (middleware, listeners) tuple of
+        # routes, see _resolve(). Cleared whenever subscriptions change.
+        self._route_cache = {}
+
+        # A DispatchStats object if calls into plugins are being timed
+        self._stats = None
+
+        # An EventQueue object in queued dispatch mode
+        self._queue = None
+
+        # A PluginHealth object if the circuit breaker is on
+        self._health = None
+
+        # A StallMonitor object if reactor stalls are being watched for
+        self._monitor = None
+
+        # How many seconds the instrumented calls made from within the
+        # instrumented call in progress have taken, see _instrumented_call()
+        self._nested = 0.0
+
+        # maps request names to RequestPolicy objects, for requests with
+        # limits. The settings are merged from three places, see
+        # _update_request_policy()
+        self._request_policies = {}
+        self._provider_policies = {}
+        self._request_settings = {}
+        self._request_defaults = {}
+
+        # Reverse index of the above: maps each subscribed object to a set of
+        # (is middleware, matchstr) tuples of its subscriptions, and each
+        # request provider to a set of the request names it provides. Used to
+        # unhook a plugin without looking at anyone else's subscriptions.
+        self._subscriptions = defaultdict(set)
+        self._provided = defaultdict(set)
+
+        # Callables called with each object passed to unhook_plugin(), for
+        # things that keep their own records of plugins
+        self.unhook_observers = []
+
+        self.provides_request("transport.requests",
+                RequestStats(self._request_policies))
+
+    def configure(self, config):
+        """Applies the transport settings from the bot's master config dict.
+        Called at startup and whenever the config is reloaded.
+
+        """
+        settings = config.get("core", {}).get("transport", {})
+
+        if settings.get("stats") and self._stats is None:
+            self._stats = DispatchStats()
+            self.provides_request("transport.stats", self._stats)
+        elif not settings.get("stats") and self._stats is not None:
+            self.unhook_plugin(self._stats)
+            self._stats = None
+
+        queue_settings = settings.get("queue")
+        if queue_settings is not None and self._queue is None:
+            self._queue = EventQueue(self._dispatch, queue_settings, self._clock)
+            self.provides_request("transport.queue", self._queue)
+        elif queue_settings is not None:
+            self._queue.configure(queue_settings)
+        elif self._queue is not None:
+            queue, self._queue = self._queue, None
+            self.unhook_plugin(queue)
+            queue.flush()
+
+        breaker_settings = settings.get("breaker")
+        if breaker_settings is not None and self._health is None:
+            self._health = PluginHealth(breaker_settings, self._clock)
+            self.provides_request("transport.health", self._health)
+        elif breaker_settings is not None:
+            self._health.configure(breaker_settings)
+        elif self._health is not None:
+            health, self._health = self._health, None
+            self.unhook_plugin(health)
+            for obj in list(health.tripped):
+                health.forget(obj)
+
+        stall_settings = settings.get("stalls")
+        if stall_settings is not None and self._monitor is None:
+            self._monitor = StallMonitor(stall_settings, self._clock)
+            self.provides_request("transport.stalls", self._monitor)
+        elif stall_settings is not None:
+            self._monitor.configure(stall_settings)
+        elif self._monitor is not None:
+            monitor, self._monitor = self._monitor, None
+            self.unhook_plugin(monitor)
+            monitor.stop()
+
+        self._request_defaults = settings.get("request_defaults", {})
+        self._request_settings = settings.get("requests", {})
+        for name in set(chain(self._request_listeners, self._request_policies)):
+            self._update_request_policy(name)
+
+    def _route(self, eventtype):
+        """Returns the (middleware, listeners) routes for the given event
+        type, resolving and caching them if necessary
+
+        """
+        try:
+            return self._route_cache[eventtype]
+        except KeyError:
+            pass
+
+        route = (
+                self._resolve(self._middleware_listeners,
+                    self._middleware_trie, "handles_middleware_event", eventtype),
+                self._resolve(self._event_listeners,
+                    self._event_trie, "handles_event", eventtype),
+                )
+        self._route_cache[eventtype] = route
+        return route
+
+    @staticmethod
+    def _resolve(listeners, trie, methodname, eventtype):
+        """Resolves the subscribers of every glob matching eventtype into a
+        (plain, filtered, skip) tuple:
+
+        plain is a tuple of (object, _Subscribers) pairs, one per
+        unconstrained subscription, in glob order.
+        filtered is a tuple of the _Subscribers objects that have constrained
+        subscriptions, which must be checked against each event.
+        skip is a frozenset of objects that say they have no handler for this
+        event type (by returning False from the given method) and are
+        therefore never called. Objects without the method get everything.
+
+        """
+        plain = []
+        filtered = []
+        skip = set()
+        for matchstr in trie.match(eventtype):
+            callback_obj_set = listeners[matchstr]
+            for callback_obj in callback_obj_set:
+                handles = getattr(callback_obj, methodname, None)
+                if handles is not None and not handles(eventtype):
+                    skip.add(callback_obj)
+            plain.extend((callback_obj, callback_obj_set) for callback_obj in
+                    callback_obj_set.plain if callback_obj not in skip)
+            if callback_obj_set.filtered:
+                filtered.append(callback_obj_set)
+        return tuple(plain), tuple(filtered), frozenset(skip)
+
     def send_event(self, event):
-        # Note: iterating over the listener dictionaries and sets are done with
-        # copies, not an iterator, because of the posibility of the dictionary
-        # being modified somewhere down the stack in an event handler
+        """Sends an event to the middleware and listeners subscribed to it.
+        In queued dispatch mode this only queues the event.
+
+        """
+        if self._queue is not None:
+            self._queue.put(event)
+        else:
+            self._dispatch(event)
+
+    def _dispatch(self, event):
+        # The routes are immutable and are replaced, not modified, when a
+        # subscription changes somewhere down the stack in an event handler,
+        # so they can be iterated over directly. Each subscriber is checked
+        # to still be subscribed right before it's called.
+        eventtype = event.eventtype
+        middleware, listeners = self._route(eventtype)
+        instrumented = (self._stats is not None or self._health is not None
+                or self._monitor is not None)
 
         # First call all middleware
-        for callback_name, callback_obj_set in list(self._middleware_listeners.items()):
-            callback_parts = [re.escape(x) for x in callback_name.split("*")]
-            callback_match = "[^. ]+".join(callback_parts) + "$"
-            if re.match(callback_match, event.eventtype):
-                for callback_obj in set(callback_obj_set):
-                    try:
-                        event = callback_obj.received_middleware_event(event)
-                    except Exception:
-                        # We don't want one plugin's errors to prevent other
-                        # plugins from being called
-                        import traceback
-                        log.msg(traceback.format_exc())
-                    if not event:
-                        return
+        plain, filtered, skip = middleware
+        for callback_obj, callback_obj_set in self._subscribers(event, plain,
+                filtered, skip):
+            if callback_obj not in callback_obj_set:
+                continue
+            try:
+                if not instrumented:
+                    event = callback_obj.received_middleware_event(event)
+                else:
+                    event = self._instrumented_call(callback_obj, "middleware",
+                            callback_obj.received_middleware_event, event)
+            except Exception:
+                # We don't want one plugin's errors to prevent other
+                # plugins from being called
+                import traceback
+                log.msg(traceback.format_exc())
+            if not event:
+                return
 
         # Now call the event handlers
-        for callback_name, callback_obj_set in list(self._event_listeners.items()):
-            callback_match = callback_name.replace("*", "[^.]+") + "$"
-            if re.match(callback_match, event.eventtype):
-                # create a new set since the set may mutate while we iterate over it
-                for callback_obj in set(callback_obj_set):
-                    try:
-                        # Do a check to see if it's still in the original set. If
-                        # it *has* been removed (by an earlier callback, for
-                        # example), then don't call it
-                        if callback_obj in callback_obj_set:
-                            callback_obj.received_event(event)
-                    except Exception:
-                        # We don't want one plugin's errors to prevent other
-                        # plugins from being called.
-                        import traceback
-                        log.msg(traceback.format_exc())
-
-    def install_middleware(self, matchstr, obj_to_notify):
-        self._middleware_listeners[matchstr].add(obj_to_notify)
-
-    def listen_for_event(self, matchstr, obj_to_notify):
-        self._event_listeners[matchstr].add(obj_to_notify)
+        plain, filtered, skip = listeners
+        for callback_obj, callback_obj_set in self._subscribers(event, plain,
+                filtered, skip):
+            try:
+                # Do a check to see if it's still subscribed. If it *has* been
+                # removed (by an earlier callback, for example), then don't
+                # call it
+                if callback_obj not in callback_obj_set:
+                    continue
+                if not instrumented:
+                    callback_obj.received_event(event)
+                else:
+                    self._instrumented_call(callback_obj, "event",
+                            callback_obj.received_event, event)
+            except Exception:
+                # We don't want one plugin's errors to prevent other
+                # plugins from being called.
+                import traceback
+                log.msg(traceback.format_exc())
+
+    def call_handler(self, callback_obj, method, event):
+        """Calls method(event) on behalf of callback_obj, as if the transport
+        had sent it event itself: the call is timed, watched by the circuit
+        breaker and the stall monitor, and charged to callback_obj, not to
+        whoever is calling this. For objects that pass events on to plugins,
+        such as the command router. Exceptions are raised.
+
+        """
+        if (self._stats is None and self._health is None and
+                self._monitor is None):
+            return method(event)
+        return self._instrumented_call(callback_obj, "event", method, event)
+
+    def _instrumented_call(self, callback_obj, kind, method, event):
+        """Calls method(event) for the given event handler object, timing it
+        and checking its health for whichever of the stats, the circuit
+        breaker and the stall monitor are enabled. Returns what the method
+        returns, or the event unchanged if the object's circuit breaker is
+        tripped.
+
+        Time spent in instrumented calls made from inside this one, see
+        call_handler(), is charged to their objects and not to this one.
+
+        """
+        health = self._health
+        if health is not None and callback_obj in health.tripped:
+            return event
+        eventtype = event.eventtype
+        outer_nested, self._nested = self._nested, 0.0
+        start = default_timer()
+        try:
+            return method(event)
+        except Exception:
+            if health is not None:
+                health.failed(callback_obj)
+            raise
+        finally:
+            total = default_timer() - start
+            elapsed = total - self._nested
+            self._nested = outer_nested + total
+            if self._stats is not None:
+                self._stats.record(callback_obj, kind, eventtype, elapsed)
+            if self._monitor is not None:
+                self._monitor.record(callback_obj, kind, eventtype, elapsed)
+            if health is not None:
+                health.timed(callback_obj, elapsed)
+
+    def _timed_request(self, obj, name, method, *args, **kwargs):
+        """Calls method(name, *args, **kwargs) on a request provider, timing
+        it if the stats or the stall monitor are enabled
+
+        """
+        if self._stats is None and self._monitor is None:
+            return method(name, *args, **kwargs)
+        start = default_timer()
+        try:
+            return method(name, *args, **kwargs)
+        finally:
+            elapsed = default_timer() - start
+            if self._stats is not None:
+                self._stats.record(obj, "request", name, elapsed)
+            if self._monitor is not None:
+                self._monitor.record(obj, "request", name, elapsed)
+
+    @staticmethod
+    def _subscribers(event, plain, filtered, skip):
+        """Yields (object, _Subscribers) pairs for each subscriber of a route
+        to be notified of event
+
+        """
+        if not filtered:
+            # The common case needs no allocation
+            return plain
+        return chain(plain, (
+            (callback_obj, callback_obj_set)
+            for callback_obj_set in filtered
+            for callback_obj in callback_obj_set.select_filtered(event)
+            if callback_obj not in skip))
+
+    def _listeners(self, middleware):
+        """Returns the (listeners, trie) of either middleware or listeners"""
+        if middleware:
+            return self._middleware_listeners, self._middleware_trie
+        return self._event_listeners, self._event_trie
+
+    def _subscribe(self, middleware, matchstr, obj_to_notify, constraints):
+        listeners, trie = self._listeners(middleware)
+        trie.add(matchstr)
+        listeners[matchstr].add(obj_to_notify, constraints)
+        self._subscriptions[obj_to_notify].add((middleware, matchstr))
+        self._route_cache.clear()
+
+    def install_middleware(self, matchstr, obj_to_notify, **constraints):
+        """Installs obj_to_notify as middleware for events matching matchstr.
+        See listen_for_event() for the meaning of constraints.
+
+        """
+        self._subscribe(True, matchstr, obj_to_notify, constraints)
+
+    def listen_for_event(self, matchstr, obj_to_notify, **constraints):
+        """Registers obj_to_notify to receive events matching matchstr.
+
+        Any keyword arguments are attribute constraints: the object is only
+        notified of events that have each named attribute equal to the given
+        value. e.g. listen_for_event("irc.on_privmsg", self,
+        channel="#minecraft") only receives messages to #minecraft.
+
+        An object may subscribe more than once to the same glob with
+        different constraints. It is notified once per event if any of the
+        subscriptions match.
+
+        """
+        self._subscribe(False, matchstr, obj_to_notify, constraints)
+
+    def _unsubscribe(self, middleware, matchstr, obj):
+        listeners, trie = self._listeners(middleware)
+        obj_set = listeners.get(matchstr)
+        if obj_set is None or obj not in obj_set:
+            return
+        obj_set.discard(obj)
+        if not obj_set:
+            del listeners[matchstr]
+            trie.remove(matchstr)
+        self._route_cache.clear()
+
+    def stop_listening_for_event(self, matchstr, obj_to_notify):
+        """Removes the subscriptions obj_to_notify made to matchstr with
+        listen_for_event(), whatever their constraints
+
+        """
+        self._unsubscribe(False, matchstr, obj_to_notify)
+        subscriptions = self._subscriptions.get(obj_to_notify)
+        if subscriptions is not None:
+            subscriptions.discard((False, matchstr))
+            if not subscriptions:
+                del self._subscriptions[obj_to_notify]
 
 
     ### Request Interface
@@ -118,7 +1497,104 @@ class Transport(object):
            return defer.fail(NotImplementedError("Request name %r is not implemented"%(name,)))
 
         try:
-            toret = obj.incoming_request(name, *args, **kwargs)
+            policy = self._request_policies[name]
+        except KeyError:
+            return self._call_provider(obj, name, args, kwargs)
+        return policy.issue(lambda: self._call_provider(obj, name, args, kwargs),
+                args, kwargs)
+
+    def issue_requests(self, name, argsets):
+        """Plugins: call this to send the same request many times with
+        different arguments. argsets is a list of tuples of arguments. Returns
+        a deferred that fires with a list of (success, result) tuples, one for
+        each argset in order, like a DeferredList with consumeErrors set.
+
+        If the provider has a handler for the whole batch (see
+        BotPlugin.incoming_batch_request()), cached answers are taken from the
+        request's cache and the rest are sent to the provider in one call,
+        which counts as one call towards the request's limits. Otherwise each
+        argset is issued as a separate request.
+
+        """
+        argsets = [tuple(args) for args in argsets]
+        try:
+            obj = self._request_listeners[name]
+        except KeyError:
+           return defer.fail(NotImplementedError("Request name %r is not implemented"%(name,)))
+
+        handles = getattr(obj, "handles_batch_request", None)
+        if handles is None or not handles(name):
+            return defer.DeferredList([self.issue_request(name, *args)
+                for args in argsets], consumeErrors=True)
+
+        policy = self._request_policies.get(name)
+        cache = policy.cache if policy is not None else None
+
+        results = [None] * len(argsets)
+        # (index, argset, cache key) of each argset to ask the provider about
+        misses = []
+        for index, args in enumerate(argsets):
+            key = cache.key(args, {}, cache.cache_key) if cache is not None else None
+            answer = cache.lookup(key) if key is not None else _MISSING
+            if answer is _MISSING:
+                misses.append((index, args, key))
+                if cache is not None:
+                    cache.misses += 1
+            else:
+                cache.hits += 1
+                results[index] = (True, answer)
+        if not misses:
+            return defer.succeed(results)
+
+        generation = cache.generation if cache is not None else None
+        for index, args, key in misses:
+            if key is not None:
+                cache.started(key)
+        call = lambda: self._call_batch_provider(obj, name,
+                [args for index, args, key in misses])
+        d = policy.limit(call) if policy is not None else call()
+
+        def answered(answers):
+            for (index, args, key), (success, answer) in zip(misses, answers):
+                results[index] = (success, answer)
+                if key is not None and cache.finished(key) and success:
+                    cache.store(key, answer, generation)
+            return results
+        def failed(failure):
+            # The batch as a whole timed out or was refused
+            for index, args, key in misses:
+                results[index] = (False, failure)
+                if key is not None:
+                    cache.finished(key)
+            return results
+        return d.addCallbacks(answered, failed)
+
+    def _call_batch_provider(self, obj, name, argsets):
+        """Sends a batch to a provider. Returns a deferred that fires with a
+        list of (success, result) tuples. Cancelling it cancels the
+        provider's deferreds.
+
+        """
+        try:
+            answers = self._timed_request(obj, name,
+                    obj.incoming_batch_request, argsets)
+        except Exception as e:
+            return defer.fail(e)
+
+        answers = [answer if isinstance(answer, defer.Deferred) else
+                defer.succeed(answer) for answer in answers]
+        if len(answers) != len(argsets):
+            return defer.fail(ValueError("Batch handler for {0} returned {1} answers for {2} requests".format(
+                name, len(answers), len(argsets))))
+
+        d = defer.Deferred(lambda _: [answer.cancel() for answer in answers])
+        defer.DeferredList(answers, consumeErrors=True).chainDeferred(d)
+        return d
+
+    def _call_provider(self, obj, name, args, kwargs):
+        try:
+            toret = self._timed_request(obj, name, obj.incoming_request,
+                    *args, **kwargs)
         except Exception as e:
             return defer.fail(e)
 
@@ -129,25 +1605,86 @@ class Transport(object):
 
         return toret
 
-    def provides_request(self, name, obj_to_notify):
+    def provides_request(self, name, obj_to_notify, **policy):
         """Plugins: call this in your start() method to receive requests for this reqeust name
 
+        Any keyword arguments are the default limits for the request. See
+        RequestPolicy for what they are. e.g. provides_request("irc.whois",
+        self, timeout=10) makes callers' deferreds errback with a
+        RequestTimedOut after 10 seconds. The deferred returned to the
+        provider is cancelled when that happens, so it should have a canceller
+        that forgets about the call.
+
         """
         if name in self._request_listeners:
             log.msg("WARNING! two plugins provide the request {0}: {1} and {2}".format(
                 name, obj_to_notify.plugin_name, self._request_listeners[name].plugin_name))
         self._request_listeners[name] = obj_to_notify
+        self._provided[obj_to_notify].add(name)
+        self._provider_policies[name] = policy
+        self._update_request_policy(name)
+
+        # Don't answer with anything a previous provider said
+        policy = self._request_policies.get(name)
+        if policy is not None and policy.cache is not None:
+            policy.cache.clear()
+
+    def _update_request_policy(self, name):
+        """Creates, updates or removes the RequestPolicy of the named request.
+        The config's request_defaults are overridden by the provider's
+        defaults, which are overridden by the config's settings for the
+        request.
+
+        """
+        settings = dict(self._request_defaults)
+        settings.update(self._provider_policies.get(name, {}))
+        settings.update(self._request_settings.get(name, {}))
+
+        policy = self._request_policies.get(name)
+        old_cache = policy.cache if policy is not None else None
+
+        if not any(settings.get(key) is not None for key in
+                ("timeout", "max_concurrent") + RequestPolicy.CACHE_SETTINGS):
+            if policy is not None:
+                del self._request_policies[name]
+                # Let anything still waiting through
+                policy.configure(settings)
+            new_cache = None
+        else:
+            if policy is not None:
+                policy.configure(settings)
+            else:
+                policy = self._request_policies[name] = RequestPolicy(name,
+                        settings, self._clock)
+            new_cache = policy.cache
+
+        if new_cache is not old_cache:
+            if old_cache is not None:
+                self.unhook_plugin(old_cache)
+            if new_cache is not None:
+                for matchstr in new_cache.invalidate_on:
+                    self.listen_for_event(matchstr, new_cache)
 
 
     ### Called on plugin unloading
 
     def unhook_plugin(self, plugin):
-        for obj_set in chain(iter(self._middleware_listeners.values()),
-                iter(self._event_listeners.values())):
-            obj_set.discard(plugin)
-        for reqname, obj in list(self._request_listeners.items()):
-            if obj is plugin:
+        """Removes every subscription and request the given object has"""
+        for observer in self.unhook_observers:
+            observer(plugin)
+
+        if self._health is not None:
+            self._health.forget(plugin)
+
+        for middleware, matchstr in self._subscriptions.pop(plugin, ()):
+            self._unsubscribe(middleware, matchstr, plugin)
+
+        for reqname in self._provided.pop(plugin, ()):
+            # Another object may have taken over the request since
+            if self._request_listeners.get(reqname) is plugin:
                 del self._request_listeners[reqname]
+                del self._provider_policies[reqname]
+                self._update_request_policy(reqname)
 
 
 class Event(object):
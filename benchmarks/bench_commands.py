@@ -0,0 +1,82 @@
+"""
+Compares finding the command a message invokes by trying each command's
+regex in turn, which is how each CommandPluginSuperclass plugin used to
+check its commands, against trying them all at once with the combined
+alternation regexes of abbott.command._Alternation.
+
+Usage:
+
+    python benchmarks/bench_commands.py
+
+"""
+from __future__ import print_function
+
+import os.path
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from abbott.command import _Alternation
+
+def make_commands(count):
+    """Generates count distinct command regexes resembling what
+    _CommandGroup.install_command() builds
+
+    """
+    rng = random.Random(count)
+    regexes = []
+    names = set()
+    while len(regexes) < count:
+        name = "cmd%d" % rng.randint(0, 100000)
+        if name in names:
+            continue
+        names.add(name)
+        if rng.random() < 0.5:
+            pattern = r"(?:%s)(?: |\b)(?:(?P<nick>\w+)(?: (?P<reason>.*))?$)" % name
+        else:
+            pattern = r"(?:%s)$" % name
+        regexes.append(re.compile(pattern))
+    return regexes
+
+def invocation(regex):
+    """Returns a message that invokes the command regex matches"""
+    name = regex.pattern[3:].split(")")[0]
+    if "(?P<nick>" in regex.pattern:
+        return name + " bob being rude"
+    return name
+
+def linear(regexes, message):
+    for pos, regex in enumerate(regexes):
+        m = regex.match(message)
+        if m:
+            return pos, m
+    return None, None
+
+def main():
+    print("{0:>9} {1:>8} {2:>14} {3:>14}".format(
+        "commands", "message", "linear (us)", "combined (us)"))
+    for count in (50, 500):
+        regexes = make_commands(count)
+        alternation = _Alternation(regexes)
+        messages = [
+                ("first", invocation(regexes[0])),
+                ("middle", invocation(regexes[count // 2])),
+                ("last", invocation(regexes[-1])),
+                ("none", "just chatting here"),
+                ]
+        for label, message in messages:
+            assert linear(regexes, message)[0] == alternation.first(message)[0]
+            number = 2000
+            results = []
+            for func in (linear, lambda regexes, message: alternation.first(message)):
+                best = min(timeit.repeat(lambda: func(regexes, message),
+                    number=number, repeat=3))
+                results.append(best / number * 1e6)
+            print("{0:>9} {1:>8} {2:>14.2f} {3:>14.2f}".format(count, label,
+                *results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares the cost of finding the globs that match an event type using the
+SubscriptionTrie against a linear scan over every glob, which is how
+Transport.send_event resolved routes before the trie. The route cache in the
+transport hides both on repeated event types, so this measures what a cache
+miss costs.
+
+Usage:
+
+    python benchmarks/bench_routing.py
+
+"""
+from __future__ import print_function
+
+import os.path
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from abbott.transport import SubscriptionTrie, compile_glob
+
+EVENT_TYPES = [
+        "irc.on_privmsg",
+        "irc.on_notice",
+        "irc.on_unknown",
+        "irc.do_msg",
+        "ircutil.hasop.acquired",
+        ]
+
+def make_globs(count):
+    """Generates count distinct globs resembling what plugins listen for"""
+    rng = random.Random(count)
+    globs = ["irc.on_privmsg", "irc.on_*", "irc.do_*", "*.*",
+            "ircutil.hasop.*"]
+    while len(globs) < count:
+        domain = rng.choice(["irc", "ircutil", "plugin%d" % rng.randint(0, 50)])
+        action = rng.choice(["on", "do", "get"]) + "_" + "x%d" % rng.randint(0, 10000)
+        if rng.random() < 0.2:
+            action = action[:4] + "*"
+        glob = domain + "." + action
+        if glob not in globs:
+            globs.append(glob)
+    return globs[:count]
+
+def linear_uncompiled(globs, eventtype):
+    callback_matches = []
+    for glob in globs:
+        callback_parts = [re.escape(x) for x in glob.split("*")]
+        if re.match("[^. ]+".join(callback_parts) + "$", eventtype):
+            callback_matches.append(glob)
+    return callback_matches
+
+def main():
+    print("{0:>6} {1:>16} {2:>16} {3:>16}".format(
+        "globs", "regex/call (us)", "precompiled (us)", "trie (us)"))
+    for count in (10, 100, 1000):
+        globs = make_globs(count)
+        compiled = [(glob, compile_glob(glob)) for glob in globs]
+        trie = SubscriptionTrie()
+        for glob in globs:
+            trie.add(glob)
+
+        def run_uncompiled():
+            for eventtype in EVENT_TYPES:
+                linear_uncompiled(globs, eventtype)
+
+        def run_linear():
+            for eventtype in EVENT_TYPES:
+                [glob for glob, regex in compiled if regex.match(eventtype)]
+
+        def run_trie():
+            for eventtype in EVENT_TYPES:
+                trie.match(eventtype)
+
+        # Keep the slow uncompiled scan from taking forever at 1000 globs
+        number = max(5, 2000 // count)
+        results = []
+        for func in (run_uncompiled, run_linear, run_trie):
+            best = min(timeit.repeat(func, number=number, repeat=3))
+            results.append(best / number / len(EVENT_TYPES) * 1e6)
+
+        print("{0:>6} {1:>16.2f} {2:>16.2f} {3:>16.2f}".format(count, *results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+from abbott import entrypt
+entrypt.replay()